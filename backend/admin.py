@@ -20,6 +20,7 @@ class ShopAdmin(admin.ModelAdmin):
     list_filter = ['user']
     search_fields = ['name', 'url']
     raw_id_fields = ['user']
+    readonly_fields = ['feed_etag', 'feed_last_modified', 'feed_hash']
 
 
 @admin.register(Category)
@@ -6,4 +6,7 @@ class BackendConfig(AppConfig):
 
     def ready(self):
         # Импортируем сигналы
-        import backend.signals
\ No newline at end of file
+        import backend.signals
+        from django.db.models.signals import post_migrate
+        from backend.search import create_search_indexes
+        post_migrate.connect(create_search_indexes, sender=self)
\ No newline at end of file
@@ -0,0 +1,56 @@
+"""
+Бенчмарк импорта прайса поставщика
+
+Масштабирует товары из shop1.yaml до нужного количества и прогоняет
+PriceListImporter на настроенной базе данных. Все изменения
+откатываются после замера.
+
+Запуск:
+    python -m backend.benchmarks.bench_import --goods 100000
+"""
+import argparse
+import os
+import time
+
+import django
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'purchases.settings')
+django.setup()
+
+from django.db import transaction
+
+from backend.importer import PriceListImporter, IMPORT_BATCH_SIZE, IMPORT_MODES, IMPORT_MODE_SYNC
+from backend.models import User
+from backend.benchmarks.feeds import load_sample_feed, scale_feed
+
+
+def run(goods_count, batch_size, mode):
+    data = scale_feed(load_sample_feed(), goods_count)
+
+    with transaction.atomic():
+        user = User.objects.create_user(email='bench-import@example.com', password=None,
+                                        username='bench', type='shop', is_active=True)
+        start_time = time.perf_counter()
+        stats = PriceListImporter(user.id, batch_size=batch_size, mode=mode).run(data)
+        elapsed = time.perf_counter() - start_time
+
+        # Повторная синхронизация того же прайса: все строки без изменений
+        start_time = time.perf_counter()
+        resync_stats = PriceListImporter(user.id, batch_size=batch_size).run(data)
+        resync_elapsed = time.perf_counter() - start_time
+        transaction.set_rollback(True)
+
+    print(f"Товаров: {goods_count}, пакет: {batch_size}, режим: {mode}")
+    print(f"Время: {elapsed:.2f} с, скорость: {goods_count / elapsed:.0f} строк/с")
+    print(f"Статистика: {stats}")
+    print(f"Повторная синхронизация: {resync_elapsed:.2f} с, "
+          f"скорость: {goods_count / resync_elapsed:.0f} строк/с, без изменений: {resync_stats['unchanged']}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Бенчмарк импорта прайса')
+    parser.add_argument('--goods', type=int, default=100000)
+    parser.add_argument('--batch-size', type=int, default=IMPORT_BATCH_SIZE)
+    parser.add_argument('--mode', choices=IMPORT_MODES, default=IMPORT_MODE_SYNC)
+    args = parser.parse_args()
+    run(args.goods, args.batch_size, args.mode)
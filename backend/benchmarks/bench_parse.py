@@ -0,0 +1,100 @@
+"""
+Бенчмарк разбора прайса: загрузка целиком через yaml.load против потокового read_feed
+
+Каждый вариант запускается в отдельном процессе, чтобы пиковая память
+(ru_maxrss) одного замера не влияла на другой.
+
+Запуск:
+    python -m backend.benchmarks.bench_parse --goods 100000 --format yaml
+"""
+import argparse
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+import django
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'purchases.settings')
+django.setup()
+
+from yaml import load as load_yaml, Loader
+
+from backend.feed_parsers import read_feed, FEED_FORMATS, FEED_FORMAT_YAML
+from backend.benchmarks.feeds import load_sample_feed, iter_scaled_goods, write_feed
+
+VARIANT_LEGACY = 'legacy'
+VARIANT_STREAMING = 'streaming'
+
+
+def parse_legacy(path, feed_format):
+    # Как раньше в UpdatePrice: весь ответ в памяти и yaml.load с Python-загрузчиком
+    with open(path, 'rb') as feed:
+        data = load_yaml(feed.read(), Loader=Loader)
+    return sum(1 for _ in data['goods'])
+
+
+def parse_streaming(path, feed_format):
+    with open(path, 'rb') as feed:
+        data = read_feed(feed, feed_format)
+        return sum(1 for _ in data['goods'])
+
+
+PARSERS = {
+    VARIANT_LEGACY: parse_legacy,
+    VARIANT_STREAMING: parse_streaming,
+}
+
+
+def measure(variant, path, feed_format):
+    """
+    Выполняется в дочернем процессе: время разбора и прирост пиковой памяти в МБ
+    """
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start_time = time.perf_counter()
+    goods = PARSERS[variant](path, feed_format)
+    elapsed = time.perf_counter() - start_time
+    rss_after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    print(f"{goods} {elapsed} {(rss_after - rss_before) / 1024}")
+
+
+def run_variant(variant, path, feed_format):
+    output = subprocess.run(
+        [sys.executable, '-m', 'backend.benchmarks.bench_parse', '--measure', variant,
+         '--path', path, '--format', feed_format],
+        check=True, capture_output=True, text=True,
+    ).stdout.split()
+    goods, elapsed, peak_mb = output[-3:]
+    return int(goods), float(elapsed), float(peak_mb)
+
+
+def run(goods_count, feed_format):
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, f'feed.{feed_format}')
+        sample = load_sample_feed()
+        write_feed(path, sample, iter_scaled_goods(sample['goods'], goods_count), feed_format)
+        size_mb = os.path.getsize(path) / 1024 / 1024
+
+        print(f"Товаров: {goods_count}, формат: {feed_format}, размер файла: {size_mb:.1f} МБ")
+        variants = [VARIANT_STREAMING]
+        if feed_format == FEED_FORMAT_YAML:
+            variants.insert(0, VARIANT_LEGACY)
+        for variant in variants:
+            goods, elapsed, peak_mb = run_variant(variant, path, feed_format)
+            print(f"{variant}: {elapsed:.2f} с, {goods / elapsed:.0f} строк/с, "
+                  f"прирост пиковой памяти: {peak_mb:.1f} МБ")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Бенчмарк разбора прайса')
+    parser.add_argument('--goods', type=int, default=100000)
+    parser.add_argument('--format', choices=FEED_FORMATS, default=FEED_FORMAT_YAML)
+    parser.add_argument('--measure', choices=list(PARSERS), help=argparse.SUPPRESS)
+    parser.add_argument('--path', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.measure:
+        measure(args.measure, args.path, args.format)
+    else:
+        run(args.goods, args.format)
@@ -0,0 +1,228 @@
+"""
+Бенчмарк полного пути импорта прайса (UpdatePrice -> import_price_list)
+
+Генерирует синтетические прайсы в формате shop1.yaml на 1k, 10k, 100k
+(и по запросу 1M) товаров, отдает их локальным HTTP-сервером и прогоняет
+задачу импорта на базе из настроек проекта (Postgres или SQLite).
+Каждый размер замеряется в отдельном процессе, изменения откатываются.
+
+Сценарии:
+    import - первичная загрузка каталога
+    resync - повторная синхронизация того же прайса с force (diff без изменений)
+    unchanged - повторная загрузка без force: пропуск по хешу содержимого
+
+Для каждого сценария записываются время, число запросов, пиковая память
+и строк/с. Результаты сохраняются в JSON, --compare сравнивает с прошлым файлом.
+
+Запуск:
+    python -m backend.benchmarks.bench_pipeline --sizes 1000,10000,100000
+    python -m backend.benchmarks.bench_pipeline --sizes 1000000 --compare backend/benchmarks/results/<commit>.json
+"""
+import argparse
+import functools
+import http.server
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime, timezone
+from pathlib import Path
+
+import django
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'purchases.settings')
+django.setup()
+
+from django.db import connection, transaction
+
+from backend.benchmarks.feeds import load_sample_feed, iter_synthetic_goods, synthetic_parameter_names, write_feed
+from backend.feed_parsers import FEED_FORMATS, FEED_FORMAT_YAML
+from backend.import_jobs import ImportJob
+from backend.models import User
+from backend.tasks import import_price_list
+
+RESULTS_DIR = Path(__file__).resolve().parent / 'results'
+DEFAULT_SIZES = '1000,10000,100000'
+SCENARIOS = (
+    ('import', {}),
+    ('resync', {'force': True}),
+    ('unchanged', {}),
+)
+
+
+class QueryCounter:
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        self.count += 1
+        return execute(sql, params, many, context)
+
+
+def reset_peak_memory():
+    """
+    Сбрасывает пик RSS процесса (Linux), чтобы мерить каждый сценарий отдельно
+    """
+    try:
+        with open('/proc/self/clear_refs', 'w') as clear_refs:
+            clear_refs.write('5')
+    except OSError:
+        pass
+
+
+def peak_memory_mb():
+    try:
+        with open('/proc/self/status') as status:
+            for line in status:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def measure_scenario(user, url, goods_count, **job_options):
+    job = ImportJob.create(user.id, url, **job_options)
+    counter = QueryCounter()
+    reset_peak_memory()
+    start_time = time.perf_counter()
+    with connection.execute_wrapper(counter):
+        import_price_list.apply(args=(job.id,))
+    elapsed = time.perf_counter() - start_time
+
+    job_data = ImportJob.get(job.id).to_dict()
+    if job_data['errors']:
+        raise RuntimeError(f"Импорт завершился с ошибкой: {job_data['errors']}")
+    return {
+        'phase': job_data['phase'],
+        'wall_time_s': round(elapsed, 3),
+        'queries': counter.count,
+        'peak_memory_mb': round(peak_memory_mb(), 1),
+        'rows_per_second': round(goods_count / elapsed, 1) if elapsed > 0 else 0,
+    }
+
+
+def measure(goods_count, url):
+    """
+    Выполняется в дочернем процессе: все сценарии для одного размера прайса
+    """
+    results = []
+    with transaction.atomic():
+        user = User.objects.create_user(email='bench-pipeline@example.com', password=None,
+                                        username='bench', type='shop', is_active=True)
+        for scenario, job_options in SCENARIOS:
+            results.append({'goods': goods_count, 'scenario': scenario,
+                            **measure_scenario(user, url, goods_count, **job_options)})
+        transaction.set_rollback(True)
+    print(json.dumps(results))
+
+
+def serve_directory(directory):
+    handler = functools.partial(QuietHandler, directory=directory)
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+class QuietHandler(http.server.SimpleHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], check=True,
+                              capture_output=True, text=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def compare(results, baseline_path):
+    with open(baseline_path, encoding='utf-8') as baseline_file:
+        baseline = {(row['goods'], row['scenario']): row for row in json.load(baseline_file)['results']}
+    print(f"Сравнение с {baseline_path}:")
+    for row in results:
+        previous = baseline.get((row['goods'], row['scenario']))
+        if previous is None or not previous['wall_time_s']:
+            continue
+        change = (row['wall_time_s'] - previous['wall_time_s']) / previous['wall_time_s'] * 100
+        print(f"  {row['goods']:>8} {row['scenario']:<10} время {previous['wall_time_s']:.2f} -> "
+              f"{row['wall_time_s']:.2f} с ({change:+.1f}%), запросов {previous['queries']} -> {row['queries']}")
+
+
+def run(sizes, feed_format, parameter_names, parameter_values, parameters_per_item, output, baseline):
+    sample = load_sample_feed()
+    header = {'shop': 'Benchmark shop', 'categories': sample['categories']}
+    results = []
+
+    with tempfile.TemporaryDirectory() as directory:
+        server = serve_directory(directory)
+        try:
+            for goods_count in sizes:
+                name = f"feed-{goods_count}.{feed_format}"
+                goods = iter_synthetic_goods(goods_count, sample['categories'], parameter_names,
+                                             parameter_values, parameters_per_item)
+                write_feed(os.path.join(directory, name), header, goods, feed_format,
+                           parameter_names=synthetic_parameter_names(parameter_names))
+                url = f"http://127.0.0.1:{server.server_port}/{name}"
+
+                output_lines = subprocess.run(
+                    [sys.executable, '-m', 'backend.benchmarks.bench_pipeline',
+                     '--measure', str(goods_count), '--url', url],
+                    check=True, capture_output=True, text=True,
+                ).stdout.strip().splitlines()
+                for row in json.loads(output_lines[-1]):
+                    results.append(row)
+                    print(f"{row['goods']:>8} {row['scenario']:<10} {row['wall_time_s']:>8.2f} с "
+                          f"{row['rows_per_second']:>10.0f} строк/с {row['queries']:>6} запросов "
+                          f"{row['peak_memory_mb']:>8.1f} МБ")
+        finally:
+            server.shutdown()
+
+    commit = git_commit()
+    report = {
+        'meta': {
+            'commit': commit,
+            'created_at': datetime.now(timezone.utc).isoformat(),
+            'python': platform.python_version(),
+            'database': connection.vendor,
+            'format': feed_format,
+            'parameter_names': parameter_names,
+            'parameter_values': parameter_values,
+            'parameters_per_item': parameters_per_item,
+        },
+        'results': results,
+    }
+    output = Path(output or RESULTS_DIR / f"pipeline-{commit}.json")
+    output.parent.mkdir(parents=True, exist_ok=True)
+    with open(output, 'w', encoding='utf-8') as output_file:
+        json.dump(report, output_file, ensure_ascii=False, indent=2)
+    print(f"Результаты: {output}")
+
+    if baseline:
+        compare(results, baseline)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Бенчмарк полного пути импорта прайса')
+    parser.add_argument('--sizes', default=DEFAULT_SIZES,
+                        help='Размеры прайсов через запятую, например 1000,10000,100000,1000000')
+    parser.add_argument('--format', choices=FEED_FORMATS, default=FEED_FORMAT_YAML)
+    parser.add_argument('--parameter-names', type=int, default=20, help='Различных названий параметров')
+    parser.add_argument('--parameter-values', type=int, default=50, help='Различных значений у параметра')
+    parser.add_argument('--parameters-per-item', type=int, default=5)
+    parser.add_argument('--output', help='Файл результатов, по умолчанию results/pipeline-<commit>.json')
+    parser.add_argument('--compare', help='Файл результатов прошлого запуска для сравнения')
+    parser.add_argument('--measure', type=int, help=argparse.SUPPRESS)
+    parser.add_argument('--url', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.measure:
+        measure(args.measure, args.url)
+    else:
+        run([int(size) for size in args.sizes.split(',')], args.format, args.parameter_names,
+            args.parameter_values, args.parameters_per_item, args.output, args.compare)
@@ -0,0 +1,130 @@
+"""
+Бенчмарк поиска товаров: name__icontains против backend.search
+
+Заполняет каталог синтетическими товарами (по умолчанию 1M) на основе
+названий из shop1.yaml, пересчитывает search_vector и замеряет p50/p95
+времени одной страницы выдачи (COUNT + 20 строк) для набора запросов:
+точное слово, другая словоформа, опечатка и несколько слов.
+Все изменения откатываются после замера.
+
+Запуск:
+    python -m backend.benchmarks.bench_search --rows 1000000
+    PRODUCT_SEARCH_BACKEND=inverted python -m backend.benchmarks.bench_search --rows 100000
+"""
+import argparse
+import os
+import random
+import statistics
+import time
+
+import django
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'purchases.settings')
+django.setup()
+
+from django.db import connection, transaction
+
+from backend.benchmarks.feeds import load_sample_feed
+from backend.importer import iter_batches
+from backend.models import Category, Product, ProductInfo, Shop
+from backend.search import (search_products, update_search_vectors, create_search_indexes,
+                            get_inverted_index, uses_postgres_search)
+
+SEED_BATCH_SIZE = 10000
+PAGE_SIZE = 20
+QUERIES = (
+    'iphone',
+    'смартфоны',
+    'флешка',
+    'samsnug',
+    'apple iphone 512gb',
+)
+COLORS = ('черный', 'белый', 'золотистый', 'серебристый', 'синий', 'красный')
+
+
+def seed(rows, products_count):
+    sample = load_sample_feed()
+    rng = random.Random(0)
+    Category.objects.bulk_create([Category(id=category['id'], name=category['name'])
+                                  for category in sample['categories']], ignore_conflicts=True)
+    shop = Shop.objects.create(name='Benchmark shop')
+    templates = sample['goods']
+
+    products = Product.objects.bulk_create(
+        [Product(name=f"{templates[number % len(templates)]['name'][:60]} {number}",
+                 category_id=templates[number % len(templates)]['category'])
+         for number in range(products_count)],
+        batch_size=SEED_BATCH_SIZE,
+    )
+
+    def iter_product_infos():
+        for number in range(rows):
+            template = templates[number % len(templates)]
+            yield ProductInfo(
+                product=products[number % len(products)],
+                shop=shop,
+                external_id=number + 1,
+                name=f"{template['name'][:55]} {rng.choice(COLORS)} {number}"[:80],
+                model=f"{template['model']}-{number % 1000}",
+                quantity=rng.randint(0, 50),
+                price=rng.randint(100, 200000),
+            )
+
+    for batch in iter_batches(iter_product_infos(), SEED_BATCH_SIZE):
+        ProductInfo.objects.bulk_create(batch)
+
+
+def page(queryset):
+    """
+    Одна страница выдачи так, как ее строит ProductPageNumberPagination
+    """
+    queryset.count()
+    return list(queryset[:PAGE_SIZE])
+
+
+def measure(name, build_queryset, repeats):
+    for text in QUERIES:
+        timings = []
+        for _ in range(repeats):
+            start_time = time.perf_counter()
+            found = page(build_queryset(text))
+            timings.append((time.perf_counter() - start_time) * 1000)
+        p95 = statistics.quantiles(timings, n=20)[-1] if len(timings) > 1 else timings[0]
+        print(f"  {name:<10} {text:<22} p50 {statistics.median(timings):>9.1f} мс "
+              f"p95 {p95:>9.1f} мс  на странице {len(found)}")
+
+
+def run(rows, products_count, repeats):
+    # Индексы создаются до заполнения: в той же транзакции после вставки Postgres
+    # не дает выполнить CREATE INDEX из-за отложенных проверок внешних ключей
+    create_search_indexes(using=connection.alias)
+    with transaction.atomic():
+        start_time = time.perf_counter()
+        seed(rows, products_count)
+        print(f"Товаров: {rows}, заполнение: {time.perf_counter() - start_time:.1f} с")
+
+        start_time = time.perf_counter()
+        if uses_postgres_search():
+            update_search_vectors()
+            # Без свежей статистики планировщик выбирает вложенный цикл по продуктам
+            with connection.cursor() as cursor:
+                for model in (Product, ProductInfo):
+                    cursor.execute(f'ANALYZE {model._meta.db_table}')
+            print(f"search_vector: {time.perf_counter() - start_time:.1f} с")
+        else:
+            get_inverted_index()
+            print(f"Инвертированный индекс: {time.perf_counter() - start_time:.1f} с")
+
+        queryset = ProductInfo.objects.select_related('product')
+        measure('icontains', lambda text: queryset.filter(name__icontains=text).order_by('id'), repeats)
+        measure('search', lambda text: search_products(queryset, text), repeats)
+        transaction.set_rollback(True)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Бенчмарк поиска товаров')
+    parser.add_argument('--rows', type=int, default=1000000)
+    parser.add_argument('--products', type=int, default=10000, help='Различных продуктов')
+    parser.add_argument('--repeats', type=int, default=20)
+    args = parser.parse_args()
+    run(args.rows, args.products, args.repeats)
@@ -0,0 +1,113 @@
+"""
+Бенчмарк сериализации страницы списка товаров
+
+Сравнивает время подготовки JSON одной страницы (по умолчанию 100 товаров):
+    before - словарь на каждый ProductInfo (select_related + prefetch параметров,
+             как ProductListView до CatalogEntry) и JSONRenderer DRF
+    ujson  - CatalogEntry.as_dict() каждой строки каталога и ujson, как ProductListView
+
+Выборка из БД в замер не входит. Все изменения откатываются после замера.
+
+Запуск:
+    python -m backend.benchmarks.bench_serialize --page-size 100 --repeats 200
+"""
+import argparse
+import json
+import os
+import statistics
+import time
+
+import django
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'purchases.settings')
+django.setup()
+
+import ujson
+from django.db import transaction
+from rest_framework.renderers import JSONRenderer
+
+from backend.benchmarks.feeds import load_sample_feed, iter_synthetic_goods
+from backend.importer import PriceListImporter
+from backend.models import CatalogEntry, ProductInfo, User
+
+
+def product_dict(product_info):
+    """
+    Словарь товара так, как его строил ProductListView до CatalogEntry
+    """
+    return {
+        'id': product_info.id,
+        'external_id': product_info.external_id,
+        'product_id': product_info.product.id if product_info.product else None,
+        'name': product_info.name,
+        'model': product_info.model,
+        'price': product_info.price,
+        'price_rrc': product_info.price_rrc,
+        'quantity': product_info.quantity,
+        'shop': {'id': product_info.shop.id, 'name': product_info.shop.name},
+        'category': {
+            'id': product_info.product.category.id if product_info.product and product_info.product.category else None,
+            'name': product_info.product.category.name if product_info.product and product_info.product.category else None,
+        },
+        'parameters': [
+            {'id': param.parameter.id, 'name': param.parameter.name, 'value': param.value}
+            for param in product_info.product_parameters.all()
+        ],
+    }
+
+
+def envelope(products, count):
+    return {'count': count, 'next': None, 'previous': None,
+            'results': {'Status': True, 'Products': products, 'ExecutionTimeMs': 0.0}}
+
+
+def serialize_before(product_infos):
+    return JSONRenderer().render(envelope([product_dict(product_info) for product_info in product_infos], len(product_infos)))
+
+
+def serialize_after(entries):
+    return ujson.dumps(envelope([entry.as_dict() for entry in entries], len(entries)),
+                       ensure_ascii=False, escape_forward_slashes=False)
+
+
+def measure(name, function, argument, repeats):
+    timings = []
+    for _ in range(repeats):
+        start_time = time.perf_counter()
+        function(argument)
+        timings.append((time.perf_counter() - start_time) * 1000)
+    p95 = statistics.quantiles(timings, n=20)[-1]
+    print(f"  {name:<8} p50 {statistics.median(timings):>8.3f} мс  p95 {p95:>8.3f} мс")
+    return statistics.median(timings)
+
+
+def run(page_size, repeats, parameters_per_item):
+    sample = load_sample_feed()
+    goods = list(iter_synthetic_goods(page_size, sample['categories'], parameters_per_item=parameters_per_item))
+    with transaction.atomic():
+        user = User.objects.create_user(email='bench-serialize@example.com', password=None,
+                                        username='bench', type='shop', is_active=True)
+        PriceListImporter(user.id).run({'shop': 'Benchmark shop', 'categories': sample['categories'],
+                                        'goods': goods})
+
+        product_infos = list(ProductInfo.objects.select_related('product', 'shop', 'product__category')
+                             .prefetch_related('product_parameters__parameter').order_by('id'))
+        entries = list(CatalogEntry.objects.order_by('id'))
+
+        print(f"Страница: {page_size} товаров, параметров у товара: {parameters_per_item}, повторов: {repeats}")
+        before = measure('before', serialize_before, product_infos, repeats)
+        after = measure('ujson', serialize_after, entries, repeats)
+        print(f"Ускорение ujson относительно before: {before / after:.1f}x")
+        if json.loads(serialize_after(entries)) != json.loads(serialize_before(product_infos)):
+            raise RuntimeError('JSON до и после не совпадает')
+
+        transaction.set_rollback(True)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Бенчмарк сериализации страницы товаров')
+    parser.add_argument('--page-size', type=int, default=100)
+    parser.add_argument('--repeats', type=int, default=200)
+    parser.add_argument('--parameters-per-item', type=int, default=5)
+    args = parser.parse_args()
+    run(args.page_size, args.repeats, args.parameters_per_item)
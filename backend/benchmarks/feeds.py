@@ -0,0 +1,95 @@
+"""
+Синтетические прайсы для бенчмарков на основе shop1.yaml
+"""
+import copy
+import csv
+import random
+from pathlib import Path
+
+import ujson
+import yaml
+
+from backend.feed_parsers import FEED_FORMAT_YAML, FEED_FORMAT_JSONL, FEED_FORMAT_CSV, CSV_PARAMETER_PREFIX
+
+SHOP_FEED = Path(__file__).resolve().parents[2] / 'shop1.yaml'
+
+
+def load_sample_feed():
+    with open(SHOP_FEED, encoding='utf-8') as feed:
+        return yaml.safe_load(feed)
+
+
+def iter_scaled_goods(template, goods_count):
+    """
+    Размножает товары шаблона до goods_count с уникальными external_id и названиями
+    """
+    for number in range(goods_count):
+        item = copy.deepcopy(template[number % len(template)])
+        item['id'] = number + 1
+        item['name'] = f"{item['name'][:60]} #{number // len(template)}"
+        yield item
+
+
+def scale_feed(data, goods_count):
+    return dict(data, goods=list(iter_scaled_goods(data['goods'], goods_count)))
+
+
+def synthetic_parameter_names(parameter_names):
+    return [f"Параметр {number}" for number in range(parameter_names)]
+
+
+def iter_synthetic_goods(goods_count, categories, parameter_names=20, parameter_values=50,
+                         parameters_per_item=5, seed=0):
+    """
+    Товары в формате shop1.yaml с заданной кардинальностью параметров:
+    parameter_names различных названий, parameter_values значений у каждого
+    """
+    rng = random.Random(seed)
+    names = synthetic_parameter_names(parameter_names)
+    per_item = min(parameters_per_item, len(names))
+    for number in range(goods_count):
+        price = rng.randint(100, 200000)
+        yield {
+            'id': number + 1,
+            'category': categories[number % len(categories)]['id'],
+            'model': f"model/{number}",
+            'name': f"Товар {number}",
+            'price': price,
+            'price_rrc': price + rng.randint(0, 5000),
+            'quantity': rng.randint(0, 50),
+            'parameters': {name: f"Значение {rng.randrange(parameter_values)}"
+                           for name in rng.sample(names, per_item)},
+        }
+
+
+def write_feed(path, data, goods, feed_format=FEED_FORMAT_YAML, parameter_names=None):
+    """
+    Записывает прайс с заголовком из data и товарами goods в файл, не держа все товары в памяти
+
+    parameter_names - колонки параметров для CSV, по умолчанию из товаров data.
+    """
+    if parameter_names is None:
+        parameter_names = sorted({name for item in data.get('goods', []) for name in item['parameters']})
+    with open(path, 'w', encoding='utf-8', newline='') as feed:
+        if feed_format == FEED_FORMAT_YAML:
+            yaml.safe_dump({'shop': data['shop'], 'categories': data['categories']},
+                           feed, allow_unicode=True, sort_keys=False)
+            feed.write('goods:\n')
+            for item in goods:
+                yaml.safe_dump([item], feed, allow_unicode=True, sort_keys=False)
+        elif feed_format == FEED_FORMAT_JSONL:
+            feed.write(ujson.dumps({'shop': data['shop'], 'categories': data['categories']},
+                                   ensure_ascii=False) + '\n')
+            for item in goods:
+                feed.write(ujson.dumps(item, ensure_ascii=False) + '\n')
+        elif feed_format == FEED_FORMAT_CSV:
+            categories = {category['id']: category['name'] for category in data['categories']}
+            writer = csv.writer(feed)
+            writer.writerow(['shop', 'id', 'category', 'category_name', 'model', 'name', 'price', 'price_rrc',
+                             'quantity', *(CSV_PARAMETER_PREFIX + name for name in parameter_names)])
+            for item in goods:
+                writer.writerow([data['shop'], item['id'], item['category'], categories.get(item['category'], ''),
+                                 item.get('model', ''), item['name'], item['price'], item.get('price_rrc', ''),
+                                 item['quantity'], *(item['parameters'].get(name, '') for name in parameter_names)])
+        else:
+            raise ValueError(f'Неизвестный формат прайса: {feed_format}')
@@ -1,10 +1,51 @@
 from django.core.cache import cache
 from django.conf import settings
+from django.db import transaction
+from django.http import HttpResponse, HttpResponseNotModified
+from django.utils.cache import patch_vary_headers
+from django.utils.http import parse_etags
+from django.views import View
+from django_redis import get_redis_connection
+from rest_framework.renderers import JSONRenderer
+from rest_framework.response import Response
+from backend.import_locks import CacheLock, LOCK_POLL_INTERVAL
+from backend.local_cache import local_cache, publish_invalidation
+from contextvars import ContextVar
 from functools import wraps
 import time
 import hashlib
 import json
-from typing import Any, Callable, Optional
+import math
+import random
+import re
+import uuid
+from typing import Any, Callable, Iterable, Optional
+
+# Множество ключей записей, зависящих от тега, хранится в Redis под cache_tag:<тег>
+TAG_KEY_PREFIX = 'cache_tag'
+# Множество тега живет не меньше самой долгой записи в нем
+TAG_TIMEOUT = settings.CACHE_TTL['VERY_LONG']
+UNLINK_BATCH_SIZE = 500
+# Теги списков, в которые попадают новые категории и магазины
+CATEGORY_LIST_TAG = 'categories'
+SHOP_LIST_TAG = 'shops'
+
+# Поколения пространств имен кеша хранятся под cache_generation:<пространство>
+GENERATION_KEY_PREFIX = 'cache_generation'
+CATALOG_NAMESPACE = 'catalog'
+NAMESPACE_RE = re.compile(r'^(catalog|shop:\d+|category:\d+)$')
+
+# Запись хранится еще STALE_GRACE секунд после мягкого истечения: пока один воркер
+# ее пересчитывает, остальные отдают устаревшее значение
+STALE_GRACE = 60 * 5
+RECOMPUTE_LOCK_TTL = 30
+# Сколько ждать чужого пересчета при полном промахе, прежде чем считать самому
+RECOMPUTE_WAIT = 2
+# Чем больше, тем раньше до истечения начинается досрочный пересчет (XFetch)
+EARLY_REFRESH_BETA = 1.0
+
+# Теги, собранные при вычислении текущей записи кеша (см. add_cache_tags)
+_collected_tags = ContextVar('collected_cache_tags', default=None)
 
 
 class CacheMetrics:
@@ -12,32 +53,69 @@ class CacheMetrics:
 
     def __init__(self):
         self.hits = 0
+        self.l1_hits = 0
+        self.l2_hits = 0
         self.misses = 0
         self.total_time_with_cache = 0
         self.total_time_without_cache = 0
+        self.coalesced = 0
+        self.stale_served = 0
+        self.recomputed = 0
+        self.early_refreshes = 0
 
-    def add_hit(self, time_saved: float):
+    def add_hit(self, time_saved: float, level: int = 2):
+        """level - уровень, из которого отдана запись: 1 - память процесса, 2 - Redis"""
         self.hits += 1
+        if level == 1:
+            self.l1_hits += 1
+        else:
+            self.l2_hits += 1
         self.total_time_with_cache += time_saved
 
     def add_miss(self, time_penalty: float):
         self.misses += 1
         self.total_time_without_cache += time_penalty
 
+    def add_coalesced(self):
+        """Запрос дождался пересчета другим воркером вместо своего"""
+        self.coalesced += 1
+
+    def add_stale(self):
+        """Отдано устаревшее значение, пока запись пересчитывает другой воркер"""
+        self.stale_served += 1
+
+    def add_recomputed(self, early: bool = False):
+        """Запись пересчитана под блокировкой (early - досрочно, до истечения)"""
+        self.recomputed += 1
+        if early:
+            self.early_refreshes += 1
+
     def get_stats(self) -> dict:
         total_requests = self.hits + self.misses
         hit_rate = (self.hits / total_requests * 100) if total_requests > 0 else 0
         avg_time_with_cache = (self.total_time_with_cache / self.hits) if self.hits > 0 else 0
         avg_time_without_cache = (self.total_time_without_cache / self.misses) if self.misses > 0 else 0
+        # До Redis доходят только запросы, не найденные в L1
+        l2_requests = total_requests - self.l1_hits
+        l1_hit_rate = (self.l1_hits / total_requests * 100) if total_requests > 0 else 0
+        l2_hit_rate = (self.l2_hits / l2_requests * 100) if l2_requests > 0 else 0
 
         return {
             'total_requests': total_requests,
             'hits': self.hits,
             'misses': self.misses,
             'hit_rate_percent': round(hit_rate, 2),
+            'l1_hits': self.l1_hits,
+            'l2_hits': self.l2_hits,
+            'l1_hit_rate_percent': round(l1_hit_rate, 2),
+            'l2_hit_rate_percent': round(l2_hit_rate, 2),
             'avg_time_with_cache_ms': round(avg_time_with_cache * 1000, 2),
             'avg_time_without_cache_ms': round(avg_time_without_cache * 1000, 2),
             'total_time_saved_seconds': round(self.total_time_with_cache, 3),
+            'coalesced': self.coalesced,
+            'stale_served': self.stale_served,
+            'recomputed': self.recomputed,
+            'early_refreshes': self.early_refreshes,
         }
 
 
@@ -45,12 +123,82 @@ class CacheMetrics:
 cache_metrics = CacheMetrics()
 
 
-def generate_cache_key(prefix: str, *args, **kwargs) -> str:
+def local_key(key: str) -> str:
+    """
+    Ключ L1 - полный ключ Redis, как в множествах тегов и сообщениях об инвалидации
+    """
+    return str(cache.make_key(key))
+
+
+def shop_namespace(shop_id) -> str:
+    return f"shop:{shop_id}"
+
+
+def category_namespace(category_id) -> str:
+    return f"category:{category_id}"
+
+
+def generation_key(namespace: str) -> str:
+    return f"{GENERATION_KEY_PREFIX}:{namespace}"
+
+
+def get_generations(namespaces: Iterable[str]) -> dict:
+    """
+    Текущие поколения пространств имен одним get_many
+
+    Отсутствующее поколение начинается со времени в наносекундах, а не с нуля:
+    после вытеснения счетчика старые записи не должны снова стать актуальными.
+    """
+    result = {}
+    missing = {}
+    for namespace in set(namespaces):
+        generation = local_cache.get(local_key(generation_key(namespace)))
+        if generation is None:
+            missing[generation_key(namespace)] = namespace
+        else:
+            result[namespace] = generation
+    if not missing:
+        return result
+
+    generations = cache.get_many(missing)
+    for key in missing.keys() - generations.keys():
+        cache.add(key, time.time_ns(), None)
+        generations[key] = cache.get(key)
+    for key, generation in generations.items():
+        local_cache.set(local_key(key), generation)
+        result[missing[key]] = generation
+    return result
+
+
+def bump_generation(*namespaces: str) -> dict:
+    """
+    Инвалидирует все записи пространств имен одним INCR на пространство
+
+    Устаревшие записи не удаляются, а вытесняются по TTL.
+    """
+    generations = {}
+    for namespace in set(namespaces):
+        key = generation_key(namespace)
+        if not cache.add(key, time.time_ns(), None):
+            cache.incr(key)
+        generations[namespace] = cache.get(key)
+    publish_invalidation(local_key(generation_key(namespace)) for namespace in generations)
+    return generations
+
+
+def generate_cache_key(prefix: str, *args, namespaces: Iterable[str] = None, **kwargs) -> str:
     """
     Генерация уникального ключа кеша на основе аргументов
+
+    Поколения пространств имен namespaces входят в ключ: после bump_generation
+    ключ меняется, и старая запись больше не читается.
     """
     key_parts = [prefix]
 
+    if namespaces:
+        key_parts.extend(f"{namespace}@{generation}"
+                         for namespace, generation in sorted(get_generations(namespaces).items()))
+
     # Добавляем аргументы
     for arg in args:
         key_parts.append(str(arg))
@@ -68,14 +216,278 @@ def generate_cache_key(prefix: str, *args, **kwargs) -> str:
     return key_string
 
 
-def cached_view(timeout: int = None, key_prefix: str = None):
+def shop_tag(shop_id) -> str:
+    return f"shop:{shop_id}"
+
+
+def category_tag(category_id) -> str:
+    return f"category:{category_id}"
+
+
+def product_tag(product_info_id) -> str:
+    return f"product:{product_info_id}"
+
+
+def product_list_tag(shop_id=None, category_id=None) -> str:
+    """
+    Тег состава списка товаров с фильтром по магазину и категории (None - без фильтра)
+    """
+    shop = int(shop_id) if shop_id else 'all'
+    category = int(category_id) if category_id else 'all'
+    return f"products:{shop}:{category}"
+
+
+def product_scope_tags(shop_id, category_id) -> list:
+    """
+    Теги всех списков товаров, в которые может попасть товар магазина shop_id из категории category_id
+    """
+    return [product_list_tag(shop, category)
+            for shop in (shop_id, None) for category in (category_id, None)]
+
+
+def add_cache_tags(*tags):
+    """
+    Регистрирует зависимости записи кеша, которая сейчас вычисляется в cached_view или cached_function
+    """
+    collected = _collected_tags.get()
+    if collected is not None:
+        collected.update(tag for tag in tags if tag)
+
+
+def collect_cache_tags(func: Callable, *args, **kwargs):
+    """
+    Выполняет func и возвращает (результат, теги, добавленные во время выполнения)
+
+    Теги вложенной записи становятся и зависимостями внешней.
+    """
+    token = _collected_tags.set(set())
+    try:
+        result = func(*args, **kwargs)
+        tags = _collected_tags.get()
+    finally:
+        _collected_tags.reset(token)
+    add_cache_tags(*tags)
+    return result, tags
+
+
+def tag_key(tag: str) -> str:
+    return cache.make_key(f"{TAG_KEY_PREFIX}:{tag}")
+
+
+def register_cache_tags(cache_key: str, tags: Iterable[str], timeout: int):
+    """
+    Добавляет ключ записи в множества ее тегов
+    """
+    tags = set(tags)
+    if not tags:
+        return
+    raw_key = cache.make_key(cache_key)
+    with get_redis_connection('default').pipeline(transaction=False) as pipe:
+        for tag in tags:
+            pipe.sadd(tag_key(tag), raw_key)
+            pipe.expire(tag_key(tag), max(timeout, TAG_TIMEOUT))
+        pipe.execute()
+
+
+def invalidate_tags(*tags: str) -> int:
+    """
+    Удаляет записи кеша, зарегистрированные под тегами, и сами множества тегов
+
+    Множества читаются и удаляются в одной транзакции, ключи удаляются UNLINK
+    пакетами по UNLINK_BATCH_SIZE - без сканирования пространства ключей.
+    """
+    tag_keys = [tag_key(tag) for tag in set(tags)]
+    if not tag_keys:
+        return 0
+    client = get_redis_connection('default')
+    with client.pipeline(transaction=True) as pipe:
+        for key in tag_keys:
+            pipe.smembers(key)
+        pipe.unlink(*tag_keys)
+        members = pipe.execute()[:-1]
+
+    keys = list(set().union(*members))
+    if not keys:
+        return 0
+    with client.pipeline(transaction=False) as pipe:
+        for start in range(0, len(keys), UNLINK_BATCH_SIZE):
+            pipe.unlink(*keys[start:start + UNLINK_BATCH_SIZE])
+        deleted = sum(pipe.execute())
+    publish_invalidation(key.decode() for key in keys)
+    return deleted
+
+
+def invalidate_tags_on_commit(*tags: str):
+    """
+    Инвалидация после фиксации транзакции, чтобы кеш не заполнился старыми данными до коммита
+    """
+    transaction.on_commit(lambda: invalidate_tags(*tags))
+
+
+def recompute_lock(cache_key: str) -> CacheLock:
+    return CacheLock(f"{cache_key}:lock", uuid.uuid4().hex, RECOMPUTE_LOCK_TTL)
+
+
+def needs_refresh(entry: dict, now: float) -> bool:
+    """
+    Запись истекла или выбрана для досрочного пересчета (XFetch)
+
+    Вероятность досрочного пересчета растет к сроку истечения и с длительностью
+    прошлого пересчета delta.
+    """
+    return now - entry['delta'] * EARLY_REFRESH_BETA * math.log(1.0 - random.random()) >= entry['expires']
+
+
+def wait_for_entry(cache_key: str, lock: CacheLock) -> Optional[dict]:
+    """
+    Ждет, пока запись пересчитает владелец блокировки, не дольше RECOMPUTE_WAIT секунд
+    """
+    deadline = time.monotonic() + RECOMPUTE_WAIT
+    while time.monotonic() < deadline:
+        time.sleep(LOCK_POLL_INTERVAL)
+        entry = cache.get(cache_key)
+        if entry is not None:
+            return entry
+        if not lock.is_locked():
+            # Владелец закончил, но результат не кешируется (ошибка или не 200)
+            return None
+    return None
+
+
+def recompute(cache_key: str, timeout: int, compute: Callable, to_cache: Callable, from_cache: Callable,
+              start_time: float, local: bool = True):
+    result, tags = collect_cache_tags(compute)
+    value = to_cache(result)
+    if value is not None:
+        now = time.time()
+        entry = {'value': value, 'expires': now + timeout, 'delta': now - start_time}
+        cache.set(cache_key, entry, timeout + STALE_GRACE)
+        register_cache_tags(cache_key, tags, timeout + STALE_GRACE)
+        if local:
+            local_cache.set(local_key(cache_key), entry, timeout)
+    cache_metrics.add_miss(time.time() - start_time)
+    return result if value is None else from_cache(value)
+
+
+def cached_call(cache_key: str, timeout: int, compute: Callable,
+                to_cache: Callable = None, from_cache: Callable = None, local: bool = True) -> Any:
+    """
+    Значение записи кеша с защитой от лавины пересчетов
+
+    Запись сначала ищется в L1 (память процесса, если local), затем в Redis.
+    Истекшую запись пересчитывает один воркер под блокировкой на ключ, остальные
+    в это время отдают устаревшее значение, а при полном промахе ждут его
+    результат. to_cache превращает результат compute в значение для кеша
+    (None - не кешировать), from_cache - обратно.
+    """
+    to_cache = to_cache or (lambda result: result)
+    from_cache = from_cache or (lambda value: value)
+    start_time = time.time()
+
+    if local:
+        entry = local_cache.get(local_key(cache_key))
+        if entry is not None and start_time < entry['expires']:
+            cache_metrics.add_hit(time.time() - start_time, level=1)
+            return from_cache(entry['value'])
+
+    entry = cache.get(cache_key)
+    if entry is not None and not needs_refresh(entry, start_time):
+        if local:
+            local_cache.set(local_key(cache_key), entry, entry['expires'] - start_time)
+        cache_metrics.add_hit(time.time() - start_time)
+        return from_cache(entry['value'])
+
+    lock = recompute_lock(cache_key)
+    if not lock.acquire():
+        if entry is None:
+            entry = wait_for_entry(cache_key, lock)
+            if entry is None:
+                # Не дождались: считаем сами, не сохраняя блокировку
+                return recompute(cache_key, timeout, compute, to_cache, from_cache, start_time, local)
+            cache_metrics.add_coalesced()
+        elif start_time >= entry['expires']:
+            cache_metrics.add_stale()
+        cache_metrics.add_hit(time.time() - start_time)
+        return from_cache(entry['value'])
+
+    try:
+        if entry is None or start_time >= entry['expires']:
+            # Запись мог обновить воркер, который только что отпустил блокировку
+            current = cache.get(cache_key)
+            if current is not None and time.time() < current['expires']:
+                cache_metrics.add_coalesced()
+                cache_metrics.add_hit(time.time() - start_time)
+                return from_cache(current['value'])
+        cache_metrics.add_recomputed(early=entry is not None and start_time < entry['expires'])
+        return recompute(cache_key, timeout, compute, to_cache, from_cache, start_time, local)
+    finally:
+        lock.release()
+
+
+# Заголовки ответа, которые хранятся вместе с телом: Vary: Accept от DRF нужен и ответу из кеша.
+# Остальные (Set-Cookie и т.п.) не кешируются
+CACHED_RESPONSE_HEADERS = ('Vary', 'Allow', 'Content-Language')
+# Версия формата render_response входит в ключ: записи в прежнем формате не читаются
+CACHED_RESPONSE_FORMAT = 'r2'
+
+
+def render_response(response, view=None, request=None):
+    """
+    Успешный ответ в компактные байты: статус, Content-Type, ETag,
+    CACHED_RESPONSE_HEADERS (одной строкой JSON) и тело
+
+    Response DRF рендерится здесь же, как его отрендерил бы dispatch;
+    остальные ответы (не 200) не кешируются.
     """
-    Декоратор для кеширования результатов view функций
+    if response.status_code != 200:
+        return None
+    if isinstance(response, Response):
+        if view is not None:
+            response = view.finalize_response(request, response)
+        else:
+            response.accepted_renderer = JSONRenderer()
+            response.accepted_media_type = JSONRenderer.media_type
+            response.renderer_context = {}
+        response.render()
+    body = response.content
+    etag = f'"{hashlib.md5(body).hexdigest()}"'
+    headers = json.dumps({header: response[header] for header in CACHED_RESPONSE_HEADERS if response.has_header(header)})
+    return f"{response.status_code}\n{response['Content-Type']}\n{etag}\n{headers}\n".encode() + body
+
+
+def response_from_bytes(value: bytes) -> HttpResponse:
+    status, content_type, etag, headers, body = value.split(b'\n', 4)
+    response = HttpResponse(body, status=int(status), content_type=content_type.decode(),
+                            headers=json.loads(headers))
+    response['ETag'] = etag.decode()
+    return response
+
+
+def cached_view(timeout: int = None, key_prefix: str = None, namespaces=None, local: bool = True,
+                vary_on_user: bool = False):
+    """
+    Декоратор для кеширования результатов view функций и методов APIView
+
+    Хранится отрендеренный ответ (render_response) с ETag; запрос с совпадающим
+    If-None-Match получает 304 без тела. vary_on_user - ответ зависит от
+    пользователя: пользователь входит в ключ, ответ получает Vary по
+    Authorization и Cookie; иначе одна запись на всех.
+
+    Зависимости записи view объявляет через add_cache_tags, по ним запись
+    удаляется invalidate_tags. namespaces - пространства имен записи (список
+    или функция от запроса), их целиком инвалидирует bump_generation.
+    Пересчет истекшей записи и L1 (local) - см. cached_call.
     """
 
     def decorator(view_func):
         @wraps(view_func)
-        def _wrapped_view(request, *args, **kwargs):
+        def _wrapped_view(*args, **kwargs):
+            # Метод класса получает первым аргументом экземпляр view, а не запрос
+            if isinstance(args[0], View):
+                view, request, view_args, args = args[0], args[1], args[:2], args[2:]
+            else:
+                view, request, view_args, args = None, args[0], args[:1], args[1:]
+
             if timeout is None:
                 cache_timeout = settings.CACHE_TTL['MEDIUM']
             else:
@@ -87,37 +499,35 @@ def cached_view(timeout: int = None, key_prefix: str = None):
             else:
                 cache_key_prefix = f"view:{view_func.__module__}.{view_func.__name__}"
 
-            # Включаем параметры запроса в ключ
-            query_params = request.GET.urlencode()
-            user_id = request.user.id if request.user.is_authenticated else 'anonymous'
+            # Включаем в ключ параметры запроса, формат ответа (JSON или browsable API) и пользователя
+            key_parts = [CACHED_RESPONSE_FORMAT, request.GET.urlencode()]
+            renderer = getattr(request, 'accepted_renderer', None)
+            if renderer is not None:
+                key_parts.append(f"format={renderer.format}")
+            if vary_on_user:
+                key_parts.append(f"user={request.user.id if request.user.is_authenticated else 'anonymous'}")
 
             cache_key = generate_cache_key(
                 cache_key_prefix,
-                user_id,
-                query_params,
+                *key_parts,
                 *args,
+                namespaces=namespaces(request) if callable(namespaces) else namespaces,
                 **kwargs
             )
 
-            # Пытаемся получить данные из кеша
-            start_time = time.time()
-            cached_data = cache.get(cache_key)
-
-            if cached_data is not None:
-                # Кеш найден
-                cache_time = time.time() - start_time
-                cache_metrics.add_hit(cache_time)
-                return cached_data
-
-            # Кеш не найден, выполняем view функцию
-            response = view_func(request, *args, **kwargs)
-
-            # Сохраняем результат в кеш (только для успешных ответов)
-            if response.status_code == 200:
-                cache.set(cache_key, response, cache_timeout)
-                miss_time = time.time() - start_time
-                cache_metrics.add_miss(miss_time)
-
+            response = cached_call(cache_key, cache_timeout, lambda: view_func(*view_args, *args, **kwargs),
+                                   to_cache=lambda result: render_response(result, view, request),
+                                   from_cache=response_from_bytes, local=local)
+            if vary_on_user:
+                patch_vary_headers(response, ('Authorization', 'Cookie'))
+
+            etag = response.get('ETag')
+            if etag and etag in parse_etags(request.META.get('HTTP_IF_NONE_MATCH', '')):
+                not_modified = HttpResponseNotModified()
+                not_modified['ETag'] = etag
+                if response.has_header('Vary'):
+                    not_modified['Vary'] = response['Vary']
+                return not_modified
             return response
 
         return _wrapped_view
@@ -125,9 +535,12 @@ def cached_view(timeout: int = None, key_prefix: str = None):
     return decorator
 
 
-def cached_function(timeout: int = None, key_prefix: str = None):
+def cached_function(timeout: int = None, key_prefix: str = None, namespaces: Iterable[str] = None,
+                    local: bool = True):
     """
     Декоратор для кеширования результатов обычных функций
+
+    Зависимости, пространства имен, пересчет и L1 - как в cached_view.
     """
 
     def decorator(func):
@@ -143,50 +556,14 @@ def cached_function(timeout: int = None, key_prefix: str = None):
             else:
                 cache_key_prefix = f"func:{func.__module__}.{func.__name__}"
 
-            cache_key = generate_cache_key(cache_key_prefix, *args, **kwargs)
-
-            # Пытаемся получить данные из кеша
-            start_time = time.time()
-            cached_result = cache.get(cache_key)
-
-            if cached_result is not None:
-                cache_time = time.time() - start_time
-                cache_metrics.add_hit(cache_time)
-                return cached_result
-
-            # Выполняем функцию и сохраняем результат
-            result = func(*args, **kwargs)
-            cache.set(cache_key, result, cache_timeout)
-
-            miss_time = time.time() - start_time
-            cache_metrics.add_miss(miss_time)
-
-            return result
+            cache_key = generate_cache_key(cache_key_prefix, *args, namespaces=namespaces, **kwargs)
+            return cached_call(cache_key, cache_timeout, lambda: func(*args, **kwargs), local=local)
 
         return _wrapped_function
 
     return decorator
 
 
-def invalidate_cache_pattern(pattern: str):
-    """
-    Инвалидация кеша по паттерну
-    """
-    keys = cache.keys(pattern)
-    if keys:
-        cache.delete_many(keys)
-        return len(keys)
-    return 0
-
-
-def clear_model_cache(model_class):
-    """
-    Очистка кеша для конкретной модели
-    """
-    pattern = f"*{model_class.__name__.lower()}*"
-    return invalidate_cache_pattern(pattern)
-
-
 class CacheManager:
     """
     Менеджер для работы с кешем
@@ -215,18 +592,16 @@ class CacheManager:
         return "shops:all"
 
     @staticmethod
-    def invalidate_product_caches():
-        """Инвалидация всех кешей связанных с продуктами"""
-        patterns = [
-            "*product_list*",
-            "*user_products*",
-            "*product*",
-            "*category*",
-            "*shop*"
-        ]
-
-        total_invalidated = 0
-        for pattern in patterns:
-            total_invalidated += invalidate_cache_pattern(pattern)
-
-        return total_invalidated
\ No newline at end of file
+    def invalidate_product_caches(shop_id: int, category_ids: Iterable[int] = ()):
+        """
+        Инвалидация кешей после импорта прайса магазина
+
+        Записи пространства имен магазина сбрасываются одним INCR поколения.
+        По тегам удаляются записи вне его: страницы с товарами магазина, списки
+        без фильтра по магазину, в которые могли попасть его товары (по
+        категориям category_ids), и список категорий.
+        """
+        bump_generation(shop_namespace(shop_id))
+        tags = [shop_tag(shop_id), CATEGORY_LIST_TAG, product_list_tag()]
+        tags.extend(product_list_tag(None, category_id) for category_id in set(category_ids))
+        return invalidate_tags(*tags)
@@ -0,0 +1,410 @@
+import logging
+
+import ujson
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django_redis import get_redis_connection
+from redis.exceptions import WatchError
+
+from backend.exceptions import BaseAPIException
+from backend.models import Order, OrderItem, ProductInfo
+
+logger = logging.getLogger(__name__)
+
+CART_KEY_PREFIX = 'cart'
+# Множество id пользователей, чьи корзины в Redis изменились после последнего сохранения в БД
+CART_DIRTY_KEY = 'cart_dirty'
+# Служебное поле hash корзины: id корзины в БД после последнего сохранения ('' - не сохранялась)
+ORDER_FIELD = '_order'
+CART_FLUSH_BATCH_SIZE = 500
+# Наибольшее число строк в одном запросе пакетного добавления в корзину
+CART_BATCH_MAX_ITEMS = 100
+# Сколько раз повторяется транзакция WATCH/MULTI, если корзину изменили параллельно
+CART_MAX_RETRIES = 10
+
+
+def cart_line(item_id, product_info_id, product_name, shop, quantity, price):
+    return {'id': item_id, 'product_info_id': product_info_id, 'product_name': product_name,
+            'shop': shop, 'quantity': quantity, 'price': price}
+
+
+class DatabaseCart:
+    """
+    Корзина в Order/OrderItem со статусом basket
+    """
+
+    def __init__(self, user_id):
+        self.user_id = user_id
+
+    def _order(self):
+        return Order.objects.filter(user_id=self.user_id, state='basket').first()
+
+    def contents(self):
+        """
+        (id корзины, строки) или None, если корзины нет
+        """
+        order = self._order()
+        if order is None:
+            return None
+        items = order.ordered_items.select_related('product_info__shop').order_by('id')
+        return order.id, [cart_line(item.id, item.product_info_id, item.product_info.name,
+                                    item.product_info.shop.name, item.quantity, item.product_info.price)
+                          for item in items]
+
+    def exists(self):
+        return Order.objects.filter(user_id=self.user_id, state='basket').exists()
+
+    def quantity(self, product_info_id):
+        return OrderItem.objects.filter(order__user_id=self.user_id, order__state='basket',
+                                        product_info_id=product_info_id).values_list('quantity', flat=True).first() or 0
+
+    def find(self, item_id):
+        item = OrderItem.objects.filter(id=item_id, order__user_id=self.user_id, order__state='basket').first()
+        if item is None:
+            return None
+        return cart_line(item.id, item.product_info_id, None, None, item.quantity, None)
+
+    def add(self, product_info, quantity):
+        """
+        Добавляет товар в корзину и возвращает его количество в корзине
+        """
+        order, _ = Order.objects.get_or_create(user_id=self.user_id, state='basket', defaults={'contact': None})
+        item, created = OrderItem.objects.get_or_create(order=order, product_info=product_info,
+                                                        defaults={'quantity': quantity})
+        if not created:
+            item.quantity += quantity
+            item.save()
+        return item.quantity
+
+    def quantities(self, product_info_ids):
+        """
+        Количество товаров в корзине {product_info_id: количество} одним запросом
+        """
+        return dict(OrderItem.objects.filter(order__user_id=self.user_id, order__state='basket',
+                                             product_info_id__in=list(product_info_ids)).values_list(
+            'product_info_id', 'quantity'))
+
+    def add_many(self, lines):
+        """
+        Добавляет товары [(product_info, количество)] одним upsert в OrderItem и возвращает
+        их количество в корзине {product_info_id: количество}
+        """
+        with transaction.atomic():
+            order, _ = Order.objects.get_or_create(user_id=self.user_id, state='basket', defaults={'contact': None})
+            # Блокировка корзины: параллельное добавление не перезапишет количество
+            Order.objects.select_for_update().filter(id=order.id).first()
+            totals = dict(OrderItem.objects.filter(
+                order=order, product_info_id__in=[product_info.id for product_info, _ in lines]
+            ).values_list('product_info_id', 'quantity'))
+            for product_info, quantity in lines:
+                totals[product_info.id] = totals.get(product_info.id, 0) + quantity
+            added = {product_info.id: totals[product_info.id] for product_info, _ in lines}
+            OrderItem.objects.bulk_create(
+                [OrderItem(order=order, product_info_id=product_info_id, quantity=quantity)
+                 for product_info_id, quantity in added.items()],
+                update_conflicts=True, unique_fields=['order', 'product_info'], update_fields=['quantity'])
+        return added
+
+    def update(self, item_id, quantity):
+        # save(), а не QuerySet.update(): иначе cacheops продолжит отдавать старое количество
+        item = OrderItem.objects.filter(id=item_id, order__user_id=self.user_id, order__state='basket').first()
+        if item is not None:
+            item.quantity = quantity
+            item.save(update_fields=['quantity'])
+
+    def remove(self, item_id):
+        OrderItem.objects.filter(id=item_id, order__user_id=self.user_id, order__state='basket').delete()
+
+    def clear(self):
+        """
+        Удаляет все товары корзины и возвращает их id (ProductInfo)
+        """
+        items = OrderItem.objects.filter(order__user_id=self.user_id, order__state='basket')
+        product_info_ids = list(items.values_list('product_info_id', flat=True))
+        items.delete()
+        return product_info_ids
+
+    def persist(self):
+        """
+        Корзина в БД для оформления заказа или None
+        """
+        return self._order()
+
+    def discard(self):
+        pass
+
+
+class RedisCart:
+    """
+    Корзина в hash Redis cart:<user_id>: поле на товар со строкой в JSON и ORDER_FIELD
+
+    Изменения пишутся только в Redis и отмечаются в CART_DIRTY_KEY, в Order/OrderItem корзина
+    сохраняется при оформлении заказа (persist) и задачей flush_carts. Чтение - один запрос
+    HGETALL; пустой hash означает, что корзина еще не загружена, тогда она читается из БД.
+    Поле строки - id товара (ProductInfo), название и магазин запоминаются при добавлении.
+    Цена в hash не хранится: contents читает текущие цены одним запросом, как и DatabaseCart,
+    иначе после импорта прайса корзина показывала бы устаревшую сумму.
+    id строки, как и у DatabaseCart, - id OrderItem; у строки, еще не сохраненной в БД, -
+    id товара, после сохранения flush_cart записывает в hash id OrderItem.
+    """
+
+    def __init__(self, user_id):
+        self.user_id = user_id
+        self.key = cart_key(user_id)
+        self.client = get_redis_connection('default')
+
+    def _read(self):
+        data = self.client.hgetall(self.key)
+        if not data:
+            data = self._load()
+        return parse_cart(data)
+
+    def _load(self):
+        """
+        Заполняет hash из корзины в БД, если его не успел заполнить параллельный запрос
+        """
+        contents = DatabaseCart(self.user_id).contents()
+        order_id, lines = contents if contents else ('', [])
+        mapping = {str(line['product_info_id']): dump_line(line) for line in lines}
+        mapping[ORDER_FIELD] = order_id
+        with self.client.pipeline() as pipe:
+            try:
+                pipe.watch(self.key)
+                if pipe.exists(self.key):
+                    pipe.unwatch()
+                    return self.client.hgetall(self.key)
+                pipe.multi()
+                pipe.hset(self.key, mapping=mapping)
+                pipe.expire(self.key, settings.CART_REDIS_TIMEOUT)
+                pipe.execute()
+            except WatchError:
+                return self.client.hgetall(self.key)
+        return {key.encode(): str(value).encode() for key, value in mapping.items()}
+
+    def _write(self, lines=(), removed=()):
+        with self.client.pipeline(transaction=True) as pipe:
+            self._queue_write(pipe, lines, removed)
+            pipe.execute()
+
+    def _queue_write(self, pipe, lines=(), removed=()):
+        if lines:
+            pipe.hset(self.key, mapping={str(line['product_info_id']): dump_line(line) for line in lines})
+        if removed:
+            pipe.hdel(self.key, *[str(product_info_id) for product_info_id in removed])
+        pipe.expire(self.key, settings.CART_REDIS_TIMEOUT)
+        pipe.sadd(cache.make_key(CART_DIRTY_KEY), self.user_id)
+
+    def _change(self, change):
+        """
+        Читает строки корзины и записывает change(строки) -> (измененные строки, результат)
+        в транзакции WATCH/MULTI по ключу корзины: параллельные добавления не теряют друг друга
+        """
+        with self.client.pipeline() as pipe:
+            for _ in range(CART_MAX_RETRIES):
+                try:
+                    pipe.watch(self.key)
+                    data = pipe.hgetall(self.key)
+                    if not data:
+                        pipe.unwatch()
+                        self._load()
+                        continue
+                    lines, result = change(parse_cart(data)[1])
+                    pipe.multi()
+                    self._queue_write(pipe, lines)
+                    pipe.execute()
+                    return result
+                except WatchError:
+                    continue
+        raise BaseAPIException('Не удалось изменить корзину, повторите попытку', code='cart_conflict')
+
+    def contents(self):
+        order_id, lines = self._read()
+        if not lines and order_id is None:
+            return None
+        prices = dict(ProductInfo.objects.filter(id__in=list(lines)).values_list('id', 'price'))
+        # Строки удаленных товаров не показываются, flush_cart удалит их и из БД
+        return order_id, sorted((dict(line, price=prices[product_info_id])
+                                 for product_info_id, line in lines.items() if product_info_id in prices),
+                                key=lambda line: line['id'])
+
+    def exists(self):
+        return self.contents() is not None
+
+    def quantity(self, product_info_id):
+        line = self._read()[1].get(product_info_id)
+        return line['quantity'] if line else 0
+
+    def find(self, item_id):
+        """
+        Строка по id: id строки в hash, затем id OrderItem корзины в БД (hash мог еще
+        не получить его от flush_cart), затем id товара у строки, полученной до сохранения
+        """
+        try:
+            item_id = int(item_id)
+        except (TypeError, ValueError):
+            return None
+        lines = self._read()[1]
+        line = next((line for line in lines.values() if line['id'] == item_id), None)
+        if line is None:
+            product_info_id = OrderItem.objects.filter(
+                id=item_id, order__user_id=self.user_id, order__state='basket'
+            ).values_list('product_info_id', flat=True).first()
+            line = lines.get(product_info_id if product_info_id is not None else item_id)
+        return line
+
+    def add(self, product_info, quantity):
+        return self.add_many([(product_info, quantity)])[product_info.id]
+
+    def quantities(self, product_info_ids):
+        lines = self._read()[1]
+        return {product_info_id: lines[product_info_id]['quantity']
+                for product_info_id in product_info_ids if product_info_id in lines}
+
+    def add_many(self, lines):
+        def change(current):
+            added = {}
+            for product_info, quantity in lines:
+                line = current.get(product_info.id)
+                total = added[product_info.id] = (line['quantity'] if line else 0) + quantity
+                current[product_info.id] = cart_line(line['id'] if line else product_info.id, product_info.id,
+                                                     product_info.name, product_info.shop.name, total, None)
+            return [current[product_info_id] for product_info_id in added], added
+
+        return self._change(change)
+
+    def update(self, item_id, quantity):
+        line = self.find(item_id)
+        if line:
+            self._write([dict(line, quantity=quantity)])
+
+    def remove(self, item_id):
+        line = self.find(item_id)
+        if line:
+            self._write(removed=[line['product_info_id']])
+
+    def clear(self):
+        product_info_ids = list(self._read()[1])
+        if product_info_ids:
+            self._write(removed=product_info_ids)
+        return product_info_ids
+
+    def persist(self):
+        self.client.srem(cache.make_key(CART_DIRTY_KEY), self.user_id)
+        self._read()
+        return flush_cart(self.user_id)
+
+    def discard(self):
+        """
+        Корзина оформлена в заказ: следующая корзина пользователя начнется с пустого hash
+        """
+        self.client.delete(self.key)
+
+
+def cart_key(user_id):
+    return cache.make_key(f'{CART_KEY_PREFIX}:{user_id}')
+
+
+def dump_line(line):
+    return ujson.dumps({'id': line['id'], 'quantity': line['quantity'], 'product_name': line['product_name'],
+                        'shop': line['shop']}, ensure_ascii=False)
+
+
+def parse_cart(data):
+    """
+    (id корзины в БД или None, {product_info_id: строка}) из полей hash корзины
+    """
+    order_id = None
+    lines = {}
+    for field, value in data.items():
+        field = field.decode()
+        if field == ORDER_FIELD:
+            order_id = int(value) if value else None
+            continue
+        product_info_id = int(field)
+        lines[product_info_id] = dict({'id': product_info_id}, **ujson.loads(value), product_info_id=product_info_id)
+    return order_id, lines
+
+
+def get_cart(user_id):
+    """
+    Корзина пользователя в хранилище из настройки CART_BACKEND (db или redis)
+    """
+    if settings.CART_BACKEND == 'redis':
+        return RedisCart(user_id)
+    return DatabaseCart(user_id)
+
+
+def flush_cart(user_id):
+    """
+    Сохраняет корзину из Redis в Order/OrderItem и возвращает корзину в БД или None
+
+    Строки пишутся одним bulk upsert по (order, product_info), лишние удаляются, id строк
+    OrderItem записываются обратно в hash. Пустая корзина не создает строку Order.
+    """
+    key = cart_key(user_id)
+    client = get_redis_connection('default')
+    data = client.hgetall(key)
+    if not data:
+        # Корзина не загружалась или уже оформлена в заказ
+        return None
+    order_id, lines = parse_cart(data)
+    existing = set(ProductInfo.objects.filter(id__in=list(lines)).values_list('id', flat=True))
+    with transaction.atomic():
+        order = Order.objects.filter(user_id=user_id, state='basket').first()
+        if order is None and existing:
+            order = Order.objects.create(user_id=user_id, state='basket', contact=None)
+        if order is None:
+            return None
+        OrderItem.objects.filter(order=order).exclude(product_info_id__in=existing).delete()
+        OrderItem.objects.bulk_create(
+            [OrderItem(order=order, product_info_id=product_info_id, quantity=lines[product_info_id]['quantity'])
+             for product_info_id in existing],
+            update_conflicts=True, unique_fields=['order', 'product_info'], update_fields=['quantity'])
+        item_ids = dict(OrderItem.objects.filter(order=order).values_list('product_info_id', 'id'))
+    if order.id != order_id or any(lines[product_info_id]['id'] != item_id
+                                   for product_info_id, item_id in item_ids.items()):
+        with client.pipeline() as pipe:
+            try:
+                # Не пересоздаем hash, если корзину успели оформить в заказ; строки перечитываются под WATCH
+                pipe.watch(key)
+                data = pipe.hgetall(key)
+                if data:
+                    current = parse_cart(data)[1]
+                    mapping = {str(product_info_id): dump_line(dict(current[product_info_id], id=item_id))
+                               for product_info_id, item_id in item_ids.items()
+                               if product_info_id in current and current[product_info_id]['id'] != item_id}
+                    mapping[ORDER_FIELD] = order.id
+                    pipe.multi()
+                    pipe.hset(key, mapping=mapping)
+                    pipe.execute()
+            except WatchError:
+                pass
+    return order
+
+
+def flush_dirty_carts(batch_size=CART_FLUSH_BATCH_SIZE):
+    """
+    Сохраняет в БД корзины, измененные в Redis, пакетами по batch_size
+    """
+    client = get_redis_connection('default')
+    dirty_key = cache.make_key(CART_DIRTY_KEY)
+    flushed = 0
+    failed = []
+    while True:
+        user_ids = client.spop(dirty_key, batch_size)
+        if not user_ids:
+            break
+        for user_id in user_ids:
+            try:
+                flush_cart(int(user_id))
+                flushed += 1
+            except Exception:
+                logger.warning('Не удалось сохранить корзину пользователя %s', user_id, exc_info=True)
+                failed.append(user_id)
+        if len(user_ids) < batch_size:
+            break
+    if failed:
+        # Повторим при следующем запуске
+        client.sadd(dirty_key, *failed)
+    return flushed
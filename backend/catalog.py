@@ -0,0 +1,111 @@
+from collections import defaultdict
+
+from cacheops import invalidate_obj
+
+from backend.cache_utils import invalidate_tags_on_commit, product_scope_tags, product_tag
+from backend.facets import schedule_facet_refresh
+from backend.models import CatalogEntry, ProductInfo, ProductParameter
+
+CATALOG_BATCH_SIZE = 1000
+# Поля CatalogEntry, перезаписываемые при обновлении строки
+CATALOG_UPDATE_FIELDS = [
+    'external_id', 'product_id', 'name', 'model', 'price', 'price_rrc', 'quantity',
+    'shop_id', 'shop_name', 'category_id', 'category_name', 'parameters',
+]
+
+
+def build_entries(product_info_ids):
+    """
+    Строки каталога для пакета ProductInfo: два запроса независимо от размера пакета
+    """
+    parameters = defaultdict(list)
+    rows = ProductParameter.objects.filter(product_info_id__in=product_info_ids).order_by('id').values_list(
+        'product_info_id', 'parameter_id', 'parameter__name', 'value')
+    for product_info_id, parameter_id, parameter_name, value in rows:
+        parameters[product_info_id].append({'id': parameter_id, 'name': parameter_name, 'value': value})
+
+    product_infos = ProductInfo.objects.filter(id__in=product_info_ids).values_list(
+        'id', 'external_id', 'product_id', 'name', 'model', 'price', 'price_rrc', 'quantity',
+        'shop_id', 'shop__name', 'product__category_id', 'product__category__name')
+    return [
+        CatalogEntry(id=product_info_id, external_id=external_id, product_id=product_id, name=name,
+                     model=model, price=price, price_rrc=price_rrc, quantity=quantity,
+                     shop_id=shop_id, shop_name=shop_name, category_id=category_id,
+                     category_name=category_name, parameters=parameters[product_info_id])
+        for (product_info_id, external_id, product_id, name, model, price, price_rrc, quantity,
+             shop_id, shop_name, category_id, category_name) in product_infos
+    ]
+
+
+def refresh_catalog_entries(product_info_ids, batch_size=CATALOG_BATCH_SIZE):
+    """
+    Перестраивает строки каталога для указанных ProductInfo, удаляет строки удаленных
+    """
+    product_info_ids = list(product_info_ids)
+    refreshed = 0
+    for start in range(0, len(product_info_ids), batch_size):
+        ids = product_info_ids[start:start + batch_size]
+        entries = build_entries(ids)
+        CatalogEntry.objects.bulk_create(entries, batch_size=batch_size, update_conflicts=True,
+                                         unique_fields=['id'], update_fields=CATALOG_UPDATE_FIELDS)
+        missing = set(ids) - {entry.id for entry in entries}
+        if missing:
+            CatalogEntry.objects.filter(id__in=missing).delete()
+        refreshed += len(entries)
+    return refreshed
+
+
+def refresh_shop_catalog(shop_id):
+    """
+    Полная перестройка строк каталога магазина
+    """
+    CatalogEntry.objects.filter(shop_id=shop_id).exclude(
+        id__in=ProductInfo.objects.filter(shop_id=shop_id).values('id')
+    ).delete()
+    return refresh_catalog_entries(
+        ProductInfo.objects.filter(shop_id=shop_id).order_by('id').values_list('id', flat=True)
+    )
+
+
+def rename_catalog_categories(names):
+    """
+    Переносит новые названия категорий {id: название} в строки каталога
+    """
+    for category_id, name in names.items():
+        CatalogEntry.objects.filter(category_id=category_id).exclude(category_name=name).update(category_name=name)
+
+
+def stock_changed(product_info_ids):
+    """
+    Остатки изменены заказом в обход сигналов: перестраивает строки каталога, планирует
+    пересчет фасетов и после коммита одним вызовом инвалидирует кеш ответов
+
+    UPDATE остатков не проходит через сигналы cacheops, поэтому закешированные запросы
+    к измененным ProductInfo сбрасываются здесь же (внутри транзакции - после коммита).
+    """
+    product_info_ids = list(product_info_ids)
+    refresh_catalog_entries(product_info_ids)
+    tags = []
+    scopes = set()
+    for product_info in ProductInfo.objects.filter(id__in=product_info_ids).select_related('product'):
+        invalidate_obj(product_info)
+        tags.append(product_tag(product_info.id))
+        scopes.add((product_info.shop_id, product_info.product.category_id))
+    for shop_id, category_id in scopes:
+        schedule_facet_refresh(shop_id, [category_id])
+        tags.extend(product_scope_tags(shop_id, category_id))
+    invalidate_tags_on_commit(*dict.fromkeys(tags))
+
+
+def catalog_entries(query_params):
+    """
+    Строки каталога в наличии с фильтрами по магазину и категории, по возрастанию id
+    """
+    entries = CatalogEntry.objects.filter(quantity__gt=0)
+    shop_id = query_params.get('shop_id')
+    if shop_id:
+        entries = entries.filter(shop_id=shop_id)
+    category_id = query_params.get('category_id')
+    if category_id:
+        entries = entries.filter(category_id=category_id)
+    return entries.order_by('id')
@@ -12,4 +12,16 @@ app.conf.beat_schedule = {
         'task': 'backend.tasks.cleanup_orphaned_images',
         'schedule': crontab(hour=4, minute=0, day_of_week=1),  # Каждый понедельник в 4:00
     },
-}
\ No newline at end of file
+    'refresh-shop-catalogs-hourly': {
+        'task': 'backend.tasks.refresh_shop_catalogs',
+        'schedule': crontab(minute=0),  # Каждый час, запуск импортов разносится на CATALOG_REFRESH_JITTER
+    },
+    'release-expired-stock-holds-every-minute': {
+        'task': 'backend.tasks.release_expired_stock_holds',
+        'schedule': crontab(),  # Каждую минуту
+    },
+    'flush-carts-every-5-minutes': {
+        'task': 'backend.tasks.flush_carts',
+        'schedule': crontab(minute='*/5'),  # Каждые 5 минут, только корзины CART_BACKEND=redis
+    },
+}
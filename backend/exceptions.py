@@ -31,4 +31,9 @@ class ExternalAPIException(BaseAPIException):
 class DataValidationException(BaseAPIException):
     """Исключение для ошибок валидации данных"""
     default_detail = "Ошибка валидации данных"
-    default_code = "validation_error"
\ No newline at end of file
+    default_code = "validation_error"
+
+class OrderStateException(BaseAPIException):
+    """Исключение для недопустимой смены статуса заказа"""
+    default_detail = "Недопустимая смена статуса заказа"
+    default_code = "order_state_error"
@@ -0,0 +1,199 @@
+import re
+import weakref
+from collections import defaultdict
+from functools import partial
+
+from django.db import transaction
+from django.db.models import Count, Max, Q, Sum
+
+from backend.exceptions import DataValidationException
+from backend.models import FacetCount, Parameter, ProductParameter
+
+FACET_BATCH_SIZE = 1000
+
+# param_<id>=значение (можно несколько раз), param_<id>__gte=256, param_<id>__lte=512
+PARAMETER_FILTER_RE = re.compile(r'^param_(\d+)(?:__(gte|lte))?$')
+NUMBER_RE = re.compile(r'^\s*-?\d+(?:[.,]\d+)?\s*$')
+
+
+def parse_number(value):
+    """
+    Число из значения параметра ("6.5", "256") или None для "2688x1242", "красный"
+    """
+    if value is None or not NUMBER_RE.match(str(value)):
+        return None
+    return float(str(value).replace(',', '.'))
+
+
+def parse_parameter_filters(query_params):
+    """
+    Фильтры по параметрам из query string: {id параметра: {'values': [...], 'gte': x, 'lte': y}}
+    """
+    filters = defaultdict(dict)
+    for key in query_params:
+        match = PARAMETER_FILTER_RE.match(key)
+        if not match:
+            continue
+        parameter_id, lookup = int(match.group(1)), match.group(2)
+        values = [value for value in query_params.getlist(key) if value != '']
+        if not values:
+            continue
+        if lookup is None:
+            filters[parameter_id]['values'] = values
+            continue
+        number = parse_number(values[-1])
+        if number is None:
+            raise DataValidationException(f'{key} должно быть числом')
+        filters[parameter_id][lookup] = number
+    return dict(filters)
+
+
+def parameter_condition(parameter_id, spec):
+    condition = Q(parameter_id=parameter_id)
+    if 'values' in spec:
+        condition &= Q(value__in=spec['values'])
+    if 'gte' in spec:
+        condition &= Q(value_number__gte=spec['gte'])
+    if 'lte' in spec:
+        condition &= Q(value_number__lte=spec['lte'])
+    return condition
+
+
+def filter_by_parameters(queryset, filters):
+    """
+    Товары, у которых выполнены все фильтры (значения одного параметра - через ИЛИ)
+
+    Каждый фильтр - подзапрос по индексу (parameter, value) или (parameter, value_number).
+    """
+    for parameter_id, spec in filters.items():
+        matching = ProductParameter.objects.filter(parameter_condition(parameter_id, spec))
+        queryset = queryset.filter(id__in=matching.values('product_info_id'))
+    return queryset
+
+
+def schedule_facet_refresh(shop_id, category_ids=None):
+    """
+    Пересчет счетчиков фасетов задачей Celery после фиксации транзакции
+
+    Запросы одной транзакции объединяются: сохранение товара с десятком параметров
+    ставит в очередь один пересчет категории, а не по одному на каждую запись.
+    """
+    connection = transaction.get_connection()
+    # Пакет транзакции - partial(send_facet_refreshes, {id магазина: id категорий}), соединение держит
+    # на него слабую ссылку: после коммита или отката Django отпускает callback, и начинается новый пакет
+    pending = getattr(connection, 'pending_facet_refreshes', None)
+    callback = pending() if pending is not None else None
+    is_new = callback is None
+    if is_new:
+        callback = partial(send_facet_refreshes, {})
+        connection.pending_facet_refreshes = weakref.ref(callback)
+
+    refreshes = callback.args[0]
+    if category_ids is None or refreshes.get(shop_id, set()) is None:
+        refreshes[shop_id] = None
+    else:
+        refreshes.setdefault(shop_id, set()).update(category_ids)
+    if is_new:
+        transaction.on_commit(callback)
+
+
+def send_facet_refreshes(refreshes):
+    """
+    Ставит в очередь пересчеты {id магазина: id категорий или None}, накопленные за транзакцию
+    """
+    from backend.tasks import refresh_facets
+
+    for shop_id, category_ids in refreshes.items():
+        refresh_facets.delay(shop_id, list(category_ids) if category_ids is not None else None)
+
+
+def refresh_facet_counts(shop_id, category_ids=None):
+    """
+    Пересчитывает счетчики фасетов магазина (или только его категорий category_ids)
+    """
+    parameters = ProductParameter.objects.filter(product_info__shop_id=shop_id, product_info__quantity__gt=0)
+    counts = FacetCount.objects.filter(shop_id=shop_id)
+    if category_ids is not None:
+        parameters = parameters.filter(product_info__product__category_id__in=category_ids)
+        counts = counts.filter(category_id__in=category_ids)
+
+    rows = parameters.values('product_info__product__category_id', 'parameter_id', 'value').annotate(
+        count=Count('id'), number=Max('value_number'),
+    ).order_by()
+    facet_counts = [
+        FacetCount(shop_id=shop_id, category_id=row['product_info__product__category_id'],
+                   parameter_id=row['parameter_id'], value=row['value'],
+                   value_number=row['number'], count=row['count'])
+        for row in rows.iterator()
+    ]
+    with transaction.atomic():
+        counts.delete()
+        FacetCount.objects.bulk_create(facet_counts, batch_size=FACET_BATCH_SIZE)
+    return len(facet_counts)
+
+
+def precomputed_counts(shop_id=None, category_id=None):
+    counts = FacetCount.objects.all()
+    if shop_id:
+        counts = counts.filter(shop_id=shop_id)
+    if category_id:
+        counts = counts.filter(category_id=category_id)
+    return counts.values('parameter_id', 'value').annotate(
+        count=Sum('count'), number=Max('value_number'),
+    ).order_by()
+
+
+def live_counts(queryset, parameter_id=None):
+    parameters = ProductParameter.objects.filter(product_info_id__in=queryset.order_by().values('id'))
+    if parameter_id is not None:
+        parameters = parameters.filter(parameter_id=parameter_id)
+    return parameters.values('parameter_id', 'value').annotate(
+        count=Count('id'), number=Max('value_number'),
+    ).order_by()
+
+
+def get_facets(queryset, filters, shop_id=None, category_id=None, searched=False):
+    """
+    Значения параметров с числом товаров для панели фильтров
+
+    Без фильтров по параметрам и поиска счетчики берутся из FacetCount.
+    Иначе считаются только по отобранным товарам; для параметра с активным
+    фильтром - без учета его собственного фильтра, чтобы можно было выбрать
+    несколько значений.
+    """
+    if not filters and not searched:
+        rows = list(precomputed_counts(shop_id, category_id))
+    else:
+        rows = [row for row in live_counts(filter_by_parameters(queryset, filters))
+                if row['parameter_id'] not in filters]
+        for parameter_id in filters:
+            other_filters = {key: spec for key, spec in filters.items() if key != parameter_id}
+            rows.extend(live_counts(filter_by_parameters(queryset, other_filters), parameter_id))
+    return build_facets(rows)
+
+
+def build_facets(rows):
+    values = defaultdict(list)
+    for row in rows:
+        values[row['parameter_id']].append(row)
+    names = dict(Parameter.objects.filter(id__in=values.keys()).values_list('id', 'name'))
+
+    facets = []
+    for parameter_id, parameter_rows in values.items():
+        numbers = [row['number'] for row in parameter_rows]
+        numeric = all(number is not None for number in numbers)
+        if numeric:
+            parameter_rows.sort(key=lambda row: row['number'])
+        else:
+            parameter_rows.sort(key=lambda row: (-row['count'], row['value']))
+        facet = {
+            'id': parameter_id,
+            'name': names.get(parameter_id),
+            'values': [{'value': row['value'], 'count': row['count']} for row in parameter_rows],
+        }
+        if numeric:
+            facet['min'] = min(numbers)
+            facet['max'] = max(numbers)
+        facets.append(facet)
+    facets.sort(key=lambda facet: facet['name'] or '')
+    return facets
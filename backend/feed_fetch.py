@@ -0,0 +1,108 @@
+import hashlib
+import tempfile
+
+from requests import get
+
+# Таймаут загрузки прайса поставщика (соединение, чтение)
+FEED_DOWNLOAD_TIMEOUT = (10, 300)
+# Размер куска при чтении ответа
+FEED_CHUNK_SIZE = 64 * 1024
+# До этого размера прайс держится в памяти, дальше сбрасывается во временный файл
+FEED_SPOOL_MAX_SIZE = 32 * 1024 * 1024
+
+
+class FeedDownload:
+    """
+    Результат условной загрузки прайса
+
+    not_modified - сервер ответил 304, тело не загружалось.
+    file - тело прайса во временном файле, позиционированном на начало.
+    """
+
+    def __init__(self, url, not_modified=False, file=None, content_hash='',
+                 etag='', last_modified='', content_type=''):
+        self.url = url
+        self.not_modified = not_modified
+        self.file = file
+        self.content_hash = content_hash
+        self.etag = etag
+        self.last_modified = last_modified
+        self.content_type = content_type
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def conditional_headers(shop, url):
+    """
+    Заголовки If-None-Match / If-Modified-Since, если прайс уже загружался с этого url
+    """
+    if shop is None or shop.url != url:
+        return {}
+    headers = {}
+    if shop.feed_etag:
+        headers['If-None-Match'] = shop.feed_etag
+    if shop.feed_last_modified:
+        headers['If-Modified-Since'] = shop.feed_last_modified
+    return headers
+
+
+def download_feed(url, shop=None, timeout=FEED_DOWNLOAD_TIMEOUT):
+    """
+    Загружает прайс условным запросом, считая SHA-256 тела по мере чтения
+    """
+    with get(url, headers=conditional_headers(shop, url), timeout=timeout, stream=True) as response:
+        if response.status_code == 304:
+            return FeedDownload(url, not_modified=True,
+                                etag=shop.feed_etag, last_modified=shop.feed_last_modified)
+        response.raise_for_status()
+        # Распаковываем gzip/deflate на лету, хеш считается по содержимому прайса
+        response.raw.decode_content = True
+
+        digest = hashlib.sha256()
+        file = tempfile.SpooledTemporaryFile(max_size=FEED_SPOOL_MAX_SIZE)
+        try:
+            for chunk in iter(lambda: response.raw.read(FEED_CHUNK_SIZE), b''):
+                digest.update(chunk)
+                file.write(chunk)
+            file.seek(0)
+        except Exception:
+            file.close()
+            raise
+
+        return FeedDownload(
+            url,
+            file=file,
+            content_hash=digest.hexdigest(),
+            etag=response.headers.get('ETag', ''),
+            last_modified=response.headers.get('Last-Modified', ''),
+            content_type=response.headers.get('Content-Type', ''),
+        )
+
+
+def is_feed_unchanged(shop, download):
+    """
+    Прайс не изменился: 304 от сервера или тот же хеш содержимого с того же url
+    """
+    if shop is None or shop.url != download.url:
+        return False
+    return download.not_modified or (bool(shop.feed_hash) and shop.feed_hash == download.content_hash)
+
+
+def remember_feed(shop, download):
+    """
+    Сохраняет валидаторы прайса в магазине для следующих условных запросов
+    """
+    shop.url = download.url
+    shop.feed_etag = download.etag
+    shop.feed_last_modified = download.last_modified
+    if download.content_hash:
+        shop.feed_hash = download.content_hash
+    shop.save(update_fields=['url', 'feed_etag', 'feed_last_modified', 'feed_hash'])
@@ -0,0 +1,191 @@
+import csv
+import io
+from itertools import chain
+
+import yaml
+from ujson import loads as load_json
+
+from backend.exceptions import DataValidationException
+
+try:
+    # Парсер на libyaml, если PyYAML собран с ним
+    from yaml import CSafeLoader as FeedLoader
+except ImportError:
+    from yaml import SafeLoader as FeedLoader
+
+FEED_FORMAT_YAML = 'yaml'
+FEED_FORMAT_JSONL = 'jsonl'
+FEED_FORMAT_CSV = 'csv'
+FEED_FORMATS = (FEED_FORMAT_YAML, FEED_FORMAT_JSONL, FEED_FORMAT_CSV)
+
+FEED_EXTENSIONS = {
+    '.yaml': FEED_FORMAT_YAML,
+    '.yml': FEED_FORMAT_YAML,
+    '.jsonl': FEED_FORMAT_JSONL,
+    '.ndjson': FEED_FORMAT_JSONL,
+    '.csv': FEED_FORMAT_CSV,
+}
+
+# Префикс колонок с параметрами товара в CSV: parameters.Цвет
+CSV_PARAMETER_PREFIX = 'parameters.'
+CSV_INTEGER_COLUMNS = ('id', 'category', 'price', 'price_rrc', 'quantity')
+
+
+def detect_feed_format(url, content_type=''):
+    """
+    Определяет формат прайса по расширению файла или Content-Type
+    """
+    path = url.split('?', 1)[0].lower()
+    for extension, feed_format in FEED_EXTENSIONS.items():
+        if path.endswith(extension):
+            return feed_format
+    if 'csv' in content_type:
+        return FEED_FORMAT_CSV
+    if 'ndjson' in content_type or 'jsonl' in content_type:
+        return FEED_FORMAT_JSONL
+    return FEED_FORMAT_YAML
+
+
+def _construct_scalar(loader, event):
+    tag = event.tag
+    if tag is None or tag == '!':
+        tag = loader.resolve(yaml.ScalarNode, event.value, event.implicit)
+    node = yaml.ScalarNode(tag, event.value, event.start_mark, event.end_mark, style=event.style)
+    constructor = loader.yaml_constructors.get(tag)
+    # Конструкторы скаляров вызываем напрямую, минуя construct_object:
+    # он запоминает каждый узел до конца документа, и память росла бы с размером прайса
+    return constructor(loader, node) if constructor else event.value
+
+
+def _construct(loader, event):
+    """
+    Собирает Python-объект из событий парсера, начиная с event
+    """
+    if isinstance(event, yaml.ScalarEvent):
+        return _construct_scalar(loader, event)
+    if isinstance(event, yaml.SequenceStartEvent):
+        items = []
+        while not loader.check_event(yaml.SequenceEndEvent):
+            items.append(_construct(loader, loader.get_event()))
+        loader.get_event()
+        return items
+    if isinstance(event, yaml.MappingStartEvent):
+        mapping = {}
+        while not loader.check_event(yaml.MappingEndEvent):
+            key = _construct(loader, loader.get_event())
+            mapping[key] = _construct(loader, loader.get_event())
+        loader.get_event()
+        return mapping
+    raise DataValidationException(f'Неподдерживаемая конструкция YAML: {type(event).__name__}')
+
+
+def iter_yaml_feed(stream):
+    """
+    Событийный разбор YAML прайса: ('header', ключ, значение) для shop/categories
+    и ('item', товар) для каждого элемента goods по одному
+    """
+    loader = FeedLoader(stream)
+    try:
+        for event_class in (yaml.StreamStartEvent, yaml.DocumentStartEvent, yaml.MappingStartEvent):
+            if not loader.check_event(event_class):
+                raise DataValidationException('Прайс должен быть YAML-словарем с ключами shop, categories, goods')
+            loader.get_event()
+
+        while not loader.check_event(yaml.MappingEndEvent):
+            key = _construct(loader, loader.get_event())
+            if key == 'goods' and loader.check_event(yaml.SequenceStartEvent):
+                loader.get_event()
+                while not loader.check_event(yaml.SequenceEndEvent):
+                    yield 'item', _construct(loader, loader.get_event())
+                loader.get_event()
+            else:
+                yield 'header', key, _construct(loader, loader.get_event())
+    finally:
+        loader.dispose()
+
+
+def iter_jsonl_feed(stream):
+    """
+    Разбор JSON Lines: строка с ключом shop - заголовок, остальные строки - товары
+    """
+    text = io.TextIOWrapper(stream, encoding='utf-8')
+    try:
+        for line in text:
+            line = line.strip()
+            if not line:
+                continue
+            record = load_json(line)
+            if 'shop' in record:
+                for key, value in record.items():
+                    yield 'header', key, value
+            else:
+                yield 'item', record
+    finally:
+        # Обертка при сборке закрыла бы и сам файл, а его еще читают split_feed и шарды
+        text.detach()
+
+
+def iter_csv_feed(stream):
+    """
+    Разбор CSV: одна строка - один товар, колонки как в goods shop1.yaml,
+    плюс shop, category_name и parameters.<название> для параметров
+    """
+    shop = None
+    text = io.TextIOWrapper(stream, encoding='utf-8', newline='')
+    try:
+        for row in csv.DictReader(text):
+            if shop is None and row.get('shop'):
+                shop = row['shop']
+                yield 'header', 'shop', shop
+
+            item = {'parameters': {}}
+            for column, value in row.items():
+                if column is None or value in (None, '') or column == 'shop':
+                    continue
+                if column.startswith(CSV_PARAMETER_PREFIX):
+                    item['parameters'][column[len(CSV_PARAMETER_PREFIX):]] = value
+                elif column in CSV_INTEGER_COLUMNS:
+                    try:
+                        item[column] = int(value)
+                    except ValueError:
+                        item[column] = value
+                else:
+                    item[column] = value
+            yield 'item', item
+    finally:
+        text.detach()
+
+
+FEED_PARSERS = {
+    FEED_FORMAT_YAML: iter_yaml_feed,
+    FEED_FORMAT_JSONL: iter_jsonl_feed,
+    FEED_FORMAT_CSV: iter_csv_feed,
+}
+
+
+def read_feed(stream, feed_format=FEED_FORMAT_YAML, require_shop=True):
+    """
+    Читает заголовок прайса и возвращает словарь shop, categories, goods,
+    где goods - генератор товаров, читающий поток по мере обхода.
+
+    Ключи shop и categories должны идти до goods, как в shop1.yaml.
+    require_shop=False - прайс без shop не отклоняется (проверка прайса сообщит об этом сама).
+    """
+    if feed_format not in FEED_PARSERS:
+        raise DataValidationException(f'Неизвестный формат прайса: {feed_format}')
+
+    events = FEED_PARSERS[feed_format](stream)
+    data = {'categories': []}
+    first_item = []
+    for event in events:
+        if event[0] == 'header':
+            data[event[1]] = event[2]
+        else:
+            first_item.append(event[1])
+            break
+
+    if require_shop and not data.get('shop'):
+        raise DataValidationException('В прайсе не указан shop')
+
+    data['goods'] = chain(first_item, (event[1] for event in events if event[0] == 'item'))
+    return data
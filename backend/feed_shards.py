@@ -0,0 +1,160 @@
+import io
+import re
+
+from ujson import loads as load_json
+
+from backend.exceptions import DataValidationException
+from backend.feed_parsers import FEED_PARSERS, FEED_FORMAT_YAML, FEED_FORMAT_JSONL, FEED_FORMAT_CSV
+
+# Минимальный размер шарда: мелкие прайсы нет смысла делить
+MIN_SHARD_SIZE = 256 * 1024
+MAX_SHARDS = 32
+
+YAML_GOODS_KEY = re.compile(rb'^goods:\s*(#.*)?$')
+YAML_ITEM_START = re.compile(rb'^( *)- ')
+
+
+class RangeReader(io.RawIOBase):
+    """
+    Поток только для чтения: prefix, затем байты файла с start по end
+    """
+
+    def __init__(self, file, start, end, prefix=b''):
+        super().__init__()
+        self.file = file
+        self.position = start
+        self.end = end
+        self.prefix = prefix
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        size = len(buffer)
+        chunk = self.prefix[:size]
+        self.prefix = self.prefix[size:]
+        if len(chunk) < size and self.position < self.end:
+            self.file.seek(self.position)
+            data = self.file.read(min(size - len(chunk), self.end - self.position))
+            self.position += len(data)
+            chunk += data
+        buffer[:len(chunk)] = chunk
+        return len(chunk)
+
+
+def _iter_lines(file, start=0):
+    file.seek(start)
+    position = start
+    for line in iter(file.readline, b''):
+        yield position, line
+        position += len(line)
+
+
+def _goods_range(file, feed_format, size):
+    """
+    Границы списка товаров в файле: (prefix, start, end, шаблон начала товара)
+
+    prefix дописывается перед каждым шардом, чтобы он разбирался тем же парсером.
+    """
+    if feed_format == FEED_FORMAT_CSV:
+        file.seek(0)
+        header = file.readline()
+        return header, len(header), size, None
+
+    if feed_format != FEED_FORMAT_YAML:
+        return b'', 0, size, None
+
+    lines = _iter_lines(file)
+    for _, line in lines:
+        if YAML_GOODS_KEY.match(line):
+            break
+    else:
+        raise DataValidationException('В прайсе нет списка goods')
+
+    start = item_start = None
+    for position, line in lines:
+        if start is None:
+            match = YAML_ITEM_START.match(line)
+            if match:
+                start = position
+                item_start = re.compile(re.escape(match.group(0)))
+            elif line.strip() and not line.lstrip().startswith(b'#'):
+                raise DataValidationException('goods должен быть YAML-списком в блочном стиле')
+        elif line[:1] not in (b' ', b'-', b'#', b'\n', b'\r'):
+            # Следующий ключ верхнего уровня
+            return b'goods:\n', start, position, item_start
+    if start is None:
+        return b'goods:\n', size, size, None
+    return b'goods:\n', start, size, item_start
+
+
+def _next_boundary(file, position, end, item_start):
+    """
+    Первое начало товара не раньше position
+    """
+    file.seek(position)
+    # Дочитываем текущую строку: граница всегда на начале строки
+    position += len(file.readline())
+    for line_position, line in _iter_lines(file, position):
+        if line_position >= end:
+            break
+        if item_start is None or item_start.match(line):
+            return line_position
+    return end
+
+
+def split_feed(file, feed_format, shards):
+    """
+    Делит товары прайса на shards диапазонов байт, не разрезая товары
+
+    Возвращает (prefix, [(start, end), ...]). YAML должен хранить goods
+    блочным списком, как в shop1.yaml; CSV не должен содержать переводов
+    строк внутри значений.
+    """
+    file.seek(0, 2)
+    size = file.tell()
+    prefix, start, end, item_start = _goods_range(file, feed_format, size)
+
+    shards = max(1, min(shards, (end - start) // MIN_SHARD_SIZE))
+    step = (end - start) / shards
+    boundaries = [start]
+    for number in range(1, shards):
+        boundary = _next_boundary(file, int(start + step * number), end, item_start)
+        if boundary > boundaries[-1]:
+            boundaries.append(boundary)
+    boundaries.append(end)
+    return prefix, [(low, high) for low, high in zip(boundaries, boundaries[1:]) if high > low]
+
+
+def count_goods(file, feed_format):
+    """
+    Число товаров прайса подсчетом строк, без разбора значений (rows_total в статусе импорта)
+
+    Ограничения те же, что у split_feed; если прайс им не отвечает, возвращает None.
+    """
+    file.seek(0, 2)
+    size = file.tell()
+    try:
+        _, start, end, item_start = _goods_range(file, feed_format, size)
+    except DataValidationException:
+        return None
+
+    count = 0
+    for position, line in _iter_lines(file, start):
+        if position >= end:
+            break
+        if item_start is not None:
+            count += bool(item_start.match(line))
+        elif line.strip():
+            # Заголовок JSON Lines - строка с ключом shop, разбираем только строки, где он может быть
+            count += not (feed_format == FEED_FORMAT_JSONL and b'"shop"' in line and 'shop' in load_json(line))
+    file.seek(0)
+    return count
+
+
+def iter_shard_goods(file, feed_format, prefix, start, end):
+    """
+    Товары одного шарда, разобранные тем же потоковым парсером, что и весь прайс
+    """
+    events = FEED_PARSERS[feed_format](RangeReader(file, start, end, prefix))
+    return (event[1] for event in events if event[0] == 'item')
@@ -0,0 +1,140 @@
+from yaml import YAMLError
+
+from backend.exceptions import DataValidationException
+from backend.feed_parsers import read_feed, FEED_FORMAT_YAML
+from backend.importer import iter_batches, IMPORT_BATCH_SIZE
+from backend.models import Category
+
+# Сколько ошибок попадает в отчет, остальные только считаются
+VALIDATION_MAX_ERRORS = 200
+
+REQUIRED_ITEM_KEYS = ('id', 'category', 'name', 'price', 'quantity')
+# Поле -> минимальное допустимое значение
+INTEGER_ITEM_FIELDS = {'id': 1, 'category': 1, 'price': 1, 'price_rrc': 1, 'quantity': 0}
+
+
+def _is_integer(value):
+    return isinstance(value, int) and not isinstance(value, bool)
+
+
+class FeedValidator:
+    """
+    Проверка прайса без записи в БД
+
+    Товары проверяются пакетами по колонкам: обязательные ключи, целые
+    неотрицательные цены и остатки, дубликаты external_id и ссылки на
+    категории. Неизвестные категории сверяются с БД одним запросом в конце.
+    """
+
+    def __init__(self, batch_size=IMPORT_BATCH_SIZE, max_errors=VALIDATION_MAX_ERRORS):
+        self.batch_size = batch_size
+        self.max_errors = max_errors
+        self.errors = []
+        self.error_count = 0
+        self.rows = 0
+        self.seen = {}
+        self.categories = set()
+        # id категории -> первая строка, где она встретилась
+        self.referenced_categories = {}
+
+    def add_error(self, code, message, row=None, external_id=None, field=None):
+        self.error_count += 1
+        if len(self.errors) < self.max_errors:
+            self.errors.append({'row': row, 'id': external_id, 'field': field, 'code': code, 'message': message})
+
+    def validate(self, stream, feed_format=FEED_FORMAT_YAML):
+        """
+        Читает прайс из потока и возвращает отчет: valid, rows, error_count, errors, truncated
+
+        Ошибки чтения заголовка попадают в отчет так же, как ошибки товаров.
+        """
+        try:
+            data = read_feed(stream, feed_format, require_shop=False)
+        except (YAMLError, ValueError, DataValidationException) as e:
+            self.add_error('parse_error', str(e))
+            return self.report()
+        self.validate_header(data)
+        try:
+            for batch in iter_batches(data['goods'], self.batch_size):
+                self.validate_batch(batch)
+        except (YAMLError, ValueError, DataValidationException) as e:
+            self.add_error('parse_error', str(e), row=self.rows + 1)
+        self.validate_categories()
+        return self.report()
+
+    def validate_header(self, data):
+        if data.get('shop') in (None, ''):
+            self.add_error('required', 'Не указано поле shop', field='shop')
+        elif not isinstance(data['shop'], str) or not data['shop'].strip():
+            self.add_error('invalid', 'shop должен быть непустой строкой', field='shop')
+        categories = data.get('categories') or []
+        if not isinstance(categories, list):
+            self.add_error('invalid', 'categories должен быть списком', field='categories')
+            return
+        for category in categories:
+            if not isinstance(category, dict) or not _is_integer(category.get('id')) or not category.get('name'):
+                self.add_error('invalid', f'Некорректная категория: {category}', field='categories')
+            else:
+                self.categories.add(category['id'])
+
+    def validate_batch(self, goods):
+        first_row = self.rows + 1
+        self.rows += len(goods)
+        rows = range(first_row, first_row + len(goods))
+
+        not_mappings = {row for row, item in zip(rows, goods) if not isinstance(item, dict)}
+        for row in sorted(not_mappings):
+            self.add_error('invalid', 'Товар должен быть словарем', row=row)
+        items = [(row, item) for row, item in zip(rows, goods) if row not in not_mappings]
+
+        for key in REQUIRED_ITEM_KEYS:
+            for row, item in items:
+                if item.get(key) in (None, ''):
+                    self.add_error('required', f'Не указано поле {key}', row, item.get('id'), key)
+
+        for field, minimum in INTEGER_ITEM_FIELDS.items():
+            for row, item in items:
+                value = item.get(field)
+                if value is not None and (not _is_integer(value) or value < minimum):
+                    self.add_error('invalid', f'{field} должно быть целым числом не меньше {minimum}',
+                                   row, item.get('id'), field)
+
+        for row, item in items:
+            parameters = item.get('parameters')
+            if parameters is not None and not isinstance(parameters, dict):
+                self.add_error('invalid', 'parameters должен быть словарем', row, item.get('id'), 'parameters')
+
+        for row, item in items:
+            external_id = item.get('id')
+            if not _is_integer(external_id):
+                continue
+            if external_id in self.seen:
+                self.add_error('duplicate', f'id уже встречался в строке {self.seen[external_id]}',
+                               row, external_id, 'id')
+            else:
+                self.seen[external_id] = row
+
+        for row, item in items:
+            category_id = item.get('category')
+            if not _is_integer(category_id):
+                continue
+            if item.get('category_name'):
+                self.categories.add(category_id)
+            self.referenced_categories.setdefault(category_id, row)
+
+    def validate_categories(self):
+        unknown = self.referenced_categories.keys() - self.categories
+        if unknown:
+            unknown -= set(Category.objects.filter(id__in=unknown).values_list('id', flat=True))
+        for category_id in sorted(unknown, key=self.referenced_categories.get):
+            self.add_error('unknown_category', f'Категория {category_id} не описана в прайсе и не найдена',
+                           self.referenced_categories[category_id], field='category')
+
+    def report(self):
+        return {
+            'valid': self.error_count == 0,
+            'rows': self.rows,
+            'error_count': self.error_count,
+            'errors': self.errors,
+            'truncated': self.error_count > len(self.errors),
+        }
@@ -0,0 +1,175 @@
+import time
+import uuid
+
+from django.core.cache import cache
+from django_redis import get_redis_connection
+
+# Время хранения состояния задачи импорта в кеше
+IMPORT_JOB_TTL = 60 * 60 * 24
+
+# Фазы задачи импорта
+PHASE_QUEUED = 'queued'
+PHASE_DOWNLOADING = 'downloading'
+PHASE_PARSING = 'parsing'
+PHASE_IMPORTING = 'importing'
+PHASE_DONE = 'done'
+# Прайс не изменился с прошлой загрузки, импорт пропущен
+PHASE_UNCHANGED = 'unchanged'
+PHASE_FAILED = 'failed'
+
+
+class ImportJob:
+    """
+    Состояние фоновой задачи импорта прайса
+
+    Хранится в кеше, а не в БД: импорт идет внутри одной транзакции,
+    и прогресс, записанный в БД, не был бы виден до ее завершения.
+    """
+
+    def __init__(self, job_id, state):
+        self.id = job_id
+        self.state = state
+
+    @staticmethod
+    def cache_key(job_id):
+        return f"import_job:{job_id}"
+
+    @classmethod
+    def create(cls, user_id, url, feed_format=None, force=False, scheduled=False, shards=1,
+               dry_run=False, **options):
+        job = cls(uuid.uuid4().hex, {
+            'user_id': user_id,
+            'url': url,
+            'feed_format': feed_format,
+            'force': force,
+            'scheduled': scheduled,
+            'shards': shards,
+            'dry_run': dry_run,
+            'report': None,
+            'options': options,
+            'phase': PHASE_QUEUED,
+            'rows_processed': 0,
+            'rows_total': None,
+            'started_at': None,
+            'finished_at': None,
+            'stats': {},
+            'errors': [],
+        })
+        job.save()
+        return job
+
+    @classmethod
+    def get(cls, job_id):
+        state = cache.get(cls.cache_key(job_id))
+        if state is None:
+            return None
+        job = cls(job_id, state)
+        if state.get('shard_count'):
+            # Шарды пишут прогресс в свои ключи, чтобы не перезаписывать общее состояние
+            progress = cache.get_many([job.shard_progress_key(number) for number in range(state['shard_count'])])
+            state['rows_processed'] = sum(progress.values())
+        return job
+
+    def save(self):
+        cache.set(self.cache_key(self.id), self.state, IMPORT_JOB_TTL)
+
+    def set_phase(self, phase, **fields):
+        if self.state['started_at'] is None and phase != PHASE_QUEUED:
+            self.state['started_at'] = time.time()
+        self.state['phase'] = phase
+        self.state.update(fields)
+        self.save()
+
+    def set_progress(self, rows_processed):
+        self.state['rows_processed'] = rows_processed
+        self.save()
+
+    def shard_progress_key(self, number):
+        return f"{self.cache_key(self.id)}:shard:{number}"
+
+    def set_shard_progress(self, number, rows_processed):
+        cache.set(self.shard_progress_key(number), rows_processed, IMPORT_JOB_TTL)
+
+    def seen_key(self):
+        return cache.make_key(f"{self.cache_key(self.id)}:seen")
+
+    def claim_rows(self, external_ids):
+        """
+        Отмечает external_id встреченными при параллельном импорте одним пакетом SADD
+
+        Возвращает те, что до этого не встречались ни в одном шарде: товар
+        с повторяющимся id импортирует только шард, первым дошедший до него.
+        """
+        external_ids = list(external_ids)
+        key = self.seen_key()
+        with get_redis_connection('default').pipeline(transaction=False) as pipe:
+            for external_id in external_ids:
+                pipe.sadd(key, external_id)
+            pipe.expire(key, IMPORT_JOB_TTL)
+            added = pipe.execute()[:-1]
+        return {external_id for external_id, new in zip(external_ids, added) if new}
+
+    def seen_count(self):
+        return get_redis_connection('default').scard(self.seen_key())
+
+    def iter_seen(self, batch_size=1000):
+        """
+        Все встреченные external_id, читаются из Redis порциями через SSCAN
+        """
+        for external_id in get_redis_connection('default').sscan_iter(self.seen_key(), count=batch_size):
+            yield int(external_id)
+
+    def clear_seen(self):
+        get_redis_connection('default').delete(self.seen_key())
+
+    def finish(self, stats):
+        self.state['stats'] = stats
+        self.state['finished_at'] = time.time()
+        self.set_phase(PHASE_DONE)
+
+    def finish_validation(self, report):
+        self.state['report'] = report
+        self.state['rows_processed'] = report['rows']
+        self.state['finished_at'] = time.time()
+        if report['valid']:
+            self.set_phase(PHASE_DONE)
+        else:
+            self.state['errors'].append(f"Прайс содержит ошибок: {report['error_count']}")
+            self.set_phase(PHASE_FAILED)
+
+    def skip(self, reason):
+        self.state['stats'] = {'skipped': reason}
+        self.state['finished_at'] = time.time()
+        self.set_phase(PHASE_UNCHANGED)
+
+    def fail(self, error):
+        self.state['errors'].append(error)
+        self.state['finished_at'] = time.time()
+        self.set_phase(PHASE_FAILED)
+
+    @property
+    def is_finished(self):
+        return self.state['phase'] in (PHASE_DONE, PHASE_UNCHANGED, PHASE_FAILED)
+
+    @property
+    def user_id(self):
+        return self.state['user_id']
+
+    def rows_per_second(self):
+        started_at = self.state['started_at']
+        if not started_at:
+            return 0
+        elapsed = (self.state['finished_at'] or time.time()) - started_at
+        return round(self.state['rows_processed'] / elapsed, 2) if elapsed > 0 else 0
+
+    def to_dict(self):
+        return {
+            'job_id': self.id,
+            'phase': self.state['phase'],
+            'rows_processed': self.state['rows_processed'],
+            'rows_total': self.state['rows_total'],
+            'rows_per_second': self.rows_per_second(),
+            'stats': self.state['stats'],
+            'errors': self.state['errors'],
+            'report': self.state.get('report'),
+        }
@@ -0,0 +1,66 @@
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+
+# Время жизни блокировок импорта: идущий импорт продлевает их (CacheLock.extend),
+# а упавший воркер не держит магазин и слот дольше этого срока
+IMPORT_LOCK_TTL = 60 * 60 * 2
+LOCK_POLL_INTERVAL = 0.05
+
+
+class CacheLock:
+    """
+    Блокировка на cache.add с токеном владельца
+
+    Снимается только владельцем, по истечении TTL освобождается сама.
+    """
+
+    def __init__(self, key, token, ttl=IMPORT_LOCK_TTL):
+        self.key = key
+        self.token = token
+        self.ttl = ttl
+
+    def acquire(self, wait=0):
+        """
+        Пытается взять блокировку, ожидая ее освобождения не дольше wait секунд
+        """
+        deadline = time.monotonic() + wait
+        while not cache.add(self.key, self.token, self.ttl):
+            if time.monotonic() >= deadline:
+                return False
+            time.sleep(LOCK_POLL_INTERVAL)
+        return True
+
+    def extend(self):
+        """
+        Продлевает TTL блокировки, если она все еще у владельца
+        """
+        if cache.get(self.key) == self.token:
+            cache.touch(self.key, self.ttl)
+
+    def release(self):
+        if cache.get(self.key) == self.token:
+            cache.delete(self.key)
+
+    def is_locked(self):
+        return cache.get(self.key) is not None
+
+
+def shop_import_lock(user_id, token):
+    """
+    Блокировка импорта магазина пользователя: два импорта одного магазина не пересекаются
+    """
+    return CacheLock(f"import_lock:shop:{user_id}", token)
+
+
+def acquire_import_slot(token):
+    """
+    Занимает один из CATALOG_IMPORT_MAX_CONCURRENT слотов импорта или возвращает None
+    """
+    for number in range(settings.CATALOG_IMPORT_MAX_CONCURRENT):
+        slot = CacheLock(f"import_lock:slot:{number}", token)
+        if slot.acquire():
+            return slot
+    return None
+
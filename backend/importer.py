@@ -0,0 +1,452 @@
+from django.db import connection, transaction
+from django.db.models.expressions import RawSQL
+from cacheops import invalidate_model
+
+from backend.models import Shop, Category, Product, ProductInfo, Parameter, ProductParameter, CatalogEntry
+from backend.cache_utils import CacheManager, category_tag, invalidate_tags_on_commit
+from backend.registry import ParameterRegistry, CategoryRegistry
+from backend.search import update_search_vectors
+from backend.facets import parse_number, refresh_facet_counts
+from backend.catalog import refresh_catalog_entries, rename_catalog_categories
+
+# Размер пакета для bulk_create / bulk_update
+IMPORT_BATCH_SIZE = 1000
+
+# Режимы импорта: полная замена каталога магазина или синхронизация по external_id
+IMPORT_MODE_REPLACE = 'replace'
+IMPORT_MODE_SYNC = 'sync'
+IMPORT_MODES = (IMPORT_MODE_REPLACE, IMPORT_MODE_SYNC)
+
+# Поля ProductInfo, которые сравниваются при синхронизации
+SYNC_FIELDS = ('product_id', 'name', 'model', 'price', 'price_rrc', 'quantity')
+# Изменение этих полей требует пересчета search_vector
+SEARCH_FIELDS = {'product_id', 'name', 'model'}
+# Временная таблица external_id, встреченных в прайсе, для снятия с продажи отсутствующих
+SEEN_TABLE = 'import_seen_external_ids'
+
+
+def iter_batches(items, size):
+    """
+    Разбивает итерируемый объект на списки длиной не более size
+    """
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+class PriceListImporter:
+    """
+    Импорт прайса поставщика пакетными запросами
+
+    Категории, продукты и параметры разрешаются через словари в памяти,
+    запись идет через bulk_create пакетами внутри одной транзакции.
+    Количество запросов зависит от числа пакетов, а не от числа товаров.
+
+    В режиме sync товары сопоставляются с существующими по (shop, external_id):
+    новые создаются, у изменившихся обновляются только отличающиеся поля
+    и параметры, отсутствующие в прайсе снимаются с продажи (quantity = 0),
+    чтобы не каскадно удалять позиции заказов и корзин.
+    """
+
+    def __init__(self, user_id, batch_size=IMPORT_BATCH_SIZE, mode=IMPORT_MODE_SYNC, progress=None):
+        if mode not in IMPORT_MODES:
+            raise ValueError(f'Неизвестный режим импорта: {mode}')
+        self.user_id = user_id
+        self.batch_size = batch_size
+        self.mode = mode
+        # Вызывается после каждого пакета с числом обработанных товаров
+        self.progress = progress
+        self.rows_processed = 0
+        self.shop = None
+        # external_id -> словарь полей существующей ProductInfo (режим sync)
+        self.existing = {}
+        # id ProductInfo -> {id параметра: (id ProductParameter, значение)}
+        self.existing_parameters = {}
+        # external_id, встреченные в прайсе
+        self.seen = set()
+        # id категорий, уже обработанных в этом импорте
+        self.known_categories = set()
+        # (название, id категории) -> id продукта
+        self.products = {}
+        # Справочники параметров и категорий, загружаются один раз на импорт
+        self.parameters = ParameterRegistry(batch_size)
+        self.categories = CategoryRegistry(batch_size)
+        self.stats = {
+            'categories': 0,
+            'products': 0,
+            'product_infos': 0,
+            'parameters': 0,
+            'product_parameters': 0,
+            'inserted': 0,
+            'updated': 0,
+            'unchanged': 0,
+            'removed': 0,
+        }
+
+    def run(self, data):
+        """
+        Импортирует прайс в формате shop1.yaml: shop, categories, goods
+        """
+        with transaction.atomic():
+            self.import_header(data)
+            if self.mode == IMPORT_MODE_SYNC:
+                for batch in iter_batches(data['goods'], self.batch_size):
+                    self.sync_batch(batch)
+                    self.report_progress(batch)
+                self.retire_missing()
+            else:
+                _, deleted = ProductInfo.objects.filter(shop_id=self.shop.id).delete()
+                self.stats['removed'] = deleted.get(ProductInfo._meta.label, 0)
+                CatalogEntry.objects.filter(shop_id=self.shop.id).delete()
+                for batch in iter_batches(data['goods'], self.batch_size):
+                    self.import_goods(batch)
+                    self.report_progress(batch)
+        if self.has_changes():
+            self.invalidate_caches()
+            refresh_facet_counts(self.shop.id)
+        return self.stats
+
+    def import_header(self, data):
+        """
+        Магазин и категории из заголовка прайса
+        """
+        self.shop, _ = Shop.objects.get_or_create(name=data['shop'], user_id=self.user_id)
+        self.import_categories(data.get('categories') or [])
+
+    def report_progress(self, batch):
+        self.rows_processed += len(batch)
+        if self.progress:
+            self.progress(self.rows_processed)
+
+    def has_changes(self):
+        return any(self.stats[key] for key in ('categories', 'inserted', 'updated', 'removed'))
+
+    def import_categories(self, categories):
+        """
+        Создает недостающие категории, обновляет названия и связывает их с магазином
+        """
+        names = {int(category['id']): category['name'] for category in categories}
+        if not names:
+            return
+        self.known_categories.update(names)
+        created = self.categories.created
+        self.categories.sync(names)
+        if self.categories.renamed:
+            rename_catalog_categories(self.categories.renamed)
+            invalidate_tags_on_commit(*[category_tag(category_id) for category_id in self.categories.renamed])
+
+        through = Category.shops.through
+        through.objects.bulk_create(
+            [through(category_id=category_id, shop_id=self.shop.id) for category_id in names],
+            ignore_conflicts=True,
+        )
+        self.stats['categories'] += self.categories.created - created
+
+    def import_item_categories(self, goods):
+        """
+        Категории, объявленные прямо в товарах (колонка category_name в CSV)
+        """
+        declared = {}
+        for item in goods:
+            if item.get('category_name') and int(item['category']) not in self.known_categories:
+                declared[int(item['category'])] = item['category_name']
+        if declared:
+            self.import_categories([{'id': category_id, 'name': name} for category_id, name in declared.items()])
+
+    def resolve_products(self, goods):
+        """
+        Возвращает id продуктов для товаров пакета, создавая недостающие
+        """
+        keys = {(item['name'], int(item['category'])) for item in goods}
+        missing = keys - self.products.keys()
+        if missing:
+            self.load_products(missing)
+            new_keys = missing - self.products.keys()
+            if new_keys:
+                # Тот же продукт мог одновременно создать параллельный шард: вставляем
+                # с ignore_conflicts (уникальность (name, category) в БД) и перечитываем id
+                Product.objects.bulk_create(
+                    [Product(name=name, category_id=category_id) for name, category_id in new_keys],
+                    batch_size=self.batch_size, ignore_conflicts=True,
+                )
+                self.load_products(new_keys)
+                self.stats['products'] += len(new_keys)
+        return self.products
+
+    def load_products(self, keys):
+        """
+        Дописывает в self.products id существующих продуктов с ключами (название, id категории)
+        """
+        found = Product.objects.filter(
+            category_id__in={category_id for _, category_id in keys},
+            name__in={name for name, _ in keys},
+        ).values_list('name', 'category_id', 'id')
+        for name, category_id, product_id in found:
+            if (name, category_id) in keys:
+                self.products.setdefault((name, category_id), product_id)
+
+    def resolve_parameters(self, names):
+        """
+        Возвращает id параметров по названиям, создавая недостающие
+        """
+        created = self.parameters.created
+        ids = self.parameters.resolve(names)
+        self.stats['parameters'] += self.parameters.created - created
+        return ids
+
+    def item_fields(self, item, products):
+        """
+        Значения полей ProductInfo для товара из прайса
+        """
+        return {
+            'product_id': products[(item['name'], int(item['category']))],
+            'name': item['name'],
+            'model': item.get('model', ''),
+            'price': item['price'],
+            'price_rrc': item.get('price_rrc'),
+            'quantity': item['quantity'],
+        }
+
+    def item_parameters(self, item, parameters):
+        """
+        Параметры товара из прайса: {id параметра: значение}
+        """
+        return {parameters[name]: str(value) for name, value in (item.get('parameters') or {}).items()}
+
+    def resolve_batch(self, goods):
+        self.import_item_categories(goods)
+        products = self.resolve_products(goods)
+        parameters = self.resolve_parameters(
+            {name for item in goods for name in (item.get('parameters') or {})}
+        )
+        return products, parameters
+
+    def create_product_infos(self, goods, products, parameters):
+        """
+        Создает ProductInfo и их параметры для пакета новых товаров
+        """
+        product_infos = ProductInfo.objects.bulk_create(
+            [ProductInfo(external_id=item['id'], shop_id=self.shop.id, **self.item_fields(item, products))
+             for item in goods],
+            batch_size=self.batch_size,
+        )
+
+        product_parameters = [
+            ProductParameter(product_info_id=product_info.id, parameter_id=parameter_id,
+                             value=value, value_number=parse_number(value))
+            for product_info, item in zip(product_infos, goods)
+            for parameter_id, value in self.item_parameters(item, parameters).items()
+        ]
+        ProductParameter.objects.bulk_create(product_parameters, batch_size=self.batch_size)
+        update_search_vectors([product_info.id for product_info in product_infos])
+        refresh_catalog_entries([product_info.id for product_info in product_infos], self.batch_size)
+
+        self.stats['product_infos'] += len(product_infos)
+        self.stats['product_parameters'] += len(product_parameters)
+        self.stats['inserted'] += len(product_infos)
+
+    def import_goods(self, goods):
+        """
+        Записывает пакет товаров: продукты, информацию о продуктах и параметры
+        """
+        products, parameters = self.resolve_batch(goods)
+        self.create_product_infos(goods, products, parameters)
+
+    def load_existing(self, external_ids):
+        """
+        Загружает товары магазина с external_ids и их параметры для сравнения с прайсом
+
+        Загруженное заменяет предыдущий пакет, поэтому память не растет с размером каталога.
+        """
+        self.existing = {}
+        self.existing_parameters = {}
+        product_infos = ProductInfo.objects.filter(shop_id=self.shop.id, external_id__in=external_ids)
+        parameters = ProductParameter.objects.filter(product_info__in=product_infos)
+
+        for values in product_infos.values('id', 'external_id', *SYNC_FIELDS):
+            self.existing[values['external_id']] = values
+
+        parameters = parameters.values_list('id', 'product_info_id', 'parameter_id', 'value')
+        for product_parameter_id, product_info_id, parameter_id, value in parameters:
+            self.existing_parameters.setdefault(product_info_id, {})[parameter_id] = (product_parameter_id, value)
+
+    def sync_batch(self, goods):
+        """
+        Загружает существующие товары пакета и синхронизирует его
+        """
+        self.load_existing({int(item['id']) for item in goods})
+        self.sync_goods(goods)
+
+    def sync_goods(self, goods):
+        """
+        Сравнивает пакет товаров с каталогом магазина и применяет только изменения
+        """
+        unique_goods = []
+        for item in goods:
+            external_id = int(item['id'])
+            if external_id not in self.seen:
+                self.seen.add(external_id)
+                unique_goods.append(item)
+
+        products, parameters = self.resolve_batch(unique_goods)
+
+        new_goods = []
+        changed_infos = []
+        changed_fields = set()
+        reindex_ids = []
+        # id существующих товаров, чьи строки каталога нужно перестроить
+        touched_ids = []
+        new_parameters = []
+        changed_parameters = []
+        removed_parameters = []
+
+        for item in unique_goods:
+            current = self.existing.get(int(item['id']))
+            if current is None:
+                new_goods.append(item)
+                continue
+
+            fields = self.item_fields(item, products)
+            diff = [field for field in SYNC_FIELDS if current[field] != fields[field]]
+            if diff:
+                changed_infos.append(ProductInfo(id=current['id'], **fields))
+                changed_fields.update(diff)
+                if SEARCH_FIELDS.intersection(diff):
+                    reindex_ids.append(current['id'])
+
+            wanted = self.item_parameters(item, parameters)
+            stored = self.existing_parameters.get(current['id'], {})
+            parameters_changed = False
+            for parameter_id, value in wanted.items():
+                if parameter_id not in stored:
+                    new_parameters.append(ProductParameter(product_info_id=current['id'], parameter_id=parameter_id,
+                                                           value=value, value_number=parse_number(value)))
+                    parameters_changed = True
+                elif stored[parameter_id][1] != value:
+                    changed_parameters.append(ProductParameter(id=stored[parameter_id][0], value=value,
+                                                               value_number=parse_number(value)))
+                    parameters_changed = True
+            for parameter_id, (product_parameter_id, _) in stored.items():
+                if parameter_id not in wanted:
+                    removed_parameters.append(product_parameter_id)
+                    parameters_changed = True
+
+            if diff or parameters_changed:
+                self.stats['updated'] += 1
+                touched_ids.append(current['id'])
+            else:
+                self.stats['unchanged'] += 1
+
+        if new_goods:
+            self.create_product_infos(new_goods, products, parameters)
+        if changed_infos:
+            ProductInfo.objects.bulk_update(changed_infos, sorted(changed_fields), batch_size=self.batch_size)
+        if reindex_ids:
+            update_search_vectors(reindex_ids)
+        if new_parameters:
+            ProductParameter.objects.bulk_create(new_parameters, batch_size=self.batch_size)
+            self.stats['product_parameters'] += len(new_parameters)
+        if changed_parameters:
+            ProductParameter.objects.bulk_update(changed_parameters, ['value', 'value_number'],
+                                                 batch_size=self.batch_size)
+        for ids in iter_batches(removed_parameters, self.batch_size):
+            ProductParameter.objects.filter(id__in=ids).delete()
+        if touched_ids:
+            refresh_catalog_entries(touched_ids, self.batch_size)
+
+    def retire_missing(self, seen=None, seen_count=None):
+        """
+        Снимает с продажи товары магазина, которых нет в прайсе
+
+        Встреченные external_id (seen и их число seen_count, по умолчанию self.seen)
+        пишутся во временную таблицу, и товары снимаются двумя UPDATE с NOT IN по ней,
+        без загрузки каталога магазина в память. Вызывается внутри transaction.atomic:
+        при откате исчезает и временная таблица.
+        """
+        if seen is None:
+            seen, seen_count = self.seen, len(self.seen)
+        # Все встреченные товары уже записаны в магазин: если строк столько же, снимать нечего
+        if ProductInfo.objects.filter(shop_id=self.shop.id).count() == seen_count:
+            return
+
+        table = connection.ops.quote_name(SEEN_TABLE)
+        with connection.cursor() as cursor:
+            cursor.execute(f'CREATE TEMPORARY TABLE {table} (external_id bigint PRIMARY KEY)')
+            for ids in iter_batches(seen, self.batch_size):
+                cursor.execute(f"INSERT INTO {table} (external_id) VALUES {', '.join(['(%s)'] * len(ids))}", ids)
+
+        seen = RawSQL(f'SELECT external_id FROM {table}', [])
+        CatalogEntry.objects.filter(shop_id=self.shop.id, quantity__gt=0).exclude(
+            external_id__in=seen).update(quantity=0)
+        self.stats['removed'] += ProductInfo.objects.filter(shop_id=self.shop.id, quantity__gt=0).exclude(
+            external_id__in=seen).update(quantity=0)
+
+        with connection.cursor() as cursor:
+            cursor.execute(f'DROP TABLE {table}')
+
+    def invalidate_caches(self):
+        """
+        bulk-операции не проходят через сигналы cacheops, поэтому сбрасываем кеш явно
+        """
+        for model in (Category, Product, ProductInfo, Parameter, ProductParameter):
+            invalidate_model(model)
+        CacheManager.invalidate_product_caches(
+            self.shop.id, Category.objects.filter(shops=self.shop).values_list('id', flat=True))
+
+
+class ShardImporter(PriceListImporter):
+    """
+    Синхронизация одного шарда прайса при параллельном импорте
+
+    Магазин и категории из заголовка уже созданы координатором. Каждый пакет
+    пишется в своей транзакции; продукты и параметры шарды создают сами,
+    вставкой с ignore_conflicts по уникальным ограничениям, без общей блокировки.
+    Встреченные id отмечаются в общем для задачи множестве (claim_rows):
+    товар, уже взятый другим шардом или ранее этим, пропускается.
+    Снятие с продажи отсутствующих товаров и сброс кеша выполняет
+    finish_sharded_import один раз после всех шардов.
+    """
+
+    def __init__(self, user_id, shop_id, claim_rows, batch_size=IMPORT_BATCH_SIZE, progress=None):
+        super().__init__(user_id, batch_size=batch_size, mode=IMPORT_MODE_SYNC, progress=progress)
+        self.shop = Shop.objects.get(id=shop_id)
+        # Принимает external_id пакета, возвращает те, что еще не встречались в прайсе
+        self.claim_rows = claim_rows
+
+    def run(self, goods):
+        for batch in iter_batches(goods, self.batch_size):
+            claimed = self.claim_rows([int(item['id']) for item in batch])
+            own = [item for item in batch if int(item['id']) in claimed]
+            if own:
+                # Повторы между пакетами уже отсеяны claim_rows, seen нужен только внутри пакета
+                self.seen = set()
+                with transaction.atomic():
+                    self.sync_batch(own)
+            self.report_progress(batch)
+        return self.stats
+
+
+def finish_sharded_import(user_id, shop_id, shard_stats, seen=(), seen_count=0, retire=True):
+    """
+    Завершает параллельный импорт: снимает с продажи товары, которых не было
+    ни в одном шарде (seen - все встреченные external_id, seen_count - их число),
+    суммирует статистику и один раз сбрасывает кеш
+    """
+    importer = PriceListImporter(user_id)
+    importer.shop = Shop.objects.get(id=shop_id)
+    for stats in shard_stats:
+        for key, value in stats.items():
+            importer.stats[key] += value
+
+    if retire:
+        with transaction.atomic():
+            importer.retire_missing(seen, seen_count)
+
+    importer.invalidate_caches()
+    refresh_facet_counts(shop_id)
+    return importer.stats
@@ -0,0 +1,116 @@
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django_redis import get_redis_connection
+
+logger = logging.getLogger(__name__)
+
+# Канал Redis, по которому процессы сообщают друг другу об удаленных ключах
+INVALIDATION_CHANNEL = 'cache_l1_invalidation'
+# Пауза перед переподключением слушателя после ошибки Redis
+LISTENER_RETRY_DELAY = 1
+# Сколько слушатель ждет сообщение за один вызов: меньше SOCKET_TIMEOUT пула,
+# иначе тихий канал выглядел бы как обрыв соединения
+LISTENER_POLL_TIMEOUT = 1
+
+
+class LocalCache:
+    """
+    L1: кеш в памяти процесса перед Redis (L2)
+
+    Ограничен по числу записей (вытесняется давно не читанная) и по времени
+    жизни записи. Согласованность между процессами - через сообщения
+    INVALIDATION_CHANNEL, короткий TTL ограничивает устаревание, если
+    сообщение потерялось. Значение из L1 - общий объект для всех потоков
+    процесса, изменять его нельзя.
+    """
+
+    def __init__(self, max_entries, timeout):
+        self.max_entries = max_entries
+        self.timeout = timeout
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._listener_pid = None
+
+    def get(self, key):
+        self._ensure_listener()
+        with self._lock:
+            item = self._entries.get(key)
+            if item is None:
+                return None
+            value, expires = item
+            if time.monotonic() >= expires:
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, timeout=None):
+        self._ensure_listener()
+        timeout = self.timeout if timeout is None else min(timeout, self.timeout)
+        with self._lock:
+            self._entries[key] = (value, time.monotonic() + timeout)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def delete_many(self, keys):
+        with self._lock:
+            for key in keys:
+                self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _ensure_listener(self):
+        # После fork (gunicorn, celery prefork) поток слушателя в дочернем процессе не существует
+        if self._listener_pid == os.getpid():
+            return
+        with self._lock:
+            if self._listener_pid == os.getpid():
+                return
+            self._entries.clear()
+            self._listener_pid = os.getpid()
+            threading.Thread(target=self._listen, name='cache-l1-invalidation', daemon=True).start()
+
+    def _listen(self):
+        while True:
+            pubsub = None
+            try:
+                pubsub = get_redis_connection('default').pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(INVALIDATION_CHANNEL)
+                while True:
+                    # Без сообщений get_message возвращает None по таймауту, а не бросает исключение
+                    message = pubsub.get_message(timeout=LISTENER_POLL_TIMEOUT)
+                    if message:
+                        self.delete_many(message['data'].decode().split('\n'))
+            except Exception:
+                logger.warning('Слушатель инвалидации L1 отключился от Redis', exc_info=True)
+                # Пока слушатель не работал, сообщения могли потеряться
+                self.clear()
+                time.sleep(LISTENER_RETRY_DELAY)
+            finally:
+                if pubsub is not None:
+                    pubsub.close()
+
+
+local_cache = LocalCache(settings.CACHE_L1_MAX_ENTRIES, settings.CACHE_L1_TIMEOUT)
+
+
+def publish_invalidation(keys):
+    """
+    Удаляет ключи из L1 текущего процесса и сообщает о них остальным процессам
+    """
+    keys = list(keys)
+    if not keys:
+        return
+    local_cache.delete_many(keys)
+    get_redis_connection('default').publish(INVALIDATION_CHANNEL, '\n'.join(keys))
@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+
+from backend.catalog import refresh_shop_catalog
+from backend.models import CatalogEntry, Shop
+
+
+class Command(BaseCommand):
+    help = 'Перестраивает денормализованный каталог CatalogEntry (после развертывания или сбоя)'
+
+    def handle(self, *args, **options):
+        refreshed = 0
+        for shop_id in Shop.objects.order_by('id').values_list('id', flat=True):
+            refreshed += refresh_shop_catalog(shop_id)
+        _, deleted = CatalogEntry.objects.exclude(shop_id__in=Shop.objects.values('id')).delete()
+        self.stdout.write(self.style.SUCCESS(f'Строк каталога: {refreshed}, удалено лишних: {deleted}'))
@@ -0,0 +1,19 @@
+from django.core.management.base import BaseCommand
+
+from backend.importer import iter_batches
+from backend.models import ProductInfo
+from backend.search import update_search_vectors
+
+
+class Command(BaseCommand):
+    help = 'Пересчитывает search_vector у всех товаров (после первого развертывания поиска)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=10000)
+
+    def handle(self, *args, **options):
+        ids = ProductInfo.objects.order_by('id').values_list('id', flat=True).iterator()
+        updated = 0
+        for batch in iter_batches(ids, options['batch_size']):
+            updated += update_search_vectors(product_info_ids=batch)
+        self.stdout.write(self.style.SUCCESS(f'Обновлено товаров: {updated}'))
@@ -2,6 +2,7 @@ from django.contrib.auth.base_user import BaseUserManager
 from django.contrib.auth.models import AbstractUser
 from django.contrib.auth.validators import UnicodeUsernameValidator
 from django.db import models
+from django.contrib.postgres.search import SearchVectorField
 from django_rest_passwordreset.tokens import get_token_generator
 from django.dispatch import Signal
 from imagekit.models import ProcessedImageField
@@ -144,6 +145,10 @@ class Shop(models.Model):
     user = models.OneToOneField(User, verbose_name='Пользователи',
                                 blank=True, null=True,
                                 on_delete=models.CASCADE)
+    # Валидаторы последнего загруженного прайса для условных запросов
+    feed_etag = models.CharField('ETag прайса', max_length=255, blank=True, default='')
+    feed_last_modified = models.CharField('Last-Modified прайса', max_length=64, blank=True, default='')
+    feed_hash = models.CharField('SHA-256 прайса', max_length=64, blank=True, default='')
 
     class Meta:
         verbose_name = 'Магазин'
@@ -179,6 +184,9 @@ class Product(models.Model):
         verbose_name = 'Продукт'
         verbose_name_plural = "Список продуктов"
         ordering = ('-name',)
+        constraints = [
+            models.UniqueConstraint(fields=['name', 'category'], name='unique_product_category'),
+        ]
 
     def __str__(self):
         return self.name
@@ -249,6 +257,8 @@ class ProductInfo(models.Model):
     main_image = models.ForeignKey(ProductImage, verbose_name='Основное изображение',
                                    null=True, blank=True, on_delete=models.SET_NULL,
                                    related_name='main_product_info')
+    # Поддерживается backend.search: название, название продукта и модель
+    search_vector = SearchVectorField(null=True, editable=False)
 
     class Meta:
         verbose_name = 'Информация о продукте'
@@ -285,6 +295,9 @@ class Parameter(models.Model):
         verbose_name = 'Имя параметра'
         verbose_name_plural = "Список имен параметров"
         ordering = ('-name',)
+        constraints = [
+            models.UniqueConstraint(fields=['name'], name='unique_parameter_name'),
+        ]
 
     def __str__(self):
         return self.name
@@ -300,6 +313,8 @@ class ProductParameter(models.Model):
     parameter = models.ForeignKey(Parameter, verbose_name='Параметр', related_name='product_parameters', blank=True,
                                   on_delete=models.CASCADE)
     value = models.CharField(verbose_name='Значение', max_length=100)
+    # Числовое значение для фильтров по диапазону (backend.facets.parse_number)
+    value_number = models.FloatField(verbose_name='Числовое значение', null=True, blank=True, editable=False)
 
     class Meta:
         verbose_name = 'Параметр'
@@ -307,6 +322,90 @@ class ProductParameter(models.Model):
         constraints = [
             models.UniqueConstraint(fields=['product_info', 'parameter'], name='unique_product_parameter'),
         ]
+        indexes = [
+            models.Index(fields=['parameter', 'value'], name='product_parameter_value_idx'),
+            models.Index(fields=['parameter', 'value_number'], name='product_parameter_number_idx'),
+        ]
+
+
+class FacetCount(models.Model):
+    """
+    Предрасчитанное число товаров в наличии со значением параметра
+
+    Хранится по магазину и категории: импорт прайса пересчитывает только
+    строки своего магазина (backend.facets.refresh_facet_counts).
+    """
+    shop = models.ForeignKey(Shop, verbose_name='Магазин', related_name='facet_counts',
+                             on_delete=models.CASCADE)
+    category = models.ForeignKey(Category, verbose_name='Категория', related_name='facet_counts',
+                                 on_delete=models.CASCADE)
+    parameter = models.ForeignKey(Parameter, verbose_name='Параметр', related_name='facet_counts',
+                                  on_delete=models.CASCADE)
+    value = models.CharField(verbose_name='Значение', max_length=100)
+    value_number = models.FloatField(verbose_name='Числовое значение', null=True, blank=True)
+    count = models.PositiveIntegerField(verbose_name='Количество товаров')
+
+    class Meta:
+        verbose_name = 'Счетчик фасета'
+        verbose_name_plural = 'Счетчики фасетов'
+        constraints = [
+            models.UniqueConstraint(fields=['shop', 'category', 'parameter', 'value'], name='unique_facet_count'),
+        ]
+        indexes = [
+            models.Index(fields=['category', 'parameter'], name='facet_count_category_idx'),
+        ]
+
+
+class CatalogEntry(models.Model):
+    """
+    Денормализованная строка каталога: одно предложение магазина
+
+    id совпадает с id ProductInfo. Названия магазина и категории и параметры
+    (JSON) хранятся в строке, поэтому страница каталога читается одним
+    запросом по индексу без JOIN и prefetch. Поддерживается backend.catalog.
+    """
+    id = models.BigIntegerField(primary_key=True, verbose_name='ИД информации о продукте')
+    external_id = models.PositiveIntegerField(verbose_name='Внешний ИД магазина')
+    product_id = models.BigIntegerField(verbose_name='ИД продукта', null=True)
+    name = models.CharField(max_length=80, verbose_name='Название')
+    model = models.CharField(max_length=80, verbose_name='Модель', blank=True)
+    price = models.PositiveIntegerField(verbose_name='Цена')
+    price_rrc = models.PositiveIntegerField(verbose_name='Рекомендуемая цена', null=True)
+    quantity = models.PositiveIntegerField(verbose_name='Количество')
+    shop_id = models.BigIntegerField(verbose_name='ИД магазина')
+    shop_name = models.CharField(max_length=100, verbose_name='Название магазина')
+    category_id = models.BigIntegerField(verbose_name='ИД категории', null=True)
+    category_name = models.CharField(max_length=100, verbose_name='Название категории', null=True)
+    parameters = models.JSONField(verbose_name='Параметры', default=list)
+
+    class Meta:
+        verbose_name = 'Строка каталога'
+        verbose_name_plural = 'Каталог (read model)'
+        indexes = [
+            models.Index(fields=['id'], condition=models.Q(quantity__gt=0), name='catalog_in_stock_idx'),
+            models.Index(fields=['shop_id', 'id'], condition=models.Q(quantity__gt=0),
+                         name='catalog_shop_in_stock_idx'),
+            models.Index(fields=['category_id', 'id'], condition=models.Q(quantity__gt=0),
+                         name='catalog_category_in_stock_idx'),
+        ]
+
+    def as_dict(self, held=0):
+        """
+        Товар в формате ответа ProductListView, held - количество, удерживаемое корзинами
+        """
+        return {
+            'id': self.id,
+            'external_id': self.external_id,
+            'product_id': self.product_id,
+            'name': self.name,
+            'model': self.model,
+            'price': self.price,
+            'price_rrc': self.price_rrc,
+            'quantity': max(self.quantity - held, 0),
+            'shop': {'id': self.shop_id, 'name': self.shop_name},
+            'category': {'id': self.category_id, 'name': self.category_name},
+            'parameters': self.parameters,
+        }
 
 
 class Address(models.Model):
@@ -0,0 +1,67 @@
+from copy import copy
+
+from cacheops import invalidate_obj
+from django.db import transaction
+
+from backend.catalog import stock_changed
+from backend.exceptions import OrderStateException
+from backend.models import Order, STATE_CHOICES
+from backend.stock import held_by_others, order_lines, release_holds, reserve_stock, restore_stock
+
+# Допустимые переходы статусов заказа
+ORDER_TRANSITIONS = {
+    'basket': ('new', 'canceled'),
+    'new': ('confirmed', 'canceled'),
+    'confirmed': ('assembled', 'canceled'),
+    'assembled': ('sent', 'canceled'),
+    'sent': ('delivered', 'canceled'),
+    'delivered': (),
+    'canceled': (),
+}
+# Статусы, в которых товары заказа списаны со склада
+STOCK_RESERVED_STATES = {'new', 'confirmed', 'assembled', 'sent', 'delivered'}
+STATE_NAMES = dict(STATE_CHOICES)
+
+
+def change_state(order, target, **fields):
+    """
+    Переводит заказ в статус target вместе с изменением остатков
+
+    Статус меняется по условию (compare-and-set по статусу, прочитанному в order), в одной
+    транзакции с остатками: при выходе из корзины товары списываются (reserve_stock),
+    при отмене списанного заказа возвращаются одним запросом (restore_stock). Кеш ответов
+    инвалидируется одним событием на заказ после коммита. Недопустимый переход или
+    параллельная смена статуса - OrderStateException, нехватка товара - InventoryException.
+    fields - другие поля заказа, меняемые вместе со статусом (например, contact).
+    """
+    source = order.state
+    if target not in ORDER_TRANSITIONS.get(source, ()):
+        raise OrderStateException(
+            f'Невозможно перевести заказ из статуса "{STATE_NAMES[source]}" в статус "{STATE_NAMES[target]}"',
+            code='invalid_transition')
+
+    lines = None
+    with transaction.atomic():
+        if not Order.objects.filter(id=order.id, state=source).update(state=target, **fields):
+            raise OrderStateException('Статус заказа уже изменен другим запросом', code='state_conflict')
+        if source not in STOCK_RESERVED_STATES and target in STOCK_RESERVED_STATES:
+            lines = order_lines(order.id)
+            reserve_stock(lines, held_by_others(order.user_id, lines))
+        elif source in STOCK_RESERVED_STATES and target not in STOCK_RESERVED_STATES:
+            lines = order_lines(order.id)
+            restore_stock(lines)
+        if lines:
+            stock_changed(lines)
+
+    previous = copy(order)
+    order.state = target
+    for name, value in fields.items():
+        setattr(order, name, value)
+    # Условный UPDATE не проходит через сигналы cacheops: сбрасываем закешированные запросы
+    # к заказу в старом и новом статусе (внутри внешней транзакции cacheops отложит это до коммита)
+    invalidate_obj(previous)
+    invalidate_obj(order)
+    if source == 'basket':
+        # Корзина оформлена или отменена, ее резервы больше не нужны
+        release_holds(order.user_id, lines or order_lines(order.id))
+    return order
@@ -0,0 +1,68 @@
+import json
+
+from django.db import connections
+from rest_framework.pagination import PageNumberPagination, CursorPagination
+from rest_framework.response import Response
+
+# Потолок размера страницы, задаваемого клиентом
+MAX_PAGE_SIZE = 100
+
+
+def estimate_count(queryset):
+    """
+    Оценка числа строк по статистике планировщика Postgres вместо COUNT(*)
+
+    Для других СУБД возвращает None.
+    """
+    connection = connections[queryset.db]
+    if connection.vendor != 'postgresql':
+        return None
+    sql, params = queryset.order_by().values('pk').query.sql_with_params()
+    with connection.cursor() as cursor:
+        cursor.execute(f'EXPLAIN (FORMAT JSON) {sql}', params)
+        plan = cursor.fetchone()[0]
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    return int(plan[0]['Plan']['Plan Rows'])
+
+
+class ProductPageNumberPagination(PageNumberPagination):
+    """
+    Постраничная пагинация с ограничением page_size
+    """
+    page_size = 20
+    page_size_query_param = 'page_size'
+    max_page_size = MAX_PAGE_SIZE
+
+
+class ProductCursorPagination(CursorPagination):
+    """
+    Пагинация по курсору (keyset) по id
+
+    Следующая страница выбирается условием id > последний id, без OFFSET
+    и без COUNT(*), поэтому глубокие страницы стоят столько же, сколько первая.
+    Курсор в ответе непрозрачный. Оценку общего числа строк по статистике
+    планировщика можно запросить параметром estimate_count=true.
+    """
+    ordering = 'id'
+    page_size = 20
+    page_size_query_param = 'page_size'
+    max_page_size = MAX_PAGE_SIZE
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.estimated_count = None
+        if request.query_params.get('estimate_count', '').lower() in ('1', 'true', 'yes'):
+            self.estimated_count = estimate_count(queryset)
+        return super().paginate_queryset(queryset, request, view)
+
+    def get_paginated_response(self, data):
+        return Response({
+            'next': self.get_next_link(),
+            'previous': self.get_previous_link(),
+            'estimated_count': self.estimated_count,
+            'results': data,
+        })
+
+    @staticmethod
+    def is_requested(request):
+        return 'cursor' in request.query_params or request.query_params.get('pagination') == 'cursor'
@@ -0,0 +1,85 @@
+import sys
+
+from backend.models import Category, Parameter
+
+
+class ParameterRegistry:
+    """
+    Справочник параметров название -> id на время импорта
+
+    Загружается одним запросом при первом обращении. Недостающие названия
+    вставляются одним bulk_create с ignore_conflicts и перечитываются:
+    параллельный шард мог создать их раньше, уникальность названия
+    гарантирует БД. Названия интернируются: одни и те же строки
+    повторяются в каждом товаре.
+    """
+
+    def __init__(self, batch_size=1000):
+        self.batch_size = batch_size
+        self.ids = None
+        self.created = 0
+
+    def load(self):
+        self.ids = {}
+        for name, parameter_id in Parameter.objects.order_by('id').values_list('name', 'id'):
+            self.ids.setdefault(sys.intern(name), parameter_id)
+
+    def resolve(self, names):
+        """
+        Возвращает словарь название -> id, в котором есть все names
+        """
+        if self.ids is None:
+            self.load()
+        missing = set(names) - self.ids.keys()
+        if missing:
+            Parameter.objects.bulk_create([Parameter(name=name) for name in missing],
+                                          batch_size=self.batch_size, ignore_conflicts=True)
+            for name, parameter_id in Parameter.objects.filter(name__in=missing).values_list('name', 'id'):
+                self.ids[sys.intern(name)] = parameter_id
+            # Вставка с ignore_conflicts не сообщает, какие строки созданы: при гонке
+            # с параллельным шардом счетчик учтет и названия, созданные им
+            self.created += len(missing)
+        return self.ids
+
+
+class CategoryRegistry:
+    """
+    Справочник категорий id -> название на время импорта
+
+    Загружается одним запросом; при синхронизации создаются только новые
+    категории и переименовываются только изменившиеся.
+    """
+
+    def __init__(self, batch_size=1000):
+        self.batch_size = batch_size
+        self.names = None
+        self.created = 0
+        # id -> новое название для категорий, переименованных последним вызовом sync
+        self.renamed = {}
+
+    def load(self):
+        self.names = dict(Category.objects.values_list('id', 'name'))
+
+    def sync(self, names):
+        """
+        Приводит категории с id из names к указанным названиям
+        """
+        if self.names is None:
+            self.load()
+        missing = names.keys() - self.names.keys()
+        if missing:
+            # Категорию мог создать параллельный шард после загрузки справочника
+            self.names.update(Category.objects.filter(id__in=missing).values_list('id', 'name'))
+
+        new_categories = [Category(id=category_id, name=name)
+                          for category_id, name in names.items() if category_id not in self.names]
+        Category.objects.bulk_create(new_categories, batch_size=self.batch_size, ignore_conflicts=True)
+
+        renamed = [Category(id=category_id, name=name) for category_id, name in names.items()
+                   if category_id in self.names and self.names[category_id] != name]
+        Category.objects.bulk_update(renamed, ['name'], batch_size=self.batch_size)
+        self.renamed = {category.id: category.name for category in renamed}
+
+        self.names.update(names)
+        self.created += len(new_categories)
+        return self.names
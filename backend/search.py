@@ -0,0 +1,390 @@
+import heapq
+import logging
+import re
+import threading
+import uuid
+from collections import defaultdict
+
+from django.conf import settings
+from django.contrib.postgres.search import SearchQuery, SearchRank, SearchVector, TrigramSimilarity
+from django.core.cache import cache
+from django.db import connection, connections, transaction, DatabaseError
+from django.db.models import F, FloatField, OuterRef, Q, Subquery
+from django.db.models.expressions import RawSQL
+from django.db.models.functions import Greatest
+from django_redis import get_redis_connection
+
+from backend.models import Product, ProductInfo
+
+# Конфигурация полнотекстового поиска Postgres со стеммингом русского языка
+SEARCH_CONFIG = 'russian'
+# Порог похожести для нечеткого совпадения по триграммам
+TRIGRAM_THRESHOLD = 0.3
+# Сколько лучших результатов возвращает поиск по инвертированному индексу
+SEARCH_MAX_RESULTS = 1000
+# Веса полей: название в магазине и название продукта важнее модели
+FIELD_WEIGHTS = {'name': 1.0, 'product_name': 1.0, 'model': 0.4}
+
+SEARCH_BACKEND_POSTGRES = 'postgres'
+SEARCH_BACKEND_INVERTED = 'inverted'
+
+SEARCH_INDEX_VERSION_KEY = 'search_index_version'
+# Журнал изменений для индексов в памяти: список id измененных товаров по порядку
+SEARCH_INDEX_CHANGES_KEY = 'search_index_changes'
+# Длина журнала, после которой процессы перестраивают индекс целиком
+SEARCH_INDEX_MAX_CHANGES = 10000
+
+logger = logging.getLogger(__name__)
+
+TOKEN_RE = re.compile(r'\w+', re.UNICODE)
+CYRILLIC_RE = re.compile(r'[а-я]')
+# Окончания для упрощенного стемминга в индексе в памяти (длинные первыми)
+RUSSIAN_ENDINGS = sorted((
+    'иями', 'ями', 'ами', 'его', 'ого', 'ему', 'ому', 'ыми', 'ими', 'ией', 'иях', 'ах', 'ях',
+    'ой', 'ей', 'ий', 'ый', 'ая', 'яя', 'ое', 'ее', 'ие', 'ые', 'ом', 'ем', 'ам', 'ям', 'ов', 'ев',
+    'ью', 'ия', 'ию', 'ии', 'а', 'я', 'о', 'е', 'ы', 'и', 'у', 'ю', 'ь', 'й',
+), key=len, reverse=True)
+
+
+def search_vector_expression():
+    """
+    tsvector по названию, названию продукта (вес A) и модели (вес B)
+    """
+    product_name = Subquery(Product.objects.filter(pk=OuterRef('product_id')).values('name')[:1])
+    return (
+        SearchVector('name', weight='A', config=SEARCH_CONFIG)
+        + SearchVector(product_name, weight='A', config=SEARCH_CONFIG)
+        + SearchVector('model', weight='B', config=SEARCH_CONFIG)
+    )
+
+
+def uses_postgres_search():
+    backend = getattr(settings, 'PRODUCT_SEARCH_BACKEND', 'auto')
+    if backend == 'auto':
+        return connection.vendor == 'postgresql'
+    return backend == SEARCH_BACKEND_POSTGRES
+
+
+def update_search_vectors(product_info_ids=None, product_ids=None):
+    """
+    Пересчитывает search_vector у товаров (Postgres) и, если поиск идет по индексу
+    в памяти, записывает товары в его журнал изменений (без фильтров - сброс индекса)
+    """
+    product_infos = ProductInfo.objects.all()
+    if product_info_ids is not None:
+        product_infos = product_infos.filter(id__in=list(product_info_ids))
+    if product_ids is not None:
+        product_infos = product_infos.filter(product_id__in=list(product_ids))
+    if not uses_postgres_search():
+        if product_info_ids is None and product_ids is None:
+            transaction.on_commit(invalidate_search_index)
+        elif product_ids is None:
+            search_index_changed(product_info_ids)
+        else:
+            search_index_changed(product_infos.values_list('id', flat=True))
+    if connection.vendor != 'postgresql':
+        return 0
+    return product_infos.update(search_vector=search_vector_expression())
+
+
+def create_search_indexes(using='default', **kwargs):
+    """
+    Обработчик post_migrate: GIN-индексы по search_vector и триграммам (только Postgres)
+
+    Индексы создаются SQL-запросами, а не в Meta.indexes, чтобы схема
+    по-прежнему создавалась на SQLite в локальной разработке.
+    """
+    db = connections[using]
+    if db.vendor != 'postgresql':
+        return
+    product_info_table = ProductInfo._meta.db_table
+    product_table = Product._meta.db_table
+    with db.cursor() as cursor:
+        cursor.execute(f'CREATE INDEX IF NOT EXISTS {product_info_table}_search_vector_gin '
+                       f'ON {product_info_table} USING gin (search_vector)')
+        try:
+            with transaction.atomic(using=using):
+                cursor.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+        except DatabaseError as e:
+            logger.warning('pg_trgm недоступно, нечеткий поиск отключен: %s', e)
+            return
+        for table, column in ((product_info_table, 'name'), (product_info_table, 'model'), (product_table, 'name')):
+            cursor.execute(f'CREATE INDEX IF NOT EXISTS {table}_{column}_trgm '
+                           f'ON {table} USING gin ({column} gin_trgm_ops)')
+
+
+_trigram_available = None
+
+
+def trigram_available():
+    """
+    Установлено ли расширение pg_trgm (проверяется один раз на процесс)
+    """
+    global _trigram_available
+    if _trigram_available is None:
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT 1 FROM pg_extension WHERE extname = 'pg_trgm'")
+            _trigram_available = cursor.fetchone() is not None
+    return _trigram_available
+
+
+def postgres_search(queryset, text):
+    """
+    Полнотекстовый поиск по search_vector и нечеткий поиск по триграммам,
+    результаты отсортированы по релевантности
+    """
+    query = SearchQuery(text, config=SEARCH_CONFIG, search_type='websearch')
+    condition = Q(search_vector=query)
+    rank = SearchRank(F('search_vector'), query)
+    if trigram_available():
+        condition |= (Q(name__trigram_similar=text) | Q(model__trigram_similar=text)
+                      | Q(product__name__trigram_similar=text))
+        rank = rank + Greatest(
+            TrigramSimilarity('name', text),
+            TrigramSimilarity('model', text),
+            TrigramSimilarity('product__name', text),
+        )
+    return queryset.filter(condition).annotate(search_rank=rank).order_by('-search_rank', 'id')
+
+
+def stem(token):
+    """
+    Упрощенный стемминг: нижний регистр, ё -> е, отсечение русского окончания
+    """
+    token = token.lower().replace('ё', 'е')
+    if len(token) > 4 and CYRILLIC_RE.search(token):
+        for ending in RUSSIAN_ENDINGS:
+            if token.endswith(ending) and len(token) - len(ending) >= 3:
+                return token[:-len(ending)]
+    return token
+
+
+def tokenize(text):
+    return [stem(token) for token in TOKEN_RE.findall(text or '')]
+
+
+def trigrams(term):
+    padded = f"  {term} "
+    return {padded[index:index + 3] for index in range(len(padded) - 2)}
+
+
+class InvertedIndex:
+    """
+    Инвертированный индекс товаров в памяти процесса
+
+    Замена полнотекстового поиска Postgres для SQLite и локальной разработки:
+    термин -> {id товара: вес}, плюс триграммы терминов для нечеткого совпадения.
+    """
+
+    def __init__(self):
+        self.postings = defaultdict(dict)
+        self.term_trigrams = defaultdict(set)
+        # Термины каждого товара, чтобы убрать его из индекса без перестроения
+        self.documents = defaultdict(set)
+
+    def add(self, product_info_id, fields):
+        for field, text in fields.items():
+            weight = FIELD_WEIGHTS[field]
+            for term in tokenize(text):
+                postings = self.postings[term]
+                if not postings:
+                    for trigram in trigrams(term):
+                        self.term_trigrams[trigram].add(term)
+                postings[product_info_id] = postings.get(product_info_id, 0) + weight
+                self.documents[product_info_id].add(term)
+
+    def remove(self, product_info_id):
+        for term in self.documents.pop(product_info_id, ()):
+            postings = self.postings[term]
+            postings.pop(product_info_id, None)
+            if postings:
+                continue
+            del self.postings[term]
+            for trigram in trigrams(term):
+                self.term_trigrams[trigram].discard(term)
+                if not self.term_trigrams[trigram]:
+                    del self.term_trigrams[trigram]
+
+    def add_rows(self, rows):
+        for product_info_id, name, model, product_name in rows.iterator(chunk_size=10000):
+            self.add(product_info_id, {'name': name, 'model': model, 'product_name': product_name})
+
+    def refresh(self, product_info_ids):
+        """
+        Переиндексирует товары по текущим данным БД, удаленные товары убираются из индекса
+        """
+        product_info_ids = set(product_info_ids)
+        for product_info_id in product_info_ids:
+            self.remove(product_info_id)
+        self.add_rows(index_rows().filter(id__in=list(product_info_ids)))
+
+    @classmethod
+    def build(cls):
+        index = cls()
+        index.add_rows(index_rows())
+        return index
+
+    def similar_terms(self, term):
+        """
+        Термины индекса: точное совпадение или похожие по триграммам (коэффициент Жаккара)
+        """
+        if term in self.postings:
+            return {term: 1.0}
+        query_trigrams = trigrams(term)
+        shared = defaultdict(int)
+        for trigram in query_trigrams:
+            for candidate in self.term_trigrams.get(trigram, ()):
+                shared[candidate] += 1
+        similar = {}
+        for candidate, count in shared.items():
+            similarity = count / (len(query_trigrams) + len(trigrams(candidate)) - count)
+            if similarity >= TRIGRAM_THRESHOLD:
+                similar[candidate] = similarity
+        return similar
+
+    def search(self, text, limit=SEARCH_MAX_RESULTS):
+        """
+        [(id товара, релевантность)] для товаров, совпавших со всеми словами запроса,
+        по убыванию релевантности; limit=None - все совпадения
+        """
+        scores = None
+        for term in tokenize(text):
+            term_scores = defaultdict(float)
+            for candidate, similarity in self.similar_terms(term).items():
+                for product_info_id, weight in self.postings[candidate].items():
+                    term_scores[product_info_id] = max(term_scores[product_info_id], weight * similarity)
+            if scores is None:
+                scores = term_scores
+            else:
+                scores = {product_info_id: score + term_scores[product_info_id]
+                          for product_info_id, score in scores.items() if product_info_id in term_scores}
+            if not scores:
+                return []
+        if not scores:
+            return []
+        if limit is None:
+            return sorted(scores.items(), key=lambda pair: (-pair[1], pair[0]))
+        return heapq.nsmallest(limit, scores.items(), key=lambda pair: (-pair[1], pair[0]))
+
+
+def index_rows():
+    return ProductInfo.objects.values_list('id', 'name', 'model', 'product__name')
+
+
+_index = None
+_index_version = None
+# Сколько записей журнала изменений уже применено к индексу процесса
+_index_offset = 0
+_index_lock = threading.Lock()
+
+
+def invalidate_search_index():
+    """
+    Помечает индексы в памяти всех процессов устаревшими и очищает журнал изменений
+
+    Версия - случайный токен, а не счетчик: после очистки Redis счетчик начался
+    бы заново и мог совпасть с версией устаревшего индекса процесса.
+    """
+    with get_redis_connection('default').pipeline() as pipe:
+        pipe.set(cache.make_key(SEARCH_INDEX_VERSION_KEY), uuid.uuid4().hex)
+        pipe.delete(cache.make_key(SEARCH_INDEX_CHANGES_KEY))
+        pipe.execute()
+
+
+def search_index_changed(product_info_ids):
+    """
+    После коммита записывает измененные или удаленные товары в журнал изменений:
+    процессы переиндексируют только их. Слишком длинный журнал сбрасывает индексы целиком.
+    """
+    product_info_ids = list(product_info_ids)
+    if not product_info_ids or uses_postgres_search():
+        return
+
+    def log_changes():
+        if get_redis_connection('default').rpush(
+                cache.make_key(SEARCH_INDEX_CHANGES_KEY), *product_info_ids) > SEARCH_INDEX_MAX_CHANGES:
+            invalidate_search_index()
+
+    transaction.on_commit(log_changes)
+
+
+def read_search_index_changes(offset):
+    """
+    (версия индекса, длина журнала, id товаров из журнала начиная с offset) одной транзакцией
+    """
+    version_key = cache.make_key(SEARCH_INDEX_VERSION_KEY)
+    changes_key = cache.make_key(SEARCH_INDEX_CHANGES_KEY)
+    client = get_redis_connection('default')
+    with client.pipeline() as pipe:
+        pipe.get(version_key)
+        pipe.llen(changes_key)
+        pipe.lrange(changes_key, offset, -1)
+        version, length, changes = pipe.execute()
+    if version is None:
+        # Версии нет (первый запуск или очищенный Redis): журнал неполный, индексы строятся заново
+        client.set(version_key, uuid.uuid4().hex, nx=True)
+        return read_search_index_changes(offset)
+    return version, length, [int(product_info_id) for product_info_id in changes]
+
+
+def get_inverted_index():
+    """
+    Индекс текущего процесса
+
+    После изменения каталога применяются только новые записи журнала изменений,
+    целиком индекс перестраивается при смене версии (журнал сброшен).
+    """
+    global _index, _index_version, _index_offset
+    with _index_lock:
+        version, length, changes = read_search_index_changes(_index_offset)
+        if _index is None or _index_version != version or length < _index_offset:
+            # Длина журнала прочитана до построения: изменения, записанные во время
+            # построения, применятся повторно, переиндексация товара идемпотентна
+            _index = InvertedIndex.build()
+            _index_version, _index_offset = version, length
+        elif changes:
+            _index.refresh(changes)
+            _index_offset += len(changes)
+        return _index
+
+
+def inverted_index_search(queryset, text):
+    """
+    Поиск по индексу в памяти с фильтрами queryset
+
+    Фильтры применяются до усечения до SEARCH_MAX_RESULTS: если совпадений больше,
+    они проверяются по queryset пачками по релевантности, пока не наберется
+    SEARCH_MAX_RESULTS подходящих, иначе отфильтрованные товары вне первой пачки терялись бы.
+    """
+    matches = get_inverted_index().search(text, limit=None)
+    if len(matches) <= SEARCH_MAX_RESULTS:
+        results = matches
+    else:
+        results = []
+        for start in range(0, len(matches), SEARCH_MAX_RESULTS):
+            chunk = matches[start:start + SEARCH_MAX_RESULTS]
+            allowed = set(queryset.filter(id__in=[product_info_id for product_info_id, _ in chunk]).values_list(
+                'id', flat=True))
+            results.extend(match for match in chunk if match[0] in allowed)
+            if len(results) >= SEARCH_MAX_RESULTS:
+                break
+        results = results[:SEARCH_MAX_RESULTS]
+    if not results:
+        return queryset.none()
+    # Одно выражение CASE с параметрами вместо тысячи When(): компиляция запроса в разы быстрее
+    column = f'{connection.ops.quote_name(ProductInfo._meta.db_table)}.{connection.ops.quote_name("id")}'
+    params = [value for result in results for value in result]
+    rank = RawSQL(f'CASE {column} {" ".join(["WHEN %s THEN %s"] * len(results))} END', params,
+                  output_field=FloatField())
+    return queryset.filter(id__in=[product_info_id for product_info_id, _ in results]).annotate(
+        search_rank=rank
+    ).order_by('-search_rank', 'id')
+
+
+def search_products(queryset, text):
+    """
+    Поиск товаров по названию, модели и названию продукта с сортировкой по релевантности
+    """
+    if uses_postgres_search():
+        return postgres_search(queryset, text)
+    return inverted_index_search(queryset, text)
@@ -1,5 +1,11 @@
+from django.db.models.signals import pre_save, post_save, post_delete
 from django.dispatch import receiver
-from .models import new_user_registered
+from .cache_utils import (invalidate_tags_on_commit, product_tag, shop_tag, category_tag, product_scope_tags,
+                          CATEGORY_LIST_TAG, SHOP_LIST_TAG)
+from .catalog import refresh_catalog_entries
+from .facets import parse_number, schedule_facet_refresh
+from .models import new_user_registered, Shop, Category, Product, ProductInfo, ProductParameter, CatalogEntry
+from .search import update_search_vectors, search_index_changed
 from .tasks import send_confirmation_email
 
 @receiver(new_user_registered)
@@ -8,4 +14,175 @@ def handle_new_user_registration(sender, user_id, **kwargs):
     Обработчик сигнала новой регистрации - запускает асинхронную задачу
     """
     # Асинхронная отправка email
-    send_confirmation_email.delay(user_id)
\ No newline at end of file
+    send_confirmation_email.delay(user_id)
+
+@receiver(post_save, sender=ProductInfo)
+def update_product_info_search_vector(sender, instance, **kwargs):
+    """
+    Пересчет search_vector после сохранения товара
+    """
+    update_search_vectors(product_info_ids=[instance.pk])
+
+
+@receiver(post_save, sender=Product)
+def update_product_search_vectors(sender, instance, created, **kwargs):
+    """
+    Название продукта входит в search_vector всех его товаров
+    """
+    if not created:
+        update_search_vectors(product_ids=[instance.pk])
+
+
+@receiver(post_delete, sender=ProductInfo)
+def remove_product_info_from_search(sender, instance, **kwargs):
+    search_index_changed([instance.pk])
+
+
+@receiver(pre_save, sender=ProductParameter)
+def set_parameter_value_number(sender, instance, **kwargs):
+    instance.value_number = parse_number(instance.value)
+
+
+def product_info_scope(product_info):
+    """
+    (id магазина, id категории) товара
+
+    Запоминается на экземпляре: все обработчики сохранения товара обходятся одним
+    запросом, а если продукт уже загружен - ни одним.
+    """
+    key = (product_info.shop_id, product_info.product_id)
+    cached = getattr(product_info, '_scope', None)
+    if cached is None or cached[0] != key:
+        if ProductInfo.product.is_cached(product_info):
+            category_id = product_info.product.category_id if product_info.product else None
+        else:
+            category_id = Product.objects.filter(pk=product_info.product_id).values_list(
+                'category_id', flat=True).first()
+        cached = product_info._scope = (key, (product_info.shop_id, category_id))
+    return cached[1]
+
+
+def product_parameter_scope(product_parameter):
+    """
+    (id магазина, id категории) товара параметра или None, если товара уже нет
+
+    Как и product_info_scope, запоминается на экземпляре параметра.
+    """
+    if ProductParameter.product_info.is_cached(product_parameter):
+        return product_info_scope(product_parameter.product_info)
+    cached = getattr(product_parameter, '_scope', None)
+    if cached is None or cached[0] != product_parameter.product_info_id:
+        scope = ProductInfo.objects.filter(id=product_parameter.product_info_id).values_list(
+            'shop_id', 'product__category_id').first()
+        cached = product_parameter._scope = (product_parameter.product_info_id, scope)
+    return cached[1]
+
+
+@receiver(post_save, sender=ProductInfo)
+@receiver(post_delete, sender=ProductInfo)
+def refresh_product_info_facets(sender, instance, **kwargs):
+    shop_id, category_id = product_info_scope(instance)
+    schedule_facet_refresh(shop_id, [category_id] if category_id else None)
+
+
+@receiver(post_save, sender=ProductParameter)
+@receiver(post_delete, sender=ProductParameter)
+def refresh_product_parameter_facets(sender, instance, **kwargs):
+    # При каскадном удалении товара его уже может не быть: пересчет запланирует сам товар
+    scope = product_parameter_scope(instance)
+    if scope:
+        shop_id, category_id = scope
+        schedule_facet_refresh(shop_id, [category_id] if category_id else None)
+
+
+@receiver(post_save, sender=Product)
+def refresh_product_facets(sender, instance, created, **kwargs):
+    """
+    Смена категории продукта переносит его товары между счетчиками: пересчитываем магазины целиком
+    """
+    if created:
+        return
+    for shop_id in ProductInfo.objects.filter(product_id=instance.pk).values_list('shop_id', flat=True).distinct():
+        schedule_facet_refresh(shop_id)
+
+
+@receiver(post_save, sender=ProductInfo)
+def refresh_product_info_catalog_entry(sender, instance, **kwargs):
+    refresh_catalog_entries([instance.pk])
+
+
+@receiver(post_delete, sender=ProductInfo)
+def delete_product_info_catalog_entry(sender, instance, **kwargs):
+    CatalogEntry.objects.filter(id=instance.pk).delete()
+
+
+@receiver(post_save, sender=ProductParameter)
+@receiver(post_delete, sender=ProductParameter)
+def refresh_product_parameter_catalog_entry(sender, instance, **kwargs):
+    refresh_catalog_entries([instance.product_info_id])
+
+
+@receiver(post_save, sender=Product)
+def refresh_product_catalog_entries(sender, instance, created, **kwargs):
+    if not created:
+        refresh_catalog_entries(ProductInfo.objects.filter(product_id=instance.pk).values_list('id', flat=True))
+
+
+@receiver(post_save, sender=Category)
+def rename_category_catalog_entries(sender, instance, created, **kwargs):
+    if not created:
+        CatalogEntry.objects.filter(category_id=instance.pk).exclude(
+            category_name=instance.name).update(category_name=instance.name)
+
+
+@receiver(post_save, sender=Shop)
+def rename_shop_catalog_entries(sender, instance, created, **kwargs):
+    if not created:
+        CatalogEntry.objects.filter(shop_id=instance.pk).exclude(
+            shop_name=instance.name).update(shop_name=instance.name)
+
+
+def product_info_tags(product_info_ids):
+    """
+    Теги записей кеша, которые зависят от товаров: сами товары и все списки, куда они попадают
+    """
+    tags = []
+    for product_info_id, shop_id, category_id in ProductInfo.objects.filter(id__in=product_info_ids).values_list(
+            'id', 'shop_id', 'product__category_id'):
+        tags.append(product_tag(product_info_id))
+        tags.extend(product_scope_tags(shop_id, category_id))
+    return tags
+
+
+@receiver(post_save, sender=ProductInfo)
+@receiver(post_delete, sender=ProductInfo)
+def invalidate_product_info_caches(sender, instance, **kwargs):
+    invalidate_tags_on_commit(product_tag(instance.pk), *product_scope_tags(*product_info_scope(instance)))
+
+
+@receiver(post_save, sender=ProductParameter)
+@receiver(post_delete, sender=ProductParameter)
+def invalidate_product_parameter_caches(sender, instance, **kwargs):
+    # Магазин и категория уже найдены для пересчета фасетов и запомнены на экземпляре
+    scope = product_parameter_scope(instance)
+    if scope:
+        invalidate_tags_on_commit(product_tag(instance.product_info_id), *product_scope_tags(*scope))
+
+
+@receiver(post_save, sender=Product)
+def invalidate_product_related_caches(sender, instance, created, **kwargs):
+    if not created:
+        invalidate_tags_on_commit(*product_info_tags(
+            ProductInfo.objects.filter(product_id=instance.pk).values_list('id', flat=True)))
+
+
+@receiver(post_save, sender=Category)
+@receiver(post_delete, sender=Category)
+def invalidate_category_caches(sender, instance, created=False, **kwargs):
+    invalidate_tags_on_commit(CATEGORY_LIST_TAG if created else category_tag(instance.pk))
+
+
+@receiver(post_save, sender=Shop)
+@receiver(post_delete, sender=Shop)
+def invalidate_shop_caches(sender, instance, created=False, **kwargs):
+    invalidate_tags_on_commit(SHOP_LIST_TAG if created else shop_tag(instance.pk))
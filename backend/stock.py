@@ -0,0 +1,251 @@
+import time
+from collections import Counter
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connection
+from django.db.models import F
+from django_redis import get_redis_connection
+from redis.exceptions import WatchError
+
+from backend.cache_utils import invalidate_tags, product_tag
+from backend.exceptions import InventoryException
+from backend.models import OrderItem, ProductInfo
+
+# Резервы корзин: hash stock_hold:<product_info_id> с полями <user_id> -> удерживаемое
+# количество и HELD_FIELD -> их сумма; сроки резервов - в одном ZSET (<product_info_id>:<user_id>)
+HOLD_KEY_PREFIX = 'stock_hold'
+HOLD_EXPIRY_KEY = 'stock_hold_expiry'
+HELD_FIELD = 'held'
+HOLD_RELEASE_BATCH_SIZE = 500
+# Сколько раз повторяется транзакция WATCH/MULTI, если ключ товара изменили параллельно
+HOLD_MAX_RETRIES = 10
+
+
+def order_lines(order_id):
+    """
+    Количество товара в заказе по каждому ProductInfo: {product_info_id: количество}
+    """
+    lines = Counter()
+    for product_info_id, quantity in OrderItem.objects.filter(order_id=order_id).values_list(
+            'product_info_id', 'quantity'):
+        lines[product_info_id] += quantity
+    return lines
+
+
+def reserve_stock(lines, held=None):
+    """
+    Списывает остатки {product_info_id: количество} условным UPDATE на каждую строку
+
+    Проверка и списание - одна операция в БД, поэтому параллельные заказы не уводят
+    остаток в минус. Строки блокируются по возрастанию id, чтобы встречные заказы
+    не взаимоблокировались. Единицы, удерживаемые чужими корзинами (held), не списываются.
+    Вызывается внутри transaction.atomic: при первой нехватке бросает InventoryException,
+    и транзакция откатывает уже списанные строки. UPDATE не проходит через сигналы cacheops -
+    после списания вызывающий код должен вызвать stock_changed, он сбрасывает и кеш cacheops.
+    """
+    held = held or {}
+    for product_info_id in sorted(lines):
+        quantity = lines[product_info_id]
+        updated = ProductInfo.objects.filter(
+            id=product_info_id, quantity__gte=quantity + held.get(product_info_id, 0)
+        ).update(quantity=F('quantity') - quantity)
+        if not updated:
+            raise InventoryException('Недостаточно товаров на складе', code='insufficient_stock',
+                                     extra_context={'product_info_id': product_info_id})
+
+
+def unavailable_items(lines, held=None):
+    """
+    Строки заказа, которых сейчас не хватает на складе, в формате ответа API
+    """
+    held = held or {}
+    rows = ProductInfo.objects.filter(id__in=list(lines)).order_by('id').values_list('id', 'name', 'quantity')
+    available = {product_info_id: (name, max(quantity - held.get(product_info_id, 0), 0))
+                 for product_info_id, name, quantity in rows}
+    return [{'product': name, 'available': quantity, 'requested': lines[product_info_id]}
+            for product_info_id, (name, quantity) in available.items() if quantity < lines[product_info_id]]
+
+
+def restore_stock(lines):
+    """
+    Возвращает на склад {product_info_id: количество} одним UPDATE ... FROM (VALUES ...)
+
+    Вызывается внутри transaction.atomic. Строки сначала блокируются по возрастанию id,
+    в том же порядке, что и в reserve_stock, иначе встречные отмена и заказ могли бы
+    взаимоблокироваться: порядок строк в UPDATE с JOIN не определен. Как и после
+    reserve_stock, кеш (в том числе cacheops) сбрасывает stock_changed.
+    """
+    if not lines:
+        return
+    product_info_ids = sorted(lines)
+    list(ProductInfo.objects.select_for_update().filter(id__in=product_info_ids).order_by('id').values_list(
+        'id', flat=True))
+    table = connection.ops.quote_name(ProductInfo._meta.db_table)
+    values = ', '.join(['(%s, %s)'] * len(product_info_ids))
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f'UPDATE {table} SET quantity = {table}.quantity + delta.column2 '
+            f'FROM (VALUES {values}) AS delta WHERE {table}.id = delta.column1',
+            [value for product_info_id in product_info_ids for value in (product_info_id, lines[product_info_id])])
+
+
+def holds_enabled():
+    return settings.STOCK_HOLD_TIMEOUT > 0
+
+
+def hold_key(product_info_id):
+    return cache.make_key(f'{HOLD_KEY_PREFIX}:{product_info_id}')
+
+
+def hold_expiry_key():
+    return cache.make_key(HOLD_EXPIRY_KEY)
+
+
+def held_quantities(product_info_ids):
+    """
+    Количество, удерживаемое корзинами, {product_info_id: количество} одним запросом к Redis
+    """
+    product_info_ids = list(product_info_ids)
+    if not holds_enabled() or not product_info_ids:
+        return {}
+    with get_redis_connection('default').pipeline(transaction=False) as pipe:
+        for product_info_id in product_info_ids:
+            pipe.hget(hold_key(product_info_id), HELD_FIELD)
+        values = pipe.execute()
+    return {product_info_id: int(value) for product_info_id, value in zip(product_info_ids, values) if value}
+
+
+def held_by_others(user_id, product_info_ids):
+    """
+    Количество, удерживаемое корзинами других пользователей, {product_info_id: количество}
+    """
+    product_info_ids = list(product_info_ids)
+    if not holds_enabled() or not product_info_ids:
+        return {}
+    with get_redis_connection('default').pipeline(transaction=False) as pipe:
+        for product_info_id in product_info_ids:
+            pipe.hmget(hold_key(product_info_id), str(user_id), HELD_FIELD)
+        values = pipe.execute()
+    return {product_info_id: int(held or 0) - int(own or 0)
+            for product_info_id, (own, held) in zip(product_info_ids, values) if held}
+
+
+def hold_stock(product_info_id, user_id, quantity, stock):
+    """
+    Удерживает за корзиной пользователя quantity единиц товара на STOCK_HOLD_TIMEOUT секунд
+
+    quantity - все количество товара в корзине: прежний резерв пользователя заменяется
+    и продлевается. Сумма резервов не превышает остаток stock - проверка и запись идут
+    в транзакции WATCH/MULTI по ключу товара. При нехватке бросает InventoryException
+    с доступным пользователю количеством в extra_context.
+    """
+    if not holds_enabled():
+        return
+    key = hold_key(product_info_id)
+    field = str(user_id)
+    with get_redis_connection('default').pipeline() as pipe:
+        for _ in range(HOLD_MAX_RETRIES):
+            try:
+                pipe.watch(key)
+                own, held = (int(value or 0) for value in pipe.hmget(key, field, HELD_FIELD))
+                available = max(stock - (held - own), 0)
+                if quantity > available:
+                    pipe.unwatch()
+                    raise InventoryException('Недостаточно товаров на складе с учетом резервов',
+                                             code='stock_held', extra_context={'available': available})
+                pipe.multi()
+                pipe.hset(key, mapping={field: quantity, HELD_FIELD: held - own + quantity})
+                # Страховка, если снятие резервов не запускается: ключ живет дольше любого резерва в нем
+                pipe.expire(key, settings.STOCK_HOLD_TIMEOUT * 2)
+                expires = time.time() + settings.STOCK_HOLD_TIMEOUT
+                pipe.zadd(hold_expiry_key(), {f'{product_info_id}:{user_id}': expires})
+                pipe.execute()
+                break
+            except WatchError:
+                continue
+        else:
+            raise InventoryException('Не удалось зарезервировать товар, повторите попытку', code='stock_held')
+    invalidate_tags(product_tag(product_info_id))
+
+
+def _release(holds, expired_before=None):
+    """
+    Снимает резервы [(product_info_id, user_id)] одной транзакцией WATCH/MULTI по их ключам
+
+    С expired_before снимаются только резервы, не продленные после этого момента.
+    Возвращает id товаров, по которым снят резерв, или None, если ключи все время менялись.
+    """
+    keys = [hold_key(product_info_id) for product_info_id, _ in holds]
+    members = [f'{product_info_id}:{user_id}' for product_info_id, user_id in holds]
+    client = get_redis_connection('default')
+    with client.pipeline() as pipe:
+        for _ in range(HOLD_MAX_RETRIES):
+            try:
+                pipe.watch(*set(keys))
+                # Ключи уже под WATCH, поэтому читать можно одним пакетом через другое соединение
+                with client.pipeline(transaction=False) as reads:
+                    for (product_info_id, user_id), key, member in zip(holds, keys, members):
+                        reads.hmget(key, str(user_id), HELD_FIELD)
+                        reads.zscore(hold_expiry_key(), member)
+                    values = reads.execute()
+                pipe.multi()
+                totals = {}
+                released = []
+                for index, ((product_info_id, user_id), key, member) in enumerate(zip(holds, keys, members)):
+                    (own, held), expires = values[2 * index], values[2 * index + 1]
+                    if expired_before is not None and expires is not None and expires > expired_before:
+                        continue
+                    pipe.zrem(hold_expiry_key(), member)
+                    if own is None:
+                        continue
+                    totals[key] = totals.get(key, int(held or 0)) - int(own)
+                    pipe.hdel(key, str(user_id))
+                    released.append(int(product_info_id))
+                for key, held in totals.items():
+                    if held > 0:
+                        pipe.hset(key, HELD_FIELD, held)
+                    else:
+                        pipe.hdel(key, HELD_FIELD)
+                pipe.execute()
+                return released
+            except WatchError:
+                continue
+    return None
+
+
+def release_holds(user_id, product_info_ids):
+    """
+    Снимает резервы пользователя по товарам: товар удален из корзины или заказ подтвержден
+    """
+    product_info_ids = set(product_info_ids)
+    if not holds_enabled() or not product_info_ids:
+        return
+    released = _release([(product_info_id, user_id) for product_info_id in product_info_ids])
+    if released:
+        invalidate_tags(*[product_tag(product_info_id) for product_info_id in released])
+
+
+def release_expired_holds(batch_size=HOLD_RELEASE_BATCH_SIZE):
+    """
+    Снимает истекшие резервы пакетами по batch_size
+
+    Истекшие резервы выбираются из ZSET сроков по диапазону, поэтому работа
+    пропорциональна числу истекших резервов, а не всех корзин.
+    """
+    client = get_redis_connection('default')
+    now = time.time()
+    released = 0
+    while True:
+        members = client.zrangebyscore(hold_expiry_key(), '-inf', now, start=0, num=batch_size)
+        if not members:
+            break
+        product_info_ids = _release([member.decode().split(':') for member in members], expired_before=now)
+        if product_info_ids is None:
+            break
+        released += len(product_info_ids)
+        if product_info_ids:
+            invalidate_tags(*[product_tag(product_info_id) for product_info_id in set(product_info_ids)])
+        if len(members) < batch_size:
+            break
+    return released
@@ -1,13 +1,34 @@
-from celery import shared_task
+from celery import shared_task, chord
+from celery.exceptions import Retry
 from django.core.mail import send_mail
 from django.conf import settings
 from django.utils import timezone
 from datetime import timedelta
-from .models import User, ConfirmEmailToken, ProductImage
+from .models import User, ConfirmEmailToken, ProductImage, Shop
 from PIL import Image, ImageOps
 from io import BytesIO
 from django.core.files.images import ImageFile
+from django.core.files import File
+from django.core.files.storage import default_storage
+from django.db import transaction
+from functools import partial
+from .feed_fetch import download_feed, is_feed_unchanged, remember_feed, FeedDownload, FEED_DOWNLOAD_TIMEOUT
+from .feed_parsers import read_feed, detect_feed_format
+from .feed_shards import split_feed, iter_shard_goods, count_goods
+from .feed_validation import FeedValidator
+from .importer import PriceListImporter, ShardImporter, finish_sharded_import
+from .facets import refresh_facet_counts
+from .import_jobs import ImportJob, PHASE_DOWNLOADING, PHASE_PARSING, PHASE_IMPORTING
+from .import_locks import shop_import_lock, acquire_import_slot
+from .stock import release_expired_holds
+from .carts import flush_dirty_carts
 import os
+import random
+
+# Сколько раз импорт откладывается, пока магазин занят другим импортом
+IMPORT_MAX_RETRIES = 30
+# Средняя задержка перед повторной попыткой, секунды
+IMPORT_RETRY_DELAY = 60
 
 
 @shared_task(bind=True, max_retries=3)
@@ -224,4 +245,284 @@ def cleanup_orphaned_images():
         return f"Удалено {count} orphaned изображений"
 
     except Exception as e:
-        return f"Ошибка при очистке изображений: {str(e)}"
\ No newline at end of file
+        return f"Ошибка при очистке изображений: {str(e)}"
+
+
+@shared_task(bind=True, max_retries=None)
+def import_price_list(self, job_id):
+    """
+    Фоновая загрузка, разбор и запись прайса поставщика с отчетом о прогрессе
+
+    Импорт одного магазина не пересекается с другим импортом того же магазина,
+    а число одновременных разборов и записей ограничено CATALOG_IMPORT_MAX_CONCURRENT.
+    Пока магазин занят, задача откладывается не более IMPORT_MAX_RETRIES раз;
+    ожидание слота не ограничено: слоты освобождаются по завершении импортов или по TTL.
+    """
+    job = ImportJob.get(job_id)
+    if job is None:
+        return f"Задача импорта {job_id} не найдена"
+
+    shop_lock = shop_import_lock(job.user_id, job_id)
+    # Проверка прайса ничего не пишет и может идти параллельно с импортом
+    if not job.state.get('dry_run') and not shop_lock.acquire():
+        if job.state.get('scheduled'):
+            # Магазин уже обновляется, плановый импорт не нужен
+            job.skip('locked')
+            return f"Импорт {job_id} пропущен: магазин уже импортируется"
+        # Ожидания слота в этот счетчик не входят, поэтому request.retries не подходит
+        job.state['lock_waits'] = job.state.get('lock_waits', 0) + 1
+        if job.state['lock_waits'] > IMPORT_MAX_RETRIES:
+            job.fail('Магазин уже импортируется')
+            return f"Ошибка импорта {job_id}: магазин уже импортируется"
+        job.save()
+        _postpone_import(self)
+
+    try:
+        return _run_import(self, job, shop_lock)
+    except Retry:
+        shop_lock.release()
+        raise
+    finally:
+        # Параллельный импорт еще идет: блокировку магазина снимет finish_feed_import
+        if job.is_finished:
+            shop_lock.release()
+
+
+def _postpone_import(task):
+    """
+    Откладывает задачу импорта со случайной задержкой
+    """
+    raise task.retry(countdown=random.uniform(IMPORT_RETRY_DELAY / 2, IMPORT_RETRY_DELAY))
+
+
+def _extending_progress(progress, *locks):
+    """
+    Отчет о прогрессе, который заодно продлевает блокировки: долгий импорт не теряет их по TTL
+    """
+    def report(*args):
+        for lock in locks:
+            lock.extend()
+        progress(*args)
+    return report
+
+
+def _run_import(task, job, shop_lock):
+    """
+    Загрузка и запись прайса; неизменившийся прайс пропускается
+
+    Слот импорта занимается после условного запроса: 304 или тот же хеш слот не держат.
+    """
+    try:
+        shop = Shop.objects.filter(user_id=job.user_id).first()
+        dry_run = job.state.get('dry_run')
+        force = job.state.get('force') or dry_run
+
+        job.set_phase(PHASE_DOWNLOADING)
+        with download_feed(job.state['url'], None if force else shop,
+                           timeout=FEED_DOWNLOAD_TIMEOUT) as download:
+            if not force and is_feed_unchanged(shop, download):
+                if not download.not_modified:
+                    remember_feed(shop, download)
+                reason = 'not_modified' if download.not_modified else 'same_hash'
+                job.skip(reason)
+                return f"Импорт {job.id} пропущен: прайс не изменился ({reason})"
+
+            slot = acquire_import_slot(job.id)
+            if slot is None:
+                _postpone_import(task)
+            try:
+                return _import_download(job, download, _extending_progress(job.set_progress, shop_lock, slot))
+            finally:
+                slot.release()
+
+    except Retry:
+        raise
+    except Exception as e:
+        job.fail(str(e))
+        return f"Ошибка импорта {job.id}: {str(e)}"
+
+
+def _import_download(job, download, progress):
+    """
+    Разбор и запись загруженного прайса (или его проверка, или запуск шардов)
+    """
+    feed_format = job.state.get('feed_format') or detect_feed_format(
+        job.state['url'], download.content_type
+    )
+    job.set_phase(PHASE_PARSING, rows_total=count_goods(download.file, feed_format))
+    if job.state.get('dry_run'):
+        report = FeedValidator().validate(download.file, feed_format)
+        job.finish_validation(report)
+        return f"Проверка {job.id}: строк {report['rows']}, ошибок {report['error_count']}"
+
+    if job.state.get('shards', 1) > 1:
+        _dispatch_shards(job, download, feed_format)
+        return f"Импорт {job.id} разделен на {job.state['shard_count']} шардов"
+
+    data = read_feed(download.file, feed_format)
+
+    job.set_phase(PHASE_IMPORTING)
+    importer = PriceListImporter(job.user_id, progress=progress, **job.state['options'])
+    stats = importer.run(data)
+    remember_feed(importer.shop, download)
+
+    job.finish(stats)
+    return f"Импорт {job.id} завершен: {stats}"
+
+
+def _dispatch_shards(job, download, feed_format):
+    """
+    Создает магазин и категории, сохраняет прайс в хранилище
+    и запускает импорт шардов аккордом Celery
+    """
+    importer = PriceListImporter(job.user_id)
+    with transaction.atomic():
+        importer.import_header(read_feed(download.file, feed_format))
+
+    prefix, ranges = split_feed(download.file, feed_format, job.state['shards'])
+    download.file.seek(0)
+    path = default_storage.save(f"imports/{job.id}.{feed_format}", File(download.file))
+
+    job.state['shard_plan'] = {
+        'path': path,
+        'format': feed_format,
+        'prefix': prefix,
+        'shop_id': importer.shop.id,
+        'stats': importer.stats,
+        'feed': {
+            'content_hash': download.content_hash,
+            'etag': download.etag,
+            'last_modified': download.last_modified,
+        },
+    }
+    job.state['shard_count'] = len(ranges)
+    job.set_phase(PHASE_IMPORTING)
+    chord(
+        import_feed_shard.s(job.id, number, start, end) for number, (start, end) in enumerate(ranges)
+    )(finish_feed_import.s(job.id))
+
+
+def _shard_result(importer=None, error=None):
+    # Встреченные id шард пишет в множество задачи (ImportJob.claim_rows), а не в результат аккорда
+    return {
+        'error': error,
+        'stats': importer.stats if importer else {},
+    }
+
+
+@shared_task(bind=True, max_retries=None)
+def import_feed_shard(self, job_id, number, start, end):
+    """
+    Импорт одного диапазона байт прайса при параллельном импорте
+
+    Ошибка не прерывает аккорд, а возвращается в результате,
+    чтобы finish_feed_import все равно снял блокировку и сбросил кеш.
+    """
+    job = ImportJob.get(job_id)
+    if job is None:
+        return _shard_result(error=f"Задача импорта {job_id} не найдена")
+
+    token = f"{job_id}:{number}"
+    slot = acquire_import_slot(token)
+    if slot is None:
+        _postpone_import(self)
+
+    importer = None
+    try:
+        plan = job.state['shard_plan']
+        # Блокировку магазина держит весь аккорд, поэтому ее продлевает каждый шард
+        progress = _extending_progress(partial(job.set_shard_progress, number),
+                                       shop_import_lock(job.user_id, job_id), slot)
+        importer = ShardImporter(job.user_id, plan['shop_id'], job.claim_rows, progress=progress)
+        with default_storage.open(plan['path'], 'rb') as feed:
+            importer.run(iter_shard_goods(feed, plan['format'], plan['prefix'], start, end))
+        return _shard_result(importer)
+    except Exception as e:
+        return _shard_result(importer, error=f"Шард {number}: {str(e)}")
+    finally:
+        slot.release()
+
+
+@shared_task
+def finish_feed_import(results, job_id):
+    """
+    Завершение параллельного импорта: снятие с продажи отсутствующих товаров,
+    один сброс кеша и освобождение блокировки магазина
+    """
+    job = ImportJob.get(job_id)
+    if job is None:
+        return f"Задача импорта {job_id} не найдена"
+
+    plan = job.state['shard_plan']
+    errors = [result['error'] for result in results if result['error']]
+    try:
+        # Если часть шардов упала, отсутствующие товары не снимаются:
+        # они могли быть в непрочитанной части прайса
+        stats = finish_sharded_import(
+            job.user_id, plan['shop_id'],
+            [plan['stats'], *(result['stats'] for result in results)],
+            job.iter_seen(), job.seen_count(),
+            retire=not errors,
+        )
+        if errors:
+            job.state['stats'] = stats
+            job.fail('; '.join(errors))
+            return f"Ошибка импорта {job_id}: {'; '.join(errors)}"
+
+        remember_feed(Shop.objects.get(id=plan['shop_id']), FeedDownload(job.state['url'], **plan['feed']))
+        job.finish(stats)
+        return f"Импорт {job_id} завершен: {stats}"
+
+    except Exception as e:
+        job.fail(str(e))
+        return f"Ошибка импорта {job_id}: {str(e)}"
+    finally:
+        default_storage.delete(plan['path'])
+        job.clear_seen()
+        shop_import_lock(job.user_id, job_id).release()
+
+
+@shared_task
+def refresh_facets(shop_id, category_ids=None):
+    """
+    Пересчет счетчиков фасетов после изменения товаров вне импорта (админка, API)
+    """
+    return refresh_facet_counts(shop_id, category_ids)
+
+
+@shared_task
+def refresh_shop_catalogs():
+    """
+    Плановое обновление прайсов всех магазинов с заполненным url
+
+    Запуск импортов случайно разносится по окну CATALOG_REFRESH_JITTER,
+    неизменившиеся прайсы отсекаются условным запросом в import_price_list.
+    """
+    shops = Shop.objects.filter(
+        user__is_active=True, user__type='shop', url__isnull=False
+    ).exclude(url='').values_list('user_id', 'url')
+
+    queued = 0
+    for user_id, url in shops.iterator():
+        if shop_import_lock(user_id, None).is_locked():
+            continue
+        job = ImportJob.create(user_id, url, scheduled=True)
+        import_price_list.apply_async((job.id,), countdown=random.uniform(0, settings.CATALOG_REFRESH_JITTER))
+        queued += 1
+    return f"Поставлено в очередь {queued} обновлений прайсов"
+
+
+@shared_task
+def release_expired_stock_holds():
+    """
+    Снимает истекшие резервы товаров в корзинах пакетами по HOLD_RELEASE_BATCH_SIZE
+    """
+    return f"Снято резервов: {release_expired_holds()}"
+
+
+@shared_task
+def flush_carts():
+    """
+    Сохраняет в Order/OrderItem корзины, измененные в Redis с последнего запуска
+    """
+    return f"Сохранено корзин: {flush_dirty_carts()}"
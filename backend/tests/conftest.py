@@ -7,12 +7,35 @@ if not settings.configured:
     django.setup()
 
 from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from backend.local_cache import local_cache
 from rest_framework.test import APIClient
+from redis.exceptions import ConnectionError as RedisConnectionError
 from model_bakery import baker
 from backend.models import Shop, Category, Product, ProductInfo  # Добавьте импорт моделей
 
 User = get_user_model()
 
+@pytest.fixture(autouse=True)
+def clear_cache():
+    # Ответы view и счетчики троттлинга живут в Redis и не откатываются вместе с транзакцией теста
+    cache.clear()
+    local_cache.clear()
+
+
+@pytest.fixture
+def cacheops_enabled(settings):
+    # Кеш запросов cacheops; тест пропускается, если его Redis недоступен
+    from cacheops import invalidate_all
+    settings.CACHEOPS_ENABLED = True
+    try:
+        invalidate_all()
+    except RedisConnectionError:
+        pytest.skip('Redis cacheops недоступен')
+    yield
+    invalidate_all()
+
+
 @pytest.fixture
 def api_client():
     return APIClient()
@@ -0,0 +1,403 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+from unittest.mock import MagicMock
+
+import pytest
+from django.core.cache import cache
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from django_redis import get_redis_connection
+from redis.exceptions import ConnectionError as RedisConnectionError, TimeoutError as RedisTimeoutError
+from model_bakery import baker
+from rest_framework import status
+from rest_framework.response import Response
+from rest_framework.test import APIRequestFactory, force_authenticate
+from rest_framework.views import APIView
+
+from backend.cache_utils import (add_cache_tags, cached_function, invalidate_tags, tag_key, shop_tag,
+                                 product_list_tag, product_scope_tags, generate_cache_key, get_generations,
+                                 bump_generation, shop_namespace, cached_call, recompute_lock, needs_refresh,
+                                 cache_metrics, local_key, cached_view, render_response, response_from_bytes,
+                                 CATEGORY_LIST_TAG, CATALOG_NAMESPACE)
+from backend.local_cache import LocalCache, local_cache, INVALIDATION_CHANNEL
+from backend.models import Shop, Category, Product, ProductInfo, Parameter, ProductParameter
+
+
+def tagged_keys(tag):
+    return get_redis_connection('default').smembers(tag_key(tag))
+
+
+class TestCacheTags:
+    def test_invalidate_only_tagged_entries(self):
+        """Тест что инвалидация удаляет только записи своего тега"""
+        calls = []
+
+        @cached_function(timeout=60, key_prefix='test_shop_entry')
+        def load(shop_id):
+            calls.append(shop_id)
+            add_cache_tags(shop_tag(shop_id))
+            return shop_id
+
+        load(1), load(2), load(1)
+        assert calls == [1, 2]
+
+        assert invalidate_tags(shop_tag(1)) == 1
+        assert not tagged_keys(shop_tag(1))
+        load(1), load(2)
+        assert calls == [1, 2, 1]
+
+    def test_nested_entry_tags_propagate(self):
+        """Тест что зависимости вложенной записи становятся зависимостями внешней"""
+        @cached_function(timeout=60, key_prefix='test_inner')
+        def inner():
+            add_cache_tags(shop_tag(5))
+            return 'inner'
+
+        @cached_function(timeout=60, key_prefix='test_outer')
+        def outer():
+            return inner() + ':outer'
+
+        outer()
+        assert len(tagged_keys(shop_tag(5))) == 2
+
+    def test_product_scope_tags(self):
+        """Тест списков, в которые попадает товар"""
+        assert set(product_scope_tags(1, 2)) == {'products:1:2', 'products:1:all',
+                                                 'products:all:2', 'products:all:all'}
+        assert product_list_tag('3', None) == 'products:3:all'
+
+
+class TestCacheNamespaces:
+    def test_bump_changes_only_own_keys(self):
+        """Тест что смена поколения меняет ключи только своего пространства имен"""
+        shop_key = generate_cache_key('page', 1, namespaces=[CATALOG_NAMESPACE, shop_namespace(1)])
+        other_key = generate_cache_key('page', 2, namespaces=[CATALOG_NAMESPACE, shop_namespace(2)])
+
+        bump_generation(shop_namespace(1))
+
+        assert generate_cache_key('page', 1, namespaces=[CATALOG_NAMESPACE, shop_namespace(1)]) != shop_key
+        assert generate_cache_key('page', 2, namespaces=[CATALOG_NAMESPACE, shop_namespace(2)]) == other_key
+
+    def test_missing_generation_does_not_restart_from_zero(self):
+        """Тест что поколение после вытеснения счетчика не повторяет старое"""
+        old = bump_generation(CATALOG_NAMESPACE)[CATALOG_NAMESPACE]
+        cache.delete('cache_generation:catalog')
+        local_cache.clear()
+
+        assert get_generations([CATALOG_NAMESPACE])[CATALOG_NAMESPACE] > old
+
+    def test_cached_function_namespace(self):
+        """Тест инвалидации записей cached_function сменой поколения"""
+        calls = []
+
+        @cached_function(timeout=60, key_prefix='test_namespace', namespaces=[CATALOG_NAMESPACE])
+        def load():
+            calls.append(1)
+            return len(calls)
+
+        assert (load(), load()) == (1, 1)
+        bump_generation(CATALOG_NAMESPACE)
+        assert load() == 2
+
+
+class TestCacheStampede:
+    @staticmethod
+    def counter(calls, delay=0.0):
+        def compute():
+            time.sleep(delay)
+            calls.append(1)
+            return len(calls)
+        return compute
+
+    def test_concurrent_misses_compute_once(self):
+        """Тест что одновременные промахи по одному ключу пересчитывает один воркер"""
+        calls = []
+        compute = self.counter(calls, delay=0.3)
+        coalesced = cache_metrics.coalesced
+
+        with ThreadPoolExecutor(max_workers=5) as executor:
+            results = list(executor.map(lambda _: cached_call('test_stampede', 60, compute), range(5)))
+
+        assert results == [1] * 5
+        assert len(calls) == 1
+        assert cache_metrics.coalesced - coalesced == 4
+
+    def test_stale_served_while_recomputing(self):
+        """Тест что истекшая запись отдается, пока ее пересчитывает другой воркер"""
+        calls = []
+        cache.set('test_stale', {'value': 'old', 'expires': time.time() - 1, 'delta': 0.1}, 60)
+        lock = recompute_lock('test_stale')
+        assert lock.acquire()
+        stale_served = cache_metrics.stale_served
+
+        assert cached_call('test_stale', 60, self.counter(calls)) == 'old'
+        assert cache_metrics.stale_served - stale_served == 1
+
+        lock.release()
+        recomputed = cache_metrics.recomputed
+        assert cached_call('test_stale', 60, self.counter(calls)) == 1
+        assert cache_metrics.recomputed - recomputed == 1
+        assert cached_call('test_stale', 60, self.counter(calls)) == 1
+
+    def test_early_refresh_probability(self, monkeypatch):
+        """Тест досрочного пересчета: раньше срока, если пересчет долгий"""
+        monkeypatch.setattr('backend.cache_utils.random.random', lambda: 0.5)
+        now = time.time()
+
+        assert needs_refresh({'expires': now + 1, 'delta': 10}, now)
+        assert not needs_refresh({'expires': now + 1, 'delta': 0.01}, now)
+        assert needs_refresh({'expires': now - 1, 'delta': 0}, now)
+
+
+class TestLocalCache:
+    def test_lru_eviction_and_ttl(self):
+        """Тест вытеснения давно не читанной записи и истечения TTL"""
+        local = LocalCache(max_entries=2, timeout=60)
+        local.set('a', 1)
+        local.set('b', 2)
+        local.get('a')
+        local.set('c', 3)
+        assert (local.get('a'), local.get('b'), local.get('c')) == (1, None, 3)
+
+        local.set('d', 4, timeout=0.05)
+        time.sleep(0.1)
+        assert local.get('d') is None
+
+    def test_cached_function_served_from_l1(self):
+        """Тест что повторное чтение не доходит до Redis"""
+        calls = []
+
+        @cached_function(timeout=60, key_prefix='test_l1')
+        def load():
+            calls.append(1)
+            return 'value'
+
+        load()
+        cache.clear()
+        l1_hits = cache_metrics.l1_hits
+
+        assert load() == 'value'
+        assert calls == [1]
+        assert cache_metrics.l1_hits - l1_hits == 1
+
+    def test_invalidation_message_from_other_process(self):
+        """Тест что сообщение другого процесса удаляет запись из L1"""
+        key = local_key('test_l1_message')
+        local_cache.set(key, 'value')
+        redis = get_redis_connection('default')
+
+        # Слушатель подписывается в отдельном потоке: повторяем сообщение, пока он не подключится
+        deadline = time.monotonic() + 5
+        while local_cache.get(key) is not None and time.monotonic() < deadline:
+            redis.publish(INVALIDATION_CHANNEL, key)
+            time.sleep(0.05)
+
+        assert local_cache.get(key) is None
+
+    @staticmethod
+    def start_listener(monkeypatch, pubsub):
+        monkeypatch.setattr('backend.local_cache.get_redis_connection', lambda alias: MagicMock(
+            pubsub=MagicMock(return_value=pubsub)))
+        monkeypatch.setattr('backend.local_cache.LISTENER_POLL_TIMEOUT', 0.01)
+        local = LocalCache(max_entries=10, timeout=60)
+        local.set('key', 'value')
+        return local
+
+    def test_idle_channel_keeps_entries(self, monkeypatch):
+        """Тест что тишина в канале дольше таймаута сокета не очищает L1"""
+        pubsub = MagicMock()
+        pubsub.get_message.side_effect = lambda timeout: time.sleep(timeout)
+        # Блокирующий listen() на пуле с SOCKET_TIMEOUT падал бы на тихом канале
+        pubsub.listen.side_effect = RedisTimeoutError('Timeout reading from socket')
+        local = self.start_listener(monkeypatch, pubsub)
+
+        time.sleep(0.2)
+
+        assert pubsub.get_message.call_count > 1
+        assert local.get('key') == 'value'
+
+    def test_disconnect_clears_entries(self, monkeypatch):
+        """Тест что при обрыве соединения L1 очищается: сообщения могли потеряться"""
+        pubsub = MagicMock()
+        pubsub.get_message.side_effect = RedisConnectionError('Connection closed by server')
+        local = self.start_listener(monkeypatch, pubsub)
+
+        deadline = time.monotonic() + 5
+        while (len(local) or not pubsub.close.called) and time.monotonic() < deadline:
+            time.sleep(0.01)
+
+        assert len(local) == 0
+        pubsub.close.assert_called()
+
+
+class UserEchoView(APIView):
+    calls = []
+
+    @cached_view(timeout=60, key_prefix='test_user_echo', vary_on_user=True)
+    def get(self, request):
+        self.calls.append(request.user.id)
+        return Response({'user': request.user.id})
+
+
+class TestResponseCache:
+    def test_rendered_bytes_round_trip(self):
+        """Тест хранения ответа в виде байтов со статусом, Content-Type и ETag"""
+        value = render_response(Response({'Status': True}))
+        assert isinstance(value, bytes)
+
+        response = response_from_bytes(value)
+        assert response.status_code == 200
+        assert response['Content-Type'] == 'application/json'
+        assert response.content == b'{"Status":true}'
+        assert response['ETag'].startswith('"')
+        assert render_response(Response({'Status': False}, status=400)) is None
+
+    def test_rendered_bytes_keep_vary(self):
+        """Тест что Vary хранится вместе с телом, а прочие заголовки нет"""
+        original = Response({'Status': True}, headers={'Vary': 'Accept', 'X-Request-Id': '1'})
+
+        response = response_from_bytes(render_response(original))
+
+        assert response['Vary'] == 'Accept'
+        assert not response.has_header('X-Request-Id')
+
+    @pytest.mark.django_db
+    def test_cache_hit_keeps_vary(self, api_client):
+        """Тест что ответ из кеша и 304 сохраняют Vary: Accept, выставленный DRF"""
+        baker.make(Category, name='Смартфоны')
+        recomputed = cache_metrics.misses
+        first = api_client.get('/categories/')
+        second = api_client.get('/categories/')
+        not_modified = api_client.get('/categories/', HTTP_IF_NONE_MATCH=first['ETag'])
+
+        assert cache_metrics.misses == recomputed + 1
+        assert 'Accept' in first['Vary']
+        assert second['Vary'] == first['Vary']
+        assert not_modified['Vary'] == first['Vary']
+
+    @pytest.mark.django_db
+    def test_etag_and_not_modified(self, api_client):
+        """Тест ETag и ответа 304 на совпадающий If-None-Match"""
+        baker.make(Category, name='Смартфоны')
+        first = api_client.get('/categories/')
+        second = api_client.get('/categories/')
+
+        assert first['ETag'] == second['ETag']
+        assert first.content == second.content
+        assert 'Authorization' not in first.get('Vary', '')
+
+        not_modified = api_client.get('/categories/', HTTP_IF_NONE_MATCH=first['ETag'])
+        assert not_modified.status_code == status.HTTP_304_NOT_MODIFIED
+        assert not_modified.content == b''
+        assert not_modified['ETag'] == first['ETag']
+
+    @pytest.mark.django_db
+    def test_shared_between_users(self, api_client, authenticated_buyer_client):
+        """Тест что ответ, не зависящий от пользователя, кешируется один раз для всех"""
+        first = api_client.get('/shops/')
+        recomputed = cache_metrics.misses
+
+        assert authenticated_buyer_client.get('/shops/')['ETag'] == first['ETag']
+        assert cache_metrics.misses == recomputed
+
+    @pytest.mark.django_db
+    def test_vary_on_user(self, buyer_user, shop_user):
+        """Тест отдельной записи на пользователя для view, зависящего от пользователя"""
+        UserEchoView.calls = []
+        factory = APIRequestFactory()
+        responses = []
+        for user in (buyer_user, shop_user, buyer_user):
+            request = factory.get('/echo/')
+            force_authenticate(request, user=user)
+            responses.append(UserEchoView.as_view()(request))
+
+        assert UserEchoView.calls == [buyer_user.id, shop_user.id]
+        assert [response.content for response in responses] == [
+            f'{{"user":{user.id}}}'.encode() for user in (buyer_user, shop_user, buyer_user)]
+        assert 'Authorization' in responses[0]['Vary']
+
+
+class TestViewCacheInvalidation:
+    @pytest.fixture
+    def product_info(self):
+        return baker.make(ProductInfo, quantity=5, price=100, shop=baker.make(Shop),
+                          product=baker.make(Product, category=baker.make(Category)))
+
+    @pytest.mark.django_db
+    def test_product_change_invalidates_list_pages(self, api_client, product_info,
+                                                   django_capture_on_commit_callbacks):
+        """Тест что изменение товара удаляет только страницы списков, в которые он попадает"""
+        other_shop = baker.make(Shop)
+        assert api_client.get(f'/products/?shop_id={product_info.shop_id}').status_code == status.HTTP_200_OK
+        assert api_client.get(f'/products/?shop_id={other_shop.id}').status_code == status.HTTP_200_OK
+        assert tagged_keys(product_list_tag(product_info.shop_id))
+
+        with django_capture_on_commit_callbacks(execute=True):
+            product_info.price = 90
+            product_info.save()
+
+        assert not tagged_keys(product_list_tag(product_info.shop_id))
+        assert tagged_keys(product_list_tag(other_shop.id))
+
+    @pytest.mark.django_db
+    def test_parameter_change_looks_up_category_once(self, product_info):
+        """Тест что обработчики сохранения параметра находят магазин и категорию товара одним запросом"""
+        product_parameter = baker.make(ProductParameter, product_info=product_info, parameter=baker.make(Parameter))
+        product_parameter = ProductParameter.objects.get(id=product_parameter.id)
+
+        with CaptureQueriesContext(connection) as context:
+            product_parameter.value = 'новое'
+            product_parameter.save()
+
+        # Строка каталога перестраивается отдельным запросом с JOIN категории, его не считаем
+        scope_queries = [query['sql'] for query in context.captured_queries
+                         if '"backend_product"."category_id" AS "product__category_id"' in query['sql']
+                         and '"backend_category"' not in query['sql']]
+        assert len(scope_queries) == 1
+
+    @pytest.mark.django_db
+    def test_new_category_invalidates_category_list(self, api_client, django_capture_on_commit_callbacks):
+        """Тест инвалидации списка категорий при создании категории"""
+        assert api_client.get('/categories/').status_code == status.HTTP_200_OK
+        assert tagged_keys(CATEGORY_LIST_TAG)
+
+        with django_capture_on_commit_callbacks(execute=True):
+            baker.make(Category)
+
+        assert not tagged_keys(CATEGORY_LIST_TAG)
+
+    @pytest.mark.django_db
+    def test_cache_management_by_tags(self, authenticated_buyer_client, product_info):
+        """Тест инвалидации по тегам через API"""
+        authenticated_buyer_client.get('/products/')
+        page_keys = tagged_keys(product_list_tag())
+        assert page_keys
+
+        response = authenticated_buyer_client.post('/api/cache/clear/', {'tags': [shop_tag(product_info.shop_id)]},
+                                                   format='json')
+
+        assert response.status_code == status.HTTP_200_OK
+        assert response.json()['Status'] is True
+        assert not tagged_keys(shop_tag(product_info.shop_id))
+        assert not get_redis_connection('default').exists(*page_keys)
+
+    @pytest.mark.django_db
+    def test_cache_management_bumps_catalog_without_clear(self, authenticated_buyer_client):
+        """Тест что сброс кеша по умолчанию меняет поколение каталога и не трогает остальные ключи"""
+        cache.set('throttle_test', 1)
+        generation = get_generations([CATALOG_NAMESPACE])[CATALOG_NAMESPACE]
+
+        response = authenticated_buyer_client.post('/api/cache/clear/', {}, format='json')
+
+        assert response.status_code == status.HTTP_200_OK
+        assert get_generations([CATALOG_NAMESPACE])[CATALOG_NAMESPACE] == generation + 1
+        assert cache.get('throttle_test') == 1
+
+    @pytest.mark.django_db
+    def test_cache_management_unknown_namespace(self, authenticated_buyer_client):
+        """Тест ошибки для неизвестного пространства имен"""
+        response = authenticated_buyer_client.post('/api/cache/clear/', {'namespaces': ['*product*']},
+                                                   format='json')
+
+        assert response.status_code == status.HTTP_400_BAD_REQUEST
+        assert response.json()['Status'] is False
@@ -1,7 +1,14 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+from unittest.mock import patch
+
 import pytest
 from rest_framework import status
+from rest_framework.test import APIClient
 from model_bakery import baker
-from backend.models import Order, OrderItem, ProductInfo, Shop, Category, Product
+from backend.models import Order, OrderItem, ProductInfo, Shop, Category, Product, User, Contact, Address
+from backend.carts import RedisCart, flush_dirty_carts
+from backend.stock import held_quantities, release_expired_holds, release_holds
 
 
 class TestCartView:
@@ -159,6 +166,18 @@ class TestUpdateCartItemView:
         assert response.status_code == status.HTTP_200_OK
         assert response.json()['Status'] == True
 
+    @pytest.mark.django_db(transaction=True)
+    def test_update_visible_through_cacheops(self, authenticated_buyer_client, product_info, cacheops_enabled):
+        """Тест что новое количество сразу видно закешированному чтению корзины"""
+        user = authenticated_buyer_client.handler._force_user
+        order_item = baker.make(OrderItem, order=baker.make(Order, user=user, state='basket'),
+                                product_info=product_info, quantity=1)
+        assert authenticated_buyer_client.get('/cart/').json()['Cart']['items'][0]['quantity'] == 1
+
+        authenticated_buyer_client.put('/cart/update/', {'item_id': order_item.id, 'quantity': 3})
+
+        assert authenticated_buyer_client.get('/cart/').json()['Cart']['items'][0]['quantity'] == 3
+
 
 class TestClearCartView:
     @pytest.mark.django_db
@@ -184,4 +203,232 @@ class TestClearCartView:
 
         response = authenticated_buyer_client.delete('/cart/clear/')
         assert response.status_code == status.HTTP_200_OK
-        assert response.json()['Status'] == True
\ No newline at end of file
+        assert response.json()['Status'] == True
+
+class TestStockHolds:
+    @pytest.fixture(autouse=True)
+    def enable_holds(self, settings):
+        settings.STOCK_HOLD_TIMEOUT = 600
+
+    @pytest.fixture
+    def product_info(self):
+        product = baker.make(Product, category=baker.make(Category))
+        return baker.make(ProductInfo, product=product, shop=baker.make(Shop), quantity=5, price=1000)
+
+    @staticmethod
+    def other_client(username):
+        client = APIClient()
+        client.force_authenticate(user=baker.make(User, username=username, email=f'{username}@test.com',
+                                                  type='buyer', is_active=True))
+        return client
+
+    @pytest.mark.django_db
+    def test_hold_blocks_other_carts(self, authenticated_buyer_client, product_info):
+        """Тест что зарезервированные единицы недоступны другим корзинам и скрыты из остатка"""
+        response = authenticated_buyer_client.post('/cart/add/', {'product_info_id': product_info.id, 'quantity': 4})
+        assert response.status_code == status.HTTP_200_OK
+        assert held_quantities([product_info.id]) == {product_info.id: 4}
+
+        response = self.other_client('other').post('/cart/add/', {'product_info_id': product_info.id, 'quantity': 2})
+        assert response.status_code == status.HTTP_400_BAD_REQUEST
+        assert 'Доступно: 1' in response.json()['Error']
+
+        products = authenticated_buyer_client.get('/products/').json()['results']['Products']
+        assert products[0]['quantity'] == 1
+
+    @pytest.mark.django_db
+    def test_hold_replaced_by_cart_quantity(self, authenticated_buyer_client, product_info):
+        """Тест что резерв равен количеству в корзине и снимается при удалении товара"""
+        authenticated_buyer_client.post('/cart/add/', {'product_info_id': product_info.id, 'quantity': 2})
+        authenticated_buyer_client.post('/cart/add/', {'product_info_id': product_info.id, 'quantity': 1})
+        assert held_quantities([product_info.id]) == {product_info.id: 3}
+
+        item = OrderItem.objects.get(product_info=product_info)
+        authenticated_buyer_client.put('/cart/update/', {'item_id': item.id, 'quantity': 1})
+        assert held_quantities([product_info.id]) == {product_info.id: 1}
+
+        authenticated_buyer_client.delete('/cart/remove/', {'item_id': item.id})
+        assert held_quantities([product_info.id]) == {}
+
+    @pytest.mark.django_db
+    def test_expired_holds_released(self, authenticated_buyer_client, product_info):
+        """Тест что задача снимает только истекшие резервы"""
+        authenticated_buyer_client.post('/cart/add/', {'product_info_id': product_info.id, 'quantity': 2})
+        with patch('backend.stock.time.time', return_value=time.time() + 300):
+            self.other_client('other').post('/cart/add/', {'product_info_id': product_info.id, 'quantity': 1})
+
+        with patch('backend.stock.time.time', return_value=time.time() + 700):
+            assert release_expired_holds() == 1
+        assert held_quantities([product_info.id]) == {product_info.id: 1}
+
+    @pytest.mark.django_db
+    def test_confirm_respects_and_releases_holds(self, authenticated_buyer_client, product_info):
+        """Тест что заказ не списывает чужие резервы и снимает свои"""
+        user = authenticated_buyer_client.handler._force_user
+        contact = baker.make(Contact, user=user, address=baker.make(Address), phone='+79999999999')
+        authenticated_buyer_client.post('/cart/add/', {'product_info_id': product_info.id, 'quantity': 2})
+        # Резерв покупателя истек, остаток занимает другая корзина
+        release_holds(user.id, [product_info.id])
+        other = self.other_client('other')
+        assert other.post('/cart/add/', {'product_info_id': product_info.id, 'quantity': 4}).status_code == 200
+
+        response = authenticated_buyer_client.post('/order/confirm/', {'contact_id': contact.id})
+        assert response.status_code == status.HTTP_400_BAD_REQUEST
+        assert response.json()['UnavailableItems'][0]['available'] == 1
+
+        other_user = other.handler._force_user
+        other_contact = baker.make(Contact, user=other_user, address=baker.make(Address), phone='+79999999999')
+        response = other.post('/order/confirm/', {'contact_id': other_contact.id})
+        assert response.status_code == status.HTTP_200_OK
+        assert held_quantities([product_info.id]) == {}
+        product_info.refresh_from_db()
+        assert product_info.quantity == 1
+
+
+class TestRedisCart:
+    @pytest.fixture(autouse=True)
+    def redis_backend(self, settings):
+        settings.CART_BACKEND = 'redis'
+
+    @pytest.fixture
+    def product_info(self):
+        product = baker.make(Product, category=baker.make(Category))
+        return baker.make(ProductInfo, product=product, shop=baker.make(Shop, name='Test Shop'),
+                          name='Phone', quantity=10, price=1000)
+
+    @pytest.mark.django_db
+    def test_cart_lives_in_redis_until_flush(self, authenticated_buyer_client, product_info,
+                                             django_assert_num_queries):
+        """Тест что корзина не пишется в БД до сохранения и читается одним запросом текущих цен"""
+        user = authenticated_buyer_client.handler._force_user
+        authenticated_buyer_client.post('/cart/add/', {'product_info_id': product_info.id, 'quantity': 2})
+        authenticated_buyer_client.post('/cart/add/', {'product_info_id': product_info.id, 'quantity': 1})
+        assert not Order.objects.filter(user=user).exists()
+
+        with django_assert_num_queries(1):
+            response = authenticated_buyer_client.get('/cart/')
+        cart = response.json()['Cart']
+        assert cart['total_amount'] == 3000
+        assert cart['items'][0]['id'] == product_info.id
+        assert cart['items'][0]['shop'] == 'Test Shop'
+
+        assert flush_dirty_carts() == 1
+        item = OrderItem.objects.get(order__user=user, order__state='basket')
+        assert (item.product_info_id, item.quantity) == (product_info.id, 3)
+        cart = authenticated_buyer_client.get('/cart/').json()['Cart']
+        assert (cart['order_id'], cart['items'][0]['id']) == (item.order_id, item.id)
+
+        authenticated_buyer_client.delete('/cart/remove/', {'item_id': item.id})
+        assert flush_dirty_carts() == 1
+        assert not OrderItem.objects.filter(order__user=user).exists()
+
+    @pytest.mark.django_db
+    def test_cart_shows_current_price(self, authenticated_buyer_client, product_info):
+        """Тест что после смены цены (импорт прайса) корзина в Redis показывает новую цену, как корзина в БД"""
+        authenticated_buyer_client.post('/cart/add/', {'product_info_id': product_info.id, 'quantity': 2})
+        ProductInfo.objects.filter(id=product_info.id).update(price=1500)
+
+        cart = authenticated_buyer_client.get('/cart/').json()['Cart']
+
+        assert (cart['items'][0]['price'], cart['total_amount']) == (1500, 3000)
+
+    @pytest.mark.django_db
+    def test_cart_loaded_from_database(self, authenticated_buyer_client, product_info):
+        """Тест что корзина, сохраненная в БД, подхватывается в Redis"""
+        user = authenticated_buyer_client.handler._force_user
+        cart = baker.make(Order, user=user, state='basket')
+        # id строки отличается от id товара: в API корзины в Redis, как и в БД, - id OrderItem
+        item = baker.make(OrderItem, id=product_info.id + 100, order=cart, product_info=product_info, quantity=4)
+
+        response = authenticated_buyer_client.put('/cart/update/', {'item_id': item.id, 'quantity': 5})
+        assert response.status_code == status.HTTP_200_OK
+
+        data = authenticated_buyer_client.get('/cart/').json()['Cart']
+        assert data['order_id'] == cart.id
+        assert (data['items'][0]['id'], data['items'][0]['quantity']) == (item.id, 5)
+
+    @pytest.mark.django_db
+    def test_parallel_adds_keep_all_increments(self, buyer_user, product_info):
+        """Тест что параллельные добавления одного товара не теряют количество"""
+        RedisCart(buyer_user.id).contents()
+        product_info = ProductInfo.objects.select_related('shop').get(id=product_info.id)
+
+        def add(_):
+            for _ in range(5):
+                RedisCart(buyer_user.id).add(product_info, 1)
+
+        with ThreadPoolExecutor(max_workers=10) as executor:
+            list(executor.map(add, range(10)))
+
+        assert RedisCart(buyer_user.id).quantity(product_info.id) == 50
+
+    @pytest.mark.django_db
+    def test_checkout_persists_cart(self, authenticated_buyer_client, product_info):
+        """Тест что оформление заказа сохраняет корзину из Redis и начинает новую"""
+        user = authenticated_buyer_client.handler._force_user
+        contact = baker.make(Contact, user=user, address=baker.make(Address), phone='+79999999999')
+        authenticated_buyer_client.post('/cart/add/', {'product_info_id': product_info.id, 'quantity': 2})
+
+        response = authenticated_buyer_client.post('/order/confirm/', {'contact_id': contact.id})
+
+        assert response.status_code == status.HTTP_200_OK
+        order = Order.objects.get(id=response.json()['OrderId'])
+        assert order.state == 'new'
+        assert order.ordered_items.get().quantity == 2
+        product_info.refresh_from_db()
+        assert product_info.quantity == 8
+        assert authenticated_buyer_client.get('/cart/').json()['Cart'] == {}
+        assert flush_dirty_carts() == 0
+
+
+class TestBatchAddToCartView:
+    @pytest.fixture
+    def product_infos(self):
+        category = baker.make(Category)
+        shop = baker.make(Shop)
+        return [baker.make(ProductInfo, product=baker.make(Product, category=category), shop=shop,
+                           quantity=5, price=100) for _ in range(3)]
+
+    @pytest.mark.django_db
+    def test_batch_add_with_line_results(self, authenticated_buyer_client, product_infos,
+                                         django_assert_max_num_queries):
+        """Тест пакетного добавления: ошибочные строки пропускаются, остальные добавляются"""
+        user = authenticated_buyer_client.handler._force_user
+        first, second, third = product_infos
+        cart = baker.make(Order, user=user, state='basket')
+        baker.make(OrderItem, order=cart, product_info=first, quantity=1)
+
+        items = [
+            {'product_info_id': first.id, 'quantity': 2},
+            {'product_info_id': second.id, 'quantity': 3},
+            {'product_info_id': third.id, 'quantity': 10},
+            {'product_info_id': 999999, 'quantity': 1},
+            {'product_info_id': second.id, 'quantity': 1},
+            {'product_info_id': 'x', 'quantity': 1},
+        ]
+        with django_assert_max_num_queries(8):
+            response = authenticated_buyer_client.post('/cart/add/batch/', {'items': items}, format='json')
+
+        assert response.status_code == status.HTTP_200_OK
+        results = response.json()['Results']
+        assert [result['Status'] for result in results] == [True, True, False, False, False, False]
+        assert results[0]['in_cart'] == 3
+        assert dict(cart.ordered_items.values_list('product_info_id', 'quantity')) == {first.id: 3, second.id: 3}
+
+    @pytest.mark.django_db
+    def test_batch_add_redis_cart(self, authenticated_buyer_client, product_infos, settings):
+        """Тест пакетного добавления в корзину в Redis"""
+        settings.CART_BACKEND = 'redis'
+        items = [{'product_info_id': product_info.id, 'quantity': 2} for product_info in product_infos]
+
+        response = authenticated_buyer_client.post('/cart/add/batch/', {'items': items}, format='json')
+
+        assert all(result['Status'] for result in response.json()['Results'])
+        cart = authenticated_buyer_client.get('/cart/').json()['Cart']
+        assert cart['total_amount'] == 600
+
+    @pytest.mark.django_db
+    def test_batch_add_requires_items(self, authenticated_buyer_client):
+        """Тест пакетного добавления без списка товаров"""
+        response = authenticated_buyer_client.post('/cart/add/batch/', {'items': []}, format='json')
+        assert response.status_code == status.HTTP_400_BAD_REQUEST
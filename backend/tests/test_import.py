@@ -0,0 +1,771 @@
+import copy
+import csv
+import io
+import json
+from pathlib import Path
+from unittest.mock import patch, MagicMock
+
+import pytest
+import yaml
+from celery.exceptions import Retry
+from django.conf import settings
+from django.core.cache import cache
+from django.test import override_settings
+from django_redis import get_redis_connection
+from rest_framework import status
+from model_bakery import baker
+from backend.exceptions import DataValidationException
+from backend.feed_parsers import read_feed, detect_feed_format
+from backend.feed_shards import count_goods
+from backend.cache_utils import (add_cache_tags, cached_function, shop_tag, product_list_tag, get_generations,
+                                 shop_namespace)
+from backend.importer import PriceListImporter
+from backend.registry import ParameterRegistry, CategoryRegistry
+from backend.feed_validation import FeedValidator
+from backend.import_jobs import ImportJob
+from backend.import_locks import CacheLock, shop_import_lock, acquire_import_slot
+from backend.tasks import import_price_list, refresh_shop_catalogs
+from backend.models import Shop, Category, Product, ProductInfo, Parameter, ProductParameter, FacetCount, \
+    CatalogEntry
+
+SHOP_FEED = Path(__file__).resolve().parents[2] / 'shop1.yaml'
+
+
+@pytest.fixture
+def feed_data():
+    with open(SHOP_FEED, encoding='utf-8') as feed:
+        return yaml.safe_load(feed)
+
+
+def feed_content(feed_data, feed_format='yaml'):
+    """Прайс в формате feed_format: YAML, JSON Lines или CSV с категориями в строках"""
+    if feed_format == 'yaml':
+        return yaml.safe_dump(feed_data, allow_unicode=True, sort_keys=False).encode('utf-8')
+    if feed_format == 'jsonl':
+        lines = [{'shop': feed_data['shop'], 'categories': feed_data['categories']}, *feed_data['goods']]
+        return '\n'.join(json.dumps(line, ensure_ascii=False) for line in lines).encode('utf-8')
+
+    categories = {category['id']: category['name'] for category in feed_data['categories']}
+    parameters = list(dict.fromkeys(name for item in feed_data['goods'] for name in item['parameters']))
+    columns = ['shop', 'id', 'category', 'category_name', 'name', 'model', 'price', 'price_rrc', 'quantity']
+    output = io.StringIO()
+    writer = csv.writer(output)
+    writer.writerow(columns + [f'parameters.{name}' for name in parameters])
+    for item in feed_data['goods']:
+        row = {**item, 'shop': feed_data['shop'], 'category_name': categories[item['category']]}
+        writer.writerow([row.get(column, '') for column in columns]
+                        + [item['parameters'].get(name, '') for name in parameters])
+    return output.getvalue().encode('utf-8')
+
+
+def feed_stream(feed_data):
+    """Прайс в YAML как поток, из которого его читает импорт"""
+    return io.BytesIO(yaml.safe_dump(feed_data, allow_unicode=True, sort_keys=False).encode('utf-8'))
+
+
+def feed_response(content=b'', content_type='', status_code=200, headers=None):
+    """Ответ requests.get(stream=True) с телом в raw"""
+    response = MagicMock(status_code=status_code, raw=io.BytesIO(content),
+                         headers={'Content-Type': content_type, **(headers or {})})
+    response.__enter__.return_value = response
+    return response
+
+
+class TestFeedParsers:
+    def test_yaml_stream_matches_safe_load(self, feed_data):
+        """Тест что потоковый разбор YAML совпадает с yaml.safe_load"""
+        with open(SHOP_FEED, 'rb') as feed:
+            data = read_feed(feed, 'yaml')
+            assert data['shop'] == feed_data['shop']
+            assert data['categories'] == feed_data['categories']
+            assert list(data['goods']) == feed_data['goods']
+
+    def test_jsonl_feed(self):
+        """Тест разбора JSON Lines"""
+        content = (b'{"shop": "Shop", "categories": [{"id": 1, "name": "Cat"}]}\n'
+                   b'{"id": 10, "category": 1, "name": "Item", "price": 5, "quantity": 2, "parameters": {}}\n')
+        data = read_feed(io.BytesIO(content), 'jsonl')
+        assert data['shop'] == 'Shop'
+        assert [item['id'] for item in data['goods']] == [10]
+
+    def test_csv_feed(self):
+        """Тест разбора CSV с параметрами и числовыми колонками"""
+        content = ('shop,id,category,category_name,name,price,quantity,parameters.Цвет\n'
+                   'Shop,10,1,Cat,Item,5,2,черный\n').encode('utf-8')
+        data = read_feed(io.BytesIO(content), 'csv')
+        assert data['shop'] == 'Shop'
+        assert list(data['goods']) == [{'id': 10, 'category': 1, 'category_name': 'Cat', 'name': 'Item',
+                                        'price': 5, 'quantity': 2, 'parameters': {'Цвет': 'черный'}}]
+
+    def test_feed_without_shop(self):
+        """Тест ошибки для прайса без shop"""
+        with pytest.raises(DataValidationException):
+            read_feed(io.BytesIO(b'categories: []\ngoods: []\n'), 'yaml')
+
+    def test_detect_feed_format(self):
+        """Тест определения формата по url и Content-Type"""
+        assert detect_feed_format('https://example.com/price.csv?v=1') == 'csv'
+        assert detect_feed_format('https://example.com/price', 'application/x-ndjson') == 'jsonl'
+        assert detect_feed_format('https://example.com/shop1.yaml') == 'yaml'
+
+    @pytest.mark.django_db
+    def test_csv_feed_import_creates_categories(self, shop_user):
+        """Тест импорта CSV с категориями, объявленными в строках"""
+        content = ('shop,id,category,category_name,name,price,quantity\n'
+                   'Shop,10,777,Новая категория,Item,5,2\n').encode('utf-8')
+        PriceListImporter(shop_user.id).run(read_feed(io.BytesIO(content), 'csv'))
+
+        assert Category.objects.get(id=777).name == 'Новая категория'
+        assert ProductInfo.objects.get(external_id=10).product.category_id == 777
+
+
+    @pytest.mark.parametrize('feed_format', ['yaml', 'jsonl', 'csv'])
+    def test_count_goods(self, feed_data, feed_format):
+        """Тест подсчета товаров прайса по строкам для rows_total"""
+        file = io.BytesIO(feed_content(feed_data, feed_format))
+        assert count_goods(file, feed_format) == len(feed_data['goods'])
+        assert file.tell() == 0
+
+    def test_count_goods_flow_style(self, feed_data):
+        """Тест что для goods не блочным списком число товаров неизвестно"""
+        content = yaml.safe_dump(feed_data, allow_unicode=True, default_flow_style=True).encode('utf-8')
+        assert count_goods(io.BytesIO(content), 'yaml') is None
+
+
+class TestPriceListImporter:
+    @pytest.mark.django_db
+    def test_import_creates_catalog(self, shop_user, feed_data):
+        """Тест импорта прайса из shop1.yaml"""
+        stats = PriceListImporter(shop_user.id).run(feed_data)
+
+        shop = Shop.objects.get(user=shop_user)
+        assert shop.name == feed_data['shop']
+        assert ProductInfo.objects.filter(shop=shop).count() == len(feed_data['goods'])
+        assert stats['product_infos'] == len(feed_data['goods'])
+        assert set(Category.objects.filter(shops=shop).values_list('id', flat=True)) == \
+            {category['id'] for category in feed_data['categories']}
+
+        parameters_count = sum(len(item['parameters']) for item in feed_data['goods'])
+        assert ProductParameter.objects.filter(product_info__shop=shop).count() == parameters_count
+
+    @pytest.mark.django_db
+    def test_import_reuses_dictionaries(self, shop_user, feed_data):
+        """Тест что повторный импорт не дублирует продукты и параметры"""
+        PriceListImporter(shop_user.id).run(feed_data)
+        products_count = Product.objects.count()
+        parameters_count = Parameter.objects.count()
+
+        stats = PriceListImporter(shop_user.id).run(feed_data)
+
+        assert stats['products'] == 0
+        assert stats['parameters'] == 0
+        assert Product.objects.count() == products_count
+        assert Parameter.objects.count() == parameters_count
+
+    @pytest.mark.django_db
+    def test_import_existing_category_renamed(self, shop_user, feed_data):
+        """Тест обновления названия существующей категории"""
+        category_id = feed_data['categories'][0]['id']
+        baker.make(Category, id=category_id, name='Старое название')
+
+        PriceListImporter(shop_user.id).run(feed_data)
+
+        assert Category.objects.get(id=category_id).name == feed_data['categories'][0]['name']
+
+    @pytest.mark.django_db
+    def test_import_query_count_does_not_grow_with_goods(self, shop_user, feed_data,
+                                                          django_assert_max_num_queries):
+        """Тест что число запросов не зависит от количества товаров"""
+        goods = []
+        for copy_number in range(20):
+            for item in feed_data['goods']:
+                item = copy.deepcopy(item)
+                item['id'] = len(goods) + 1
+                goods.append(item)
+        feed_data['goods'] = goods
+
+        # Пакет: товары, параметры, строки каталога; на SQLite вставки делятся по лимиту переменных
+        with django_assert_max_num_queries(40):
+            PriceListImporter(shop_user.id, batch_size=500).run(feed_data)
+
+        assert ProductInfo.objects.count() == len(goods)
+
+
+class TestRegistries:
+    @pytest.mark.django_db
+    def test_parameter_registry_creates_only_new_names(self, django_assert_num_queries):
+        """Тест что справочник параметров загружается одним запросом и создает только новые названия"""
+        existing = baker.make(Parameter, name='Цвет')
+        registry = ParameterRegistry()
+
+        with django_assert_num_queries(3):
+            ids = registry.resolve(['Цвет', 'Вес', 'Цвет'])
+        with django_assert_num_queries(0):
+            registry.resolve(['Вес', 'Цвет'] * 1000)
+
+        assert ids['Цвет'] == existing.id
+        assert registry.created == 1
+        assert Parameter.objects.filter(name='Вес').count() == 1
+
+    @pytest.mark.django_db
+    def test_parameter_registry_reuses_concurrently_created(self):
+        """Тест что название, созданное параллельным шардом после загрузки справочника, не дублируется"""
+        registry = ParameterRegistry()
+        registry.resolve(['Цвет'])
+        concurrent = baker.make(Parameter, name='Вес')
+
+        ids = registry.resolve(['Вес'])
+
+        assert ids['Вес'] == concurrent.id
+        assert Parameter.objects.filter(name='Вес').count() == 1
+
+    @pytest.mark.django_db
+    def test_category_registry_renames_changed(self):
+        """Тест создания новых и переименования изменившихся категорий"""
+        baker.make(Category, id=1, name='Старое')
+        baker.make(Category, id=2, name='Без изменений')
+        registry = CategoryRegistry()
+
+        registry.sync({1: 'Новое', 2: 'Без изменений', 3: 'Добавленная'})
+
+        assert registry.created == 1
+        assert dict(Category.objects.values_list('id', 'name')) == {1: 'Новое', 2: 'Без изменений', 3: 'Добавленная'}
+
+
+class TestPriceListSync:
+    @pytest.mark.django_db
+    def test_sync_keeps_unchanged_rows(self, shop_user, feed_data):
+        """Тест что повторная синхронизация без изменений ничего не переписывает"""
+        PriceListImporter(shop_user.id).run(feed_data)
+        ids_before = set(ProductInfo.objects.values_list('id', flat=True))
+
+        stats = PriceListImporter(shop_user.id).run(feed_data)
+
+        assert stats['inserted'] == 0
+        assert stats['updated'] == 0
+        assert stats['removed'] == 0
+        assert stats['unchanged'] == len(feed_data['goods'])
+        assert set(ProductInfo.objects.values_list('id', flat=True)) == ids_before
+
+    @pytest.mark.django_db
+    def test_sync_updates_changed_fields_and_parameters(self, shop_user, feed_data):
+        """Тест обновления цены и параметров у существующего товара"""
+        PriceListImporter(shop_user.id).run(feed_data)
+        item = feed_data['goods'][0]
+        product_info = ProductInfo.objects.get(external_id=item['id'])
+        item['price'] += 100
+        parameter_name = next(iter(item['parameters']))
+        item['parameters'][parameter_name] = 'новое значение'
+
+        stats = PriceListImporter(shop_user.id).run(feed_data)
+
+        assert stats['updated'] == 1
+        assert stats['unchanged'] == len(feed_data['goods']) - 1
+        product_info.refresh_from_db()
+        assert product_info.price == item['price']
+        assert product_info.product_parameters.get(parameter__name=parameter_name).value == 'новое значение'
+
+    @pytest.mark.django_db
+    def test_sync_retires_missing_and_inserts_new(self, shop_user, feed_data):
+        """Тест снятия с продажи отсутствующих товаров и добавления новых"""
+        PriceListImporter(shop_user.id).run(feed_data)
+        removed_item = feed_data['goods'].pop()
+        new_item = copy.deepcopy(feed_data['goods'][0])
+        new_item['id'] = 1
+        feed_data['goods'].append(new_item)
+
+        stats = PriceListImporter(shop_user.id).run(feed_data)
+
+        assert stats['inserted'] == 1
+        assert stats['removed'] == 1
+        assert ProductInfo.objects.get(external_id=removed_item['id']).quantity == 0
+        assert ProductInfo.objects.filter(external_id=1).exists()
+
+    @pytest.mark.django_db
+    def test_sync_loads_existing_per_batch(self, shop_user, feed_data):
+        """Тест что синхронизация держит в памяти только текущий пакет каталога"""
+        PriceListImporter(shop_user.id).run(feed_data)
+        removed_items = feed_data['goods'][-3:]
+        del feed_data['goods'][-3:]
+        importer = PriceListImporter(shop_user.id, batch_size=2)
+
+        stats = importer.run(feed_data)
+
+        assert stats['unchanged'] == len(feed_data['goods'])
+        assert stats['removed'] == len(removed_items)
+        assert len(importer.existing) <= 2
+        assert set(ProductInfo.objects.filter(quantity=0).values_list('external_id', flat=True)) >= {
+            item['id'] for item in removed_items}
+        assert not CatalogEntry.objects.filter(external_id__in=[item['id'] for item in removed_items],
+                                               quantity__gt=0).exists()
+
+    @pytest.mark.django_db
+    def test_sync_refreshes_facet_counts(self, shop_user, feed_data):
+        """Тест что импорт пересчитывает счетчики фасетов своего магазина"""
+        PriceListImporter(shop_user.id).run(feed_data)
+        item = feed_data['goods'][0]
+        color = item['parameters']['Цвет']
+        in_stock = [goods for goods in feed_data['goods'] if goods['category'] == item['category']
+                    and goods['parameters'].get('Цвет') == color and goods['quantity'] > 0]
+
+        def color_count():
+            return sum(FacetCount.objects.filter(parameter__name='Цвет', value=color,
+                                                 category_id=item['category']).values_list('count', flat=True))
+
+        assert color_count() == len(in_stock)
+        assert FacetCount.objects.filter(parameter__name='Встроенная память (Гб)', value='512').first().value_number == 512
+
+        item['quantity'] = 0
+        PriceListImporter(shop_user.id).run(feed_data)
+        assert color_count() == len(in_stock) - 1
+
+    @pytest.mark.django_db
+    def test_sync_refreshes_catalog_entries(self, shop_user, feed_data):
+        """Тест что импорт поддерживает денормализованный каталог"""
+        PriceListImporter(shop_user.id).run(feed_data)
+        assert CatalogEntry.objects.count() == len(feed_data['goods'])
+
+        changed, removed = feed_data['goods'][0], feed_data['goods'].pop()
+        changed['price'] += 100
+        changed['parameters']['Цвет'] = 'синий'
+        feed_data['categories'][0]['name'] = 'Переименованная'
+        PriceListImporter(shop_user.id).run(feed_data)
+
+        entry = CatalogEntry.objects.get(external_id=changed['id'])
+        assert entry.price == changed['price']
+        assert {'Цвет': 'синий'}.items() <= {parameter['name']: parameter['value']
+                                             for parameter in entry.parameters}.items()
+        assert CatalogEntry.objects.get(external_id=removed['id']).quantity == 0
+        assert set(CatalogEntry.objects.filter(category_id=feed_data['categories'][0]['id'])
+                   .values_list('category_name', flat=True)) <= {'Переименованная'}
+
+    @pytest.mark.django_db
+    def test_sync_invalidates_only_shop_caches(self, shop_user, feed_data):
+        """Тест что импорт удаляет записи кеша своего магазина и не трогает чужие"""
+        PriceListImporter(shop_user.id).run(feed_data)
+        shop = Shop.objects.get(user=shop_user)
+        category_id = feed_data['categories'][0]['id']
+        calls = []
+
+        @cached_function(timeout=60, key_prefix='test_import_page')
+        def page(*tags):
+            calls.append(tags)
+            add_cache_tags(*tags)
+            return tags
+
+        for tags in ([product_list_tag(None, category_id)], [shop_tag(shop.id)], [shop_tag(shop.id + 1)]):
+            page(*tags)
+        generation = get_generations([shop_namespace(shop.id)])[shop_namespace(shop.id)]
+        feed_data['goods'][0]['price'] += 100
+        PriceListImporter(shop_user.id).run(feed_data)
+        assert get_generations([shop_namespace(shop.id)])[shop_namespace(shop.id)] == generation + 1
+        for tags in ([product_list_tag(None, category_id)], [shop_tag(shop.id)], [shop_tag(shop.id + 1)]):
+            page(*tags)
+
+        assert calls[3:] == [(product_list_tag(None, category_id),), (shop_tag(shop.id),)]
+
+    @pytest.mark.django_db
+    def test_replace_mode_recreates_catalog(self, shop_user, feed_data):
+        """Тест режима полной замены каталога"""
+        PriceListImporter(shop_user.id).run(feed_data)
+        ids_before = set(ProductInfo.objects.values_list('id', flat=True))
+
+        stats = PriceListImporter(shop_user.id, mode='replace').run(feed_data)
+
+        assert stats['removed'] == len(feed_data['goods'])
+        assert stats['inserted'] == len(feed_data['goods'])
+        assert not ids_before & set(ProductInfo.objects.values_list('id', flat=True))
+        assert set(CatalogEntry.objects.values_list('id', flat=True)) == set(
+            ProductInfo.objects.values_list('id', flat=True))
+
+
+class TestUpdatePriceView:
+    @pytest.mark.django_db
+    def test_update_price_returns_job(self, authenticated_shop_client):
+        """Тест постановки импорта в очередь"""
+        with patch('backend.views.import_price_list.delay') as delay:
+            response = authenticated_shop_client.post('/partner/update/', {'url': 'https://example.com/shop1.yaml'})
+
+        assert response.status_code == status.HTTP_202_ACCEPTED
+        job_id = response.json()['JobId']
+        delay.assert_called_once_with(job_id)
+        assert ImportJob.get(job_id).to_dict()['phase'] == 'queued'
+
+    @pytest.mark.django_db
+    def test_update_price_buyer_forbidden(self, authenticated_buyer_client):
+        """Тест что покупатель не может обновлять прайс"""
+        response = authenticated_buyer_client.post('/partner/update/', {'url': 'https://example.com/shop1.yaml'})
+        assert response.status_code == status.HTTP_403_FORBIDDEN
+        assert response.json()['Status'] == False
+
+    @pytest.mark.django_db
+    def test_import_status_other_user(self, authenticated_shop_client, buyer_user):
+        """Тест что статус чужой задачи недоступен"""
+        job = ImportJob.create(buyer_user.id, 'https://example.com/shop1.yaml')
+        response = authenticated_shop_client.get(f'/partner/update/status/{job.id}/')
+        assert response.status_code == status.HTTP_404_NOT_FOUND
+
+
+class TestImportPriceListTask:
+    @pytest.mark.django_db
+    def test_task_imports_feed_and_reports_progress(self, authenticated_shop_client, shop_user, feed_data):
+        """Тест фоновой задачи импорта и отчета о прогрессе"""
+        job = ImportJob.create(shop_user.id, 'https://example.com/shop1.yaml')
+        with open(SHOP_FEED, 'rb') as feed:
+            download = feed_response(feed.read())
+
+        with patch('backend.feed_fetch.get', return_value=download):
+            import_price_list(job.id)
+
+        response = authenticated_shop_client.get(f'/partner/update/status/{job.id}/')
+        assert response.status_code == status.HTTP_200_OK
+        job_data = response.json()['Job']
+        assert job_data['phase'] == 'done'
+        assert job_data['rows_processed'] == job_data['rows_total'] == len(feed_data['goods'])
+        assert job_data['stats']['inserted'] == len(feed_data['goods'])
+        assert job_data['errors'] == []
+
+    @pytest.mark.django_db
+    def test_task_reports_errors(self, shop_user):
+        """Тест что ошибка импорта попадает в статус задачи"""
+        job = ImportJob.create(shop_user.id, 'https://example.com/shop1.yaml')
+
+        with patch('backend.feed_fetch.get', side_effect=ConnectionError('нет соединения')):
+            import_price_list(job.id)
+
+        job_data = ImportJob.get(job.id).to_dict()
+        assert job_data['phase'] == 'failed'
+        assert job_data['errors'] == ['нет соединения']
+
+
+class TestConditionalFetch:
+    @pytest.fixture
+    def feed_content(self):
+        with open(SHOP_FEED, 'rb') as feed:
+            return feed.read()
+
+    def run_import(self, user, content=b'', url='https://example.com/shop1.yaml', **response_options):
+        job = ImportJob.create(user.id, url)
+        with patch('backend.feed_fetch.get', return_value=feed_response(content, **response_options)) as get:
+            import_price_list(job.id)
+        return ImportJob.get(job.id).to_dict(), get
+
+    @pytest.mark.django_db
+    def test_validators_saved_after_import(self, shop_user, feed_content):
+        """Тест сохранения ETag, Last-Modified и хеша прайса в магазине"""
+        job_data, _ = self.run_import(shop_user, feed_content, headers={
+            'ETag': '"v1"', 'Last-Modified': 'Wed, 21 Oct 2026 07:28:00 GMT'})
+
+        shop = Shop.objects.get(user=shop_user)
+        assert job_data['phase'] == 'done'
+        assert shop.url == 'https://example.com/shop1.yaml'
+        assert shop.feed_etag == '"v1"'
+        assert shop.feed_last_modified == 'Wed, 21 Oct 2026 07:28:00 GMT'
+        assert len(shop.feed_hash) == 64
+
+    @pytest.mark.django_db
+    def test_not_modified_skips_import(self, shop_user, feed_content):
+        """Тест что на 304 импорт не выполняется"""
+        self.run_import(shop_user, feed_content, headers={'ETag': '"v1"'})
+
+        with patch('backend.tasks.PriceListImporter') as importer:
+            job_data, get = self.run_import(shop_user, status_code=304)
+
+        assert get.call_args.kwargs['headers'] == {'If-None-Match': '"v1"'}
+        assert job_data['phase'] == 'unchanged'
+        assert job_data['stats'] == {'skipped': 'not_modified'}
+        importer.assert_not_called()
+
+    @pytest.mark.django_db
+    def test_same_hash_skips_import(self, shop_user, feed_content):
+        """Тест пропуска импорта для того же содержимого без валидаторов HTTP"""
+        self.run_import(shop_user, feed_content)
+
+        with patch('backend.tasks.PriceListImporter') as importer:
+            job_data, _ = self.run_import(shop_user, feed_content)
+
+        assert job_data['phase'] == 'unchanged'
+        assert job_data['stats'] == {'skipped': 'same_hash'}
+        importer.assert_not_called()
+
+    @pytest.mark.django_db
+    def test_force_and_other_url_import_again(self, shop_user, feed_content):
+        """Тест что другой url и force не используют сохраненные валидаторы"""
+        self.run_import(shop_user, feed_content, headers={'ETag': '"v1"'})
+
+        job_data, get = self.run_import(shop_user, feed_content, url='https://example.com/other.yaml')
+        assert get.call_args.kwargs['headers'] == {}
+        assert job_data['phase'] == 'done'
+
+        job = ImportJob.create(shop_user.id, 'https://example.com/other.yaml', force=True)
+        with patch('backend.feed_fetch.get', return_value=feed_response(feed_content)) as get:
+            import_price_list(job.id)
+        assert get.call_args.kwargs['headers'] == {}
+        assert ImportJob.get(job.id).to_dict()['phase'] == 'done'
+
+
+class TestScheduledRefresh:
+    @pytest.mark.django_db
+    def test_refresh_queues_shops_with_url(self, shop_user, buyer_user):
+        """Тест постановки плановых импортов только для магазинов с url"""
+        baker.make(Shop, user=shop_user, url='https://example.com/shop1.yaml')
+        baker.make(Shop, user=buyer_user, url='https://example.com/buyer.yaml')
+        baker.make(Shop, user=None, url='https://example.com/orphan.yaml')
+
+        with patch('backend.tasks.import_price_list.apply_async') as apply_async:
+            refresh_shop_catalogs()
+
+        apply_async.assert_called_once()
+        job = ImportJob.get(apply_async.call_args.args[0][0])
+        assert job.user_id == shop_user.id
+        assert job.state['scheduled'] is True
+        assert 0 <= apply_async.call_args.kwargs['countdown'] <= settings.CATALOG_REFRESH_JITTER
+
+    @pytest.mark.django_db
+    def test_refresh_skips_locked_shop(self, shop_user):
+        """Тест что магазин с идущим импортом не ставится в очередь повторно"""
+        baker.make(Shop, user=shop_user, url='https://example.com/shop1.yaml')
+        lock = shop_import_lock(shop_user.id, 'other-job')
+        assert lock.acquire()
+        try:
+            with patch('backend.tasks.import_price_list.apply_async') as apply_async:
+                refresh_shop_catalogs()
+        finally:
+            lock.release()
+
+        apply_async.assert_not_called()
+
+    @pytest.mark.django_db
+    def test_scheduled_import_skipped_when_shop_locked(self, shop_user):
+        """Тест что плановый импорт не пересекается с идущим импортом магазина"""
+        job = ImportJob.create(shop_user.id, 'https://example.com/shop1.yaml', scheduled=True)
+        lock = shop_import_lock(shop_user.id, 'other-job')
+        lock.acquire()
+        try:
+            with patch('backend.feed_fetch.get') as get:
+                import_price_list(job.id)
+        finally:
+            lock.release()
+
+        get.assert_not_called()
+        assert ImportJob.get(job.id).to_dict()['stats'] == {'skipped': 'locked'}
+
+    @pytest.mark.django_db
+    @override_settings(CATALOG_IMPORT_MAX_CONCURRENT=1)
+    def test_import_postponed_without_free_slot(self, shop_user):
+        """Тест что импорт откладывается, когда все слоты заняты"""
+        job = ImportJob.create(shop_user.id, 'https://example.com/shop1.yaml')
+        slot = acquire_import_slot('other-job')
+        try:
+            with patch('backend.tasks.import_price_list.retry', side_effect=Retry()) as retry, \
+                    patch('backend.feed_fetch.get', return_value=feed_response(SHOP_FEED.read_bytes())), \
+                    patch('backend.tasks.PriceListImporter') as importer:
+                with pytest.raises(Retry):
+                    import_price_list(job.id)
+        finally:
+            slot.release()
+
+        retry.assert_called_once()
+        importer.assert_not_called()
+        assert not shop_import_lock(shop_user.id, job.id).is_locked()
+
+    @pytest.mark.django_db
+    @override_settings(CATALOG_IMPORT_MAX_CONCURRENT=1)
+    def test_not_modified_needs_no_slot(self, shop_user):
+        """Тест что условный запрос с ответом 304 выполняется, не дожидаясь слота"""
+        baker.make(Shop, user=shop_user, url='https://example.com/shop1.yaml', feed_etag='"v1"')
+        job = ImportJob.create(shop_user.id, 'https://example.com/shop1.yaml', scheduled=True)
+        slot = acquire_import_slot('other-job')
+        try:
+            with patch('backend.tasks.import_price_list.retry', side_effect=Retry()) as retry, \
+                    patch('backend.feed_fetch.get', return_value=feed_response(status_code=304)):
+                import_price_list(job.id)
+        finally:
+            slot.release()
+
+        retry.assert_not_called()
+        assert ImportJob.get(job.id).to_dict()['stats'] == {'skipped': 'not_modified'}
+
+    @pytest.mark.django_db
+    def test_locks_extended_while_importing(self, shop_user):
+        """Тест что отчет о прогрессе продлевает блокировку магазина и слот"""
+        job = ImportJob.create(shop_user.id, 'https://example.com/shop1.yaml')
+        with patch('backend.feed_fetch.get', return_value=feed_response(SHOP_FEED.read_bytes())), \
+                patch.object(CacheLock, 'extend', autospec=True) as extend:
+            import_price_list(job.id)
+
+        keys = {call.args[0].key for call in extend.call_args_list}
+        assert f"import_lock:shop:{shop_user.id}" in keys
+        assert any(key.startswith('import_lock:slot:') for key in keys)
+
+    def test_extend_keeps_only_own_lock(self):
+        """Тест что extend продлевает TTL только блокировки своего владельца"""
+        lock = CacheLock('import_lock:test', 'job-1', ttl=10)
+        other = CacheLock('import_lock:test', 'job-2', ttl=1000)
+        assert lock.acquire()
+        try:
+            other.extend()
+            assert cache.ttl(lock.key) <= 10
+            lock.ttl = 1000
+            lock.extend()
+            assert cache.ttl(lock.key) > 10
+        finally:
+            lock.release()
+
+
+class TestShardedImport:
+    @pytest.fixture(autouse=True)
+    def small_shards(self, settings, tmp_path):
+        settings.MEDIA_ROOT = str(tmp_path)
+        with patch('backend.feed_shards.MIN_SHARD_SIZE', 1024):
+            yield
+
+    def run_sharded(self, user, content, shards=4, feed_format='yaml'):
+        job = ImportJob.create(user.id, f'https://example.com/shop1.{feed_format}', force=True, shards=shards)
+        with patch('backend.feed_fetch.get', return_value=feed_response(content)):
+            import_price_list(job.id)
+        return ImportJob.get(job.id).to_dict()
+
+    @pytest.mark.django_db(transaction=True)
+    def test_sharded_import_matches_single(self, shop_user, feed_data, settings, tmp_path):
+        """Тест что параллельный импорт дает тот же каталог без дубликатов справочников"""
+        with open(SHOP_FEED, 'rb') as feed:
+            content = feed.read()
+
+        job_data = self.run_sharded(shop_user, content)
+
+        assert job_data['phase'] == 'done', job_data['errors']
+        assert job_data['rows_processed'] == job_data['rows_total'] == len(feed_data['goods'])
+        assert job_data['stats']['inserted'] == len(feed_data['goods'])
+        assert ProductInfo.objects.count() == len(feed_data['goods'])
+        parameter_names = {name for item in feed_data['goods'] for name in item['parameters']}
+        assert Parameter.objects.count() == len(parameter_names)
+        assert Product.objects.count() == len({(item['name'], item['category']) for item in feed_data['goods']})
+        assert not shop_import_lock(shop_user.id, None).is_locked()
+        assert not list((tmp_path / 'imports').iterdir())
+        # Встреченные id шарды пишут в множество задачи, после завершения оно удаляется
+        assert not get_redis_connection('default').exists(ImportJob(job_data['job_id'], {}).seen_key())
+
+    @pytest.mark.django_db(transaction=True)
+    @pytest.mark.parametrize('feed_format', ['jsonl', 'csv'])
+    def test_sharded_import_other_formats(self, shop_user, feed_data, feed_format):
+        """Тест параллельного импорта JSON Lines и CSV: разбор заголовка не закрывает загруженный файл"""
+        job_data = self.run_sharded(shop_user, feed_content(feed_data, feed_format), feed_format=feed_format)
+
+        assert job_data['phase'] == 'done', job_data['errors']
+        assert job_data['rows_total'] == len(feed_data['goods'])
+        assert job_data['stats']['inserted'] == len(feed_data['goods'])
+        assert set(ProductInfo.objects.values_list('external_id', flat=True)) == {
+            item['id'] for item in feed_data['goods']}
+        assert ProductParameter.objects.count() == sum(len(item['parameters']) for item in feed_data['goods'])
+
+    @pytest.mark.django_db(transaction=True)
+    def test_sharded_import_retires_missing(self, shop_user, feed_data):
+        """Тест снятия с продажи отсутствующих товаров после всех шардов"""
+        PriceListImporter(shop_user.id).run(copy.deepcopy(feed_data))
+        removed_item = feed_data['goods'].pop()
+
+        job_data = self.run_sharded(shop_user, yaml.safe_dump(feed_data, allow_unicode=True, sort_keys=False).encode('utf-8'))
+
+        assert job_data['phase'] == 'done', job_data['errors']
+        assert job_data['stats']['removed'] == 1
+        assert job_data['stats']['unchanged'] == len(feed_data['goods'])
+        assert ProductInfo.objects.get(external_id=removed_item['id']).quantity == 0
+
+    @pytest.mark.django_db(transaction=True)
+    def test_sharded_import_duplicate_ids(self, shop_user, feed_data):
+        """Тест что повтор id в разных шардах не ломает импорт, побеждает первое вхождение"""
+        first = feed_data['goods'][0]
+        feed_data['goods'].append({**copy.deepcopy(first), 'price': first['price'] + 100})
+        content = yaml.safe_dump(feed_data, allow_unicode=True, sort_keys=False).encode('utf-8')
+
+        job_data = self.run_sharded(shop_user, content)
+
+        assert job_data['phase'] == 'done', job_data['errors']
+        assert job_data['stats']['inserted'] == len(feed_data['goods']) - 1
+        assert ProductInfo.objects.count() == len(feed_data['goods']) - 1
+        assert ProductInfo.objects.get(external_id=first['id']).price == first['price']
+
+    @pytest.mark.django_db
+    def test_sharded_import_requires_sync_mode(self, authenticated_shop_client):
+        """Тест что параллельный импорт недоступен в режиме replace"""
+        response = authenticated_shop_client.post('/partner/update/', {
+            'url': 'https://example.com/shop1.yaml', 'mode': 'replace', 'shards': 4})
+        assert response.status_code == status.HTTP_400_BAD_REQUEST
+
+
+class TestFeedValidation:
+    @pytest.mark.django_db
+    def test_valid_feed(self, feed_data):
+        """Тест отчета для корректного прайса"""
+        report = FeedValidator().validate(feed_stream(feed_data))
+        assert report['valid'] is True
+        assert report['rows'] == len(feed_data['goods'])
+        assert report['errors'] == []
+
+    @pytest.mark.django_db
+    def test_report_lists_item_errors(self, feed_data):
+        """Тест обнаружения пропущенных полей, некорректных чисел, дубликатов и неизвестных категорий"""
+        goods = feed_data['goods']
+        del goods[0]['name']
+        goods[1]['price'] = -5
+        goods[2]['quantity'] = '10'
+        goods[3]['id'] = goods[4]['id']
+        goods[5]['category'] = 999999
+
+        report = FeedValidator().validate(feed_stream(feed_data))
+
+        assert report['valid'] is False
+        found = {(error['row'], error['code'], error['field']) for error in report['errors']}
+        assert found == {
+            (1, 'required', 'name'),
+            (2, 'invalid', 'price'),
+            (3, 'invalid', 'quantity'),
+            (5, 'duplicate', 'id'),
+            (6, 'unknown_category', 'category'),
+        }
+
+    @pytest.mark.django_db
+    def test_dry_run_does_not_touch_database(self, shop_user, feed_data):
+        """Тест что проверка прайса не пишет в БД и возвращает отчет в статусе задачи"""
+        feed_data['goods'][0]['price'] = 'дорого'
+        content = yaml.safe_dump(feed_data, allow_unicode=True, sort_keys=False).encode('utf-8')
+        job = ImportJob.create(shop_user.id, 'https://example.com/shop1.yaml', dry_run=True)
+
+        with patch('backend.feed_fetch.get', return_value=feed_response(content)):
+            import_price_list(job.id)
+
+        job_data = ImportJob.get(job.id).to_dict()
+        assert job_data['phase'] == 'failed'
+        assert job_data['report']['error_count'] == 1
+        assert job_data['report']['errors'][0]['field'] == 'price'
+        assert not Shop.objects.filter(user=shop_user).exists()
+        assert not ProductInfo.objects.exists()
+
+    @pytest.mark.django_db
+    def test_report_lists_header_errors(self, feed_data):
+        """Тест что прайс без shop и нечитаемый прайс дают отчет, а не исключение"""
+        del feed_data['shop']
+        feed_data['goods'][0]['price'] = -5
+
+        report = FeedValidator().validate(feed_stream(feed_data))
+
+        assert report['valid'] is False
+        assert {(error['code'], error['field']) for error in report['errors']} == {('required', 'shop'),
+                                                                                  ('invalid', 'price')}
+        report = FeedValidator().validate(io.BytesIO(b'- shop\n- goods\n'))
+        assert (report['rows'], report['errors'][0]['code']) == (0, 'parse_error')
+
+    @pytest.mark.django_db
+    def test_dry_run_reports_missing_shop(self, shop_user, feed_data):
+        """Тест что проверка прайса без shop завершается отчетом"""
+        del feed_data['shop']
+        job = ImportJob.create(shop_user.id, 'https://example.com/shop1.yaml', dry_run=True)
+
+        with patch('backend.feed_fetch.get', return_value=feed_response(feed_stream(feed_data).getvalue())):
+            import_price_list(job.id)
+
+        job_data = ImportJob.get(job.id).to_dict()
+        assert job_data['report']['errors'] == [{'row': None, 'id': None, 'field': 'shop', 'code': 'required',
+                                                 'message': 'Не указано поле shop'}]
+        assert job_data['report']['rows'] == len(feed_data['goods'])
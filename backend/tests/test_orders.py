@@ -1,8 +1,17 @@
 
+from concurrent.futures import ThreadPoolExecutor
+from unittest.mock import patch
+
 import pytest
+from django.db import connection
 from rest_framework import status
+from rest_framework.test import APIClient
 from model_bakery import baker
-from backend.models import Order, Contact, Address, OrderItem, ProductInfo, Shop, Category, Product
+from backend.models import Order, Contact, Address, OrderItem, ProductInfo, Shop, Category, Product, CatalogEntry, \
+    User
+from backend.exceptions import OrderStateException
+from backend.orders import change_state
+from backend.carts import DatabaseCart
 
 
 class TestOrderListView:
@@ -83,6 +92,9 @@ class TestConfirmOrderView:
         cart.refresh_from_db()
         assert cart.state == 'new'
 
+        # Остаток списан и в денормализованном каталоге
+        assert CatalogEntry.objects.get(id=product_info.id).quantity == 9
+
     @pytest.mark.django_db
     def test_confirm_order_empty_cart(self, authenticated_buyer_client):
         """Тест подтверждения пустой корзины"""
@@ -97,6 +109,108 @@ class TestConfirmOrderView:
         assert response.status_code == status.HTTP_404_NOT_FOUND
         assert response.json()['Status'] == False
 
+    @pytest.mark.django_db
+    def test_confirm_order_shortfall_rolls_back(self, authenticated_buyer_client):
+        """Тест что нехватка одной строки откатывает списание остальных"""
+        user = authenticated_buyer_client.handler._force_user
+        shop = baker.make(Shop, name='Test Shop')
+        category = baker.make(Category, name='Test Category')
+        first = baker.make(ProductInfo, product=baker.make(Product, category=category), shop=shop,
+                           name='First', quantity=10, price=1000)
+        second = baker.make(ProductInfo, product=baker.make(Product, category=category), shop=shop,
+                            name='Second', quantity=1, price=1000)
+
+        cart = baker.make(Order, user=user, state='basket')
+        baker.make(OrderItem, order=cart, product_info=first, quantity=3)
+        baker.make(OrderItem, order=cart, product_info=second, quantity=2)
+        contact = baker.make(Contact, user=user, address=baker.make(Address), phone='+79999999999')
+
+        response = authenticated_buyer_client.post('/order/confirm/', {'contact_id': contact.id})
+
+        assert response.status_code == status.HTTP_400_BAD_REQUEST
+        assert response.json()['UnavailableItems'] == [{'product': 'Second', 'available': 1, 'requested': 2}]
+        first.refresh_from_db()
+        second.refresh_from_db()
+        cart.refresh_from_db()
+        assert (first.quantity, second.quantity) == (10, 1)
+        assert cart.state == 'basket'
+
+    @pytest.mark.django_db(transaction=True)
+    def test_stock_visible_through_cacheops(self, authenticated_buyer_client, cacheops_enabled):
+        """Тест что списание и возврат остатка сразу видны закешированной проверке наличия"""
+        user = authenticated_buyer_client.handler._force_user
+        product_info = baker.make(ProductInfo, product=baker.make(Product, category=baker.make(Category)),
+                                  quantity=5, price=1000)
+        cart = baker.make(Order, user=user, state='basket')
+        baker.make(OrderItem, order=cart, product_info=product_info, quantity=3)
+        contact = baker.make(Contact, user=user, address=baker.make(Address), phone='+79999999999')
+        other = APIClient()
+        other.force_authenticate(user=baker.make(User, type='buyer', is_active=True))
+        data = {'product_info_id': product_info.id, 'quantity': 3}
+        assert other.post('/cart/add/', data).status_code == status.HTTP_200_OK
+
+        response = authenticated_buyer_client.post('/order/confirm/', {'contact_id': contact.id})
+        assert response.status_code == status.HTTP_200_OK
+        assert other.post('/cart/add/', data).status_code == status.HTTP_404_NOT_FOUND
+
+        response = authenticated_buyer_client.post('/order/cancel/', {'order_id': cart.id})
+        assert response.status_code == status.HTTP_200_OK
+        assert other.post('/cart/add/', data).status_code == status.HTTP_200_OK
+
+    @pytest.mark.django_db
+    def test_confirm_order_twice_reserves_once(self, authenticated_buyer_client):
+        """Тест что повторное подтверждение той же корзины не списывает остаток второй раз"""
+        user = authenticated_buyer_client.handler._force_user
+        product = baker.make(Product, category=baker.make(Category))
+        product_info = baker.make(ProductInfo, product=product, quantity=10, price=1000)
+        cart = baker.make(Order, user=user, state='basket')
+        baker.make(OrderItem, order=cart, product_info=product_info, quantity=4)
+        contact = baker.make(Contact, user=user, address=baker.make(Address), phone='+79999999999')
+        stale = Order.objects.get(id=cart.id)
+
+        change_state(cart, 'new', contact=contact)
+        with pytest.raises(OrderStateException):
+            change_state(stale, 'new', contact=contact)
+
+        product_info.refresh_from_db()
+        assert product_info.quantity == 6
+
+
+@pytest.mark.skipif(connection.vendor != 'postgresql', reason='нужны параллельные транзакции PostgreSQL')
+class TestConcurrentCheckout:
+    BUYERS = 200
+    STOCK = 50
+
+    @staticmethod
+    def checkout(user, contact):
+        client = APIClient()
+        client.force_authenticate(user=user)
+        try:
+            return client.post('/order/confirm/', {'contact_id': contact.id}).status_code
+        finally:
+            connection.close()
+
+    @pytest.mark.django_db(transaction=True)
+    def test_parallel_checkouts_do_not_oversell(self):
+        """Тест что сотни одновременных заказов одного товара не уводят остаток в минус"""
+        product = baker.make(Product, category=baker.make(Category))
+        product_info = baker.make(ProductInfo, product=product, quantity=self.STOCK, price=1000)
+        buyers = []
+        for user in baker.make(User, type='buyer', is_active=True, _quantity=self.BUYERS):
+            cart = baker.make(Order, user=user, state='basket')
+            baker.make(OrderItem, order=cart, product_info=product_info, quantity=1)
+            buyers.append((user, baker.make(Contact, user=user, address=baker.make(Address), phone='+79999999999')))
+
+        with ThreadPoolExecutor(max_workers=20) as executor:
+            statuses = list(executor.map(lambda buyer: self.checkout(*buyer), buyers))
+
+        assert statuses.count(status.HTTP_200_OK) == self.STOCK
+        assert statuses.count(status.HTTP_400_BAD_REQUEST) == self.BUYERS - self.STOCK
+        product_info.refresh_from_db()
+        assert product_info.quantity == 0
+        assert Order.objects.filter(state='new').count() == self.STOCK
+        assert CatalogEntry.objects.get(id=product_info.id).quantity == 0
+
 
 class TestOrderDetailView:
     @pytest.mark.django_db
@@ -181,6 +295,7 @@ class TestCancelOrderView:
         # Проверяем что товары вернулись на склад
         product_info.refresh_from_db()
         assert product_info.quantity == initial_quantity + 1
+        assert CatalogEntry.objects.get(id=product_info.id).quantity == initial_quantity + 1
 
     @pytest.mark.django_db
     def test_cancel_order_not_found(self, authenticated_buyer_client):
@@ -208,4 +323,66 @@ class TestCancelOrderView:
         response = authenticated_buyer_client.post('/order/cancel/', data)
 
         assert response.status_code == status.HTTP_400_BAD_REQUEST
-        assert response.json()['Status'] == False
\ No newline at end of file
+        assert response.json()['Status'] == False
+    @pytest.mark.django_db
+    def test_cancel_restores_stock_once(self, authenticated_buyer_client):
+        """Тест что отмена возвращает все строки одним событием и не повторяется при гонке"""
+        user = authenticated_buyer_client.handler._force_user
+        category = baker.make(Category)
+        product_infos = [baker.make(ProductInfo, product=baker.make(Product, category=category), quantity=5, price=100)
+                         for _ in range(3)]
+        order = baker.make(Order, user=user, state='new')
+        for product_info in product_infos:
+            baker.make(OrderItem, order=order, product_info=product_info, quantity=2)
+        stale = Order.objects.get(id=order.id)
+
+        with patch('backend.catalog.invalidate_tags_on_commit') as invalidate:
+            response = authenticated_buyer_client.post('/order/cancel/', {'order_id': order.id})
+        assert response.status_code == status.HTTP_200_OK
+        assert invalidate.call_count == 1
+
+        with pytest.raises(OrderStateException):
+            change_state(stale, 'canceled')
+        assert sorted(ProductInfo.objects.values_list('quantity', flat=True)) == [7, 7, 7]
+
+
+class TestOrderStateMachine:
+    @pytest.mark.django_db
+    def test_forward_transitions_keep_stock(self, buyer_user, product_info):
+        """Тест переходов заказа по статусам до доставки без повторного списания"""
+        order = baker.make(Order, user=buyer_user, state='new')
+        baker.make(OrderItem, order=order, product_info=product_info, quantity=1)
+        quantity = product_info.quantity
+
+        for state in ('confirmed', 'assembled', 'sent', 'delivered'):
+            change_state(order, state)
+            assert Order.objects.get(id=order.id).state == state
+
+        product_info.refresh_from_db()
+        assert product_info.quantity == quantity
+
+    @pytest.mark.django_db
+    def test_invalid_transition(self, buyer_user):
+        """Тест что переходы вне ORDER_TRANSITIONS запрещены"""
+        order = baker.make(Order, user=buyer_user, state='sent')
+        with pytest.raises(OrderStateException):
+            change_state(order, 'new')
+        with pytest.raises(OrderStateException):
+            change_state(baker.make(Order, user=buyer_user, state='delivered'), 'canceled')
+        assert Order.objects.get(id=order.id).state == 'sent'
+
+    @pytest.mark.django_db(transaction=True)
+    def test_state_change_invalidates_cacheops(self, buyer_user, product_info, cacheops_enabled):
+        """Тест что закешированные cacheops запросы корзины не видят оформленный заказ"""
+        order = baker.make(Order, user=buyer_user, state='basket')
+        baker.make(OrderItem, order=order, product_info=product_info, quantity=1)
+        cart = DatabaseCart(buyer_user.id)
+        assert cart.exists()
+        assert cart._order().id == order.id
+        assert Order.objects.filter(user=buyer_user, state='new').count() == 0
+
+        change_state(order, 'new')
+
+        assert not cart.exists()
+        assert cart._order() is None
+        assert Order.objects.filter(user=buyer_user, state='new').count() == 1
@@ -1,8 +1,19 @@
 # test_products_fixed.py
 import pytest
+from unittest.mock import patch
+from django.core.cache import cache
+from django.db import transaction
+from django_redis import get_redis_connection
 from rest_framework import status
 from model_bakery import baker
-from backend.models import Shop, Category, Product, ProductInfo
+from rest_framework.request import Request
+from rest_framework.test import APIRequestFactory
+from backend.models import Shop, Category, Product, ProductInfo, Parameter, ProductParameter, FacetCount, CatalogEntry
+from backend.pagination import ProductCursorPagination, ProductPageNumberPagination, MAX_PAGE_SIZE
+from backend.search import (InvertedIndex, get_inverted_index, search_products, stem, SEARCH_BACKEND_INVERTED,
+                            SEARCH_BACKEND_POSTGRES, SEARCH_INDEX_CHANGES_KEY)
+from backend.facets import parse_number, refresh_facet_counts
+from backend.catalog import catalog_entries, refresh_shop_catalog, stock_changed
 
 
 class TestProductListView:
@@ -284,4 +295,342 @@ class TestShopListView:
             assert 'id' in shop_data
             assert 'name' in shop_data
             assert 'url' in shop_data
-            assert 'user_email' in shop_data
\ No newline at end of file
+            assert 'user_email' in shop_data
+
+class TestProductPagination:
+    @staticmethod
+    def paginate(paginator, url, queryset):
+        request = Request(APIRequestFactory().get(url))
+        page = paginator.paginate_queryset(queryset, request)
+        return [product_info.id for product_info in page], paginator
+
+    @pytest.mark.django_db
+    def test_cursor_pagination_walks_all_pages(self):
+        """Тест обхода всех товаров по курсору без пропусков и повторов"""
+        product_infos = baker.make(ProductInfo, quantity=5, _quantity=25)
+        queryset = ProductInfo.objects.order_by('id')
+
+        seen = []
+        url = '/products/?pagination=cursor&page_size=10'
+        while url:
+            ids, paginator = self.paginate(ProductCursorPagination(), url, queryset)
+            seen.extend(ids)
+            url = paginator.get_next_link()
+
+        assert seen == sorted(product_info.id for product_info in product_infos)
+
+    @pytest.mark.django_db
+    def test_cursor_pagination_skips_count(self, django_assert_num_queries):
+        """Тест что страница по курсору выполняется одним запросом без COUNT(*)"""
+        baker.make(ProductInfo, quantity=5, _quantity=5)
+
+        with django_assert_num_queries(1) as context:
+            self.paginate(ProductCursorPagination(), '/products/?pagination=cursor', ProductInfo.objects.all())
+
+        assert 'COUNT' not in context.captured_queries[0]['sql'].upper()
+
+    @pytest.mark.django_db
+    def test_page_size_has_ceiling(self):
+        """Тест ограничения page_size, заданного клиентом"""
+        baker.make(ProductInfo, quantity=5, _quantity=MAX_PAGE_SIZE + 5)
+        queryset = ProductInfo.objects.order_by('id')
+
+        ids, _ = self.paginate(ProductPageNumberPagination(), '/products/?page_size=100000', queryset)
+        assert len(ids) == MAX_PAGE_SIZE
+
+        ids, _ = self.paginate(ProductCursorPagination(), '/products/?cursor=&page_size=100000', queryset)
+        assert len(ids) == MAX_PAGE_SIZE
+
+
+class TestProductSearch:
+    @pytest.fixture(autouse=True)
+    def inverted_backend(self, settings):
+        settings.PRODUCT_SEARCH_BACKEND = SEARCH_BACKEND_INVERTED
+
+    @staticmethod
+    def search(text):
+        return list(search_products(ProductInfo.objects.all(), text).values_list('name', flat=True))
+
+    def test_stem_strips_russian_endings(self):
+        """Тест что формы слова сводятся к одной основе"""
+        assert stem('Смартфоны') == stem('смартфон') == stem('смартфона')
+        assert stem('Ёлочные') == stem('елочный')
+        assert stem('iPhone') == 'iphone'
+
+    @pytest.mark.django_db
+    def test_search_matches_word_forms(self):
+        """Тест поиска по другой форме слова и по названию продукта"""
+        product = baker.make(Product, name='Смартфон', category=baker.make(Category))
+        baker.make(ProductInfo, product=product, name='Apple iPhone XS', model='apple/iphone/xs', quantity=5)
+        baker.make(ProductInfo, name='Чехол кожаный', model='case', quantity=5)
+
+        assert self.search('смартфоны') == ['Apple iPhone XS']
+        assert self.search('чехлы кожаные') == ['Чехол кожаный']
+
+    @pytest.mark.django_db
+    def test_search_tolerates_typos(self):
+        """Тест нечеткого совпадения по триграммам"""
+        baker.make(ProductInfo, name='Samsung Galaxy S20', model='galaxy-s20', quantity=5)
+
+        assert self.search('samsnug galaxy') == ['Samsung Galaxy S20']
+        assert self.search('nokia') == []
+
+    @pytest.mark.django_db
+    def test_search_orders_by_relevance(self):
+        """Тест что совпадение в названии выше совпадения только в модели"""
+        baker.make(ProductInfo, name='Наушники', model='xiaomi', quantity=5)
+        baker.make(ProductInfo, name='Xiaomi Redmi Note', model='redmi', quantity=5)
+
+        assert self.search('xiaomi') == ['Xiaomi Redmi Note', 'Наушники']
+
+    @pytest.mark.django_db
+    def test_index_updated_after_changes(self, django_capture_on_commit_callbacks):
+        """Тест что индекс в памяти видит новые, измененные и удаленные товары без перестроения"""
+        with django_capture_on_commit_callbacks(execute=True):
+            product_info = baker.make(ProductInfo, name='Телевизор', quantity=5)
+        assert self.search('телевизор') == ['Телевизор']
+        index = get_inverted_index()
+
+        with django_capture_on_commit_callbacks(execute=True):
+            product_info.name = 'Монитор'
+            product_info.save()
+            baker.make(ProductInfo, name='Монитор игровой', quantity=5)
+        assert self.search('телевизор') == []
+        assert self.search('мониторы') == ['Монитор', 'Монитор игровой']
+
+        with django_capture_on_commit_callbacks(execute=True):
+            product_info.delete()
+        assert self.search('монитор') == ['Монитор игровой']
+        assert get_inverted_index() is index
+        assert 'телевизор' not in index.postings
+
+    @pytest.mark.django_db
+    def test_postgres_backend_skips_index_journal(self, settings, django_capture_on_commit_callbacks):
+        """Тест что при поиске в Postgres изменения товаров не пишутся в журнал индекса в памяти"""
+        settings.PRODUCT_SEARCH_BACKEND = SEARCH_BACKEND_POSTGRES
+        with django_capture_on_commit_callbacks(execute=True):
+            baker.make(ProductInfo, name='Телевизор', quantity=5).delete()
+
+        assert not get_redis_connection('default').exists(cache.make_key(SEARCH_INDEX_CHANGES_KEY))
+
+    @pytest.mark.django_db
+    def test_filters_applied_before_result_limit(self, monkeypatch):
+        """Тест что фильтр находит товары за пределами SEARCH_MAX_RESULTS лучших совпадений"""
+        monkeypatch.setattr('backend.search.SEARCH_MAX_RESULTS', 2)
+        first, second = baker.make(Shop), baker.make(Shop)
+        for _ in range(3):
+            baker.make(ProductInfo, name='Чайник', shop=first, quantity=5)
+        baker.make(ProductInfo, name='Чайник', shop=second, quantity=5)
+        baker.make(ProductInfo, name='Чайник электрический', shop=second, quantity=5)
+
+        assert search_products(ProductInfo.objects.filter(shop=second), 'чайник').count() == 2
+        assert search_products(ProductInfo.objects.all(), 'чайник').count() == 2
+
+    def test_inverted_index_requires_all_terms(self):
+        """Тест что все слова запроса должны совпасть"""
+        index = InvertedIndex()
+        index.add(1, {'name': 'Красный чайник', 'model': '', 'product_name': 'Чайник'})
+        index.add(2, {'name': 'Синий чайник', 'model': '', 'product_name': 'Чайник'})
+
+        assert [product_info_id for product_info_id, _ in index.search('красные чайники')] == [1]
+        assert len(index.search('чайник')) == 2
+
+
+class TestProductFacets:
+    @pytest.fixture
+    def catalog(self):
+        """Три телефона в одной категории: цвет и память"""
+        shop = baker.make(Shop)
+        category = baker.make(Category)
+        color = baker.make(Parameter, name='Цвет')
+        memory = baker.make(Parameter, name='Встроенная память (Гб)')
+        for name, color_value, memory_value, quantity in (
+            ('Красный 256', 'красный', '256', 5),
+            ('Черный 512', 'черный', '512', 5),
+            ('Красный 64', 'красный', '64', 5),
+            ('Красный 512 нет в наличии', 'красный', '512', 0),
+        ):
+            product_info = baker.make(ProductInfo, name=name, shop=shop, quantity=quantity,
+                                      product=baker.make(Product, category=category))
+            baker.make(ProductParameter, product_info=product_info, parameter=color, value=color_value)
+            baker.make(ProductParameter, product_info=product_info, parameter=memory, value=memory_value)
+        refresh_facet_counts(shop.id)
+        return {'shop': shop, 'category': category, 'color': color, 'memory': memory}
+
+    @staticmethod
+    def facet_values(data, parameter):
+        facet = next(facet for facet in data['Facets'] if facet['id'] == parameter.id)
+        return {value['value']: value['count'] for value in facet['values']}
+
+    def test_parse_number(self):
+        """Тест разбора числовых значений параметров"""
+        assert parse_number('256') == 256
+        assert parse_number('6,1') == 6.1
+        assert parse_number(6.5) == 6.5
+        assert parse_number('2688x1242') is None
+        assert parse_number('красный') is None
+
+    @pytest.mark.django_db
+    def test_precomputed_counts_only_in_stock(self, catalog):
+        """Тест предрасчитанных счетчиков по товарам в наличии"""
+        counts = FacetCount.objects.filter(parameter=catalog['color'])
+        assert {count.value: count.count for count in counts} == {'красный': 2, 'черный': 1}
+        assert FacetCount.objects.get(parameter=catalog['memory'], value='512').value_number == 512
+
+    @pytest.mark.django_db
+    def test_facets_from_precomputed_counts(self, api_client, catalog, django_assert_max_num_queries):
+        """Тест что без фильтров фасеты читаются из FacetCount, без агрегации параметров товаров"""
+        with django_assert_max_num_queries(2) as context:
+            response = api_client.get(f"/products/facets/?category_id={catalog['category'].id}")
+        assert not any('backend_productparameter' in query['sql'] for query in context.captured_queries)
+
+        assert response.status_code == status.HTTP_200_OK
+        data = response.json()
+        assert self.facet_values(data, catalog['color']) == {'красный': 2, 'черный': 1}
+        memory = next(facet for facet in data['Facets'] if facet['id'] == catalog['memory'].id)
+        assert [value['value'] for value in memory['values']] == ['64', '256', '512']
+        assert (memory['min'], memory['max']) == (64, 512)
+
+    @pytest.mark.django_db
+    def test_facets_with_filters(self, api_client, catalog):
+        """Тест счетчиков при фильтре: у фильтруемого параметра его собственный фильтр не учитывается"""
+        response = api_client.get(
+            f"/products/facets/?param_{catalog['color'].id}=красный&param_{catalog['memory'].id}__gte=256"
+        )
+
+        data = response.json()
+        assert self.facet_values(data, catalog['color']) == {'красный': 1, 'черный': 1}
+        assert self.facet_values(data, catalog['memory']) == {'256': 1, '64': 1}
+
+    @pytest.mark.django_db
+    def test_filter_products_by_parameters(self, catalog):
+        """Тест фильтра по значениям и диапазону: значения одного параметра через ИЛИ"""
+        from backend.facets import filter_by_parameters
+
+        products = ProductInfo.objects.filter(quantity__gt=0)
+        filters = {catalog['color'].id: {'values': ['красный', 'черный']}, catalog['memory'].id: {'gte': 256}}
+        names = set(filter_by_parameters(products, filters).values_list('name', flat=True))
+        assert names == {'Красный 256', 'Черный 512'}
+
+    @pytest.mark.django_db
+    def test_facets_invalid_range(self, api_client, catalog):
+        """Тест ошибки при нечисловой границе диапазона"""
+        response = api_client.get(f"/products/facets/?param_{catalog['memory'].id}__gte=много")
+        assert response.status_code == status.HTTP_400_BAD_REQUEST
+        assert response.json()['Status'] is False
+
+    @pytest.mark.django_db(transaction=True)
+    def test_saves_in_transaction_queue_one_refresh(self, catalog):
+        """Тест что товар и его параметры, сохраненные в одной транзакции, пересчитывают категорию один раз"""
+        product_info = ProductInfo.objects.filter(shop=catalog['shop'], quantity__gt=0).first()
+        with patch('backend.tasks.refresh_facets.delay') as delay:
+            with transaction.atomic():
+                product_info.quantity = 0
+                product_info.save()
+                for product_parameter in product_info.product_parameters.all():
+                    product_parameter.value = 'белый'
+                    product_parameter.save()
+
+        delay.assert_called_once_with(catalog['shop'].id, [catalog['category'].id])
+
+    @pytest.mark.django_db(transaction=True)
+    def test_refresh_after_rollback(self, catalog):
+        """Тест что откат транзакции не оставляет пакет пересчетов следующей транзакции"""
+        product_info = ProductInfo.objects.filter(shop=catalog['shop'], quantity__gt=0).first()
+        with patch('backend.tasks.refresh_facets.delay') as delay:
+            with pytest.raises(RuntimeError):
+                with transaction.atomic():
+                    product_info.quantity = 0
+                    product_info.save()
+                    raise RuntimeError
+            assert not delay.called
+
+            with transaction.atomic():
+                product_info.quantity = 0
+                product_info.save()
+
+        delay.assert_called_once_with(catalog['shop'].id, [catalog['category'].id])
+
+
+class TestCatalogReadModel:
+    @pytest.fixture
+    def product_info(self):
+        category = baker.make(Category, name='Смартфоны')
+        product_info = baker.make(ProductInfo, name='iPhone', quantity=3, price=1000,
+                                  shop=baker.make(Shop, name='Связной'),
+                                  product=baker.make(Product, category=category))
+        baker.make(ProductParameter, product_info=product_info, value='черный',
+                   parameter=baker.make(Parameter, name='Цвет'))
+        return product_info
+
+    @pytest.mark.django_db
+    def test_entry_matches_product_info(self, product_info):
+        """Тест что строка каталога совпадает с прежним форматом ответа ProductListView"""
+        parameter = product_info.product_parameters.get()
+        assert CatalogEntry.objects.get(id=product_info.id).as_dict() == {
+            'id': product_info.id,
+            'external_id': product_info.external_id,
+            'product_id': product_info.product_id,
+            'name': 'iPhone',
+            'model': product_info.model,
+            'price': 1000,
+            'price_rrc': product_info.price_rrc,
+            'quantity': 3,
+            'shop': {'id': product_info.shop_id, 'name': 'Связной'},
+            'category': {'id': product_info.product.category_id, 'name': 'Смартфоны'},
+            'parameters': [{'id': parameter.parameter_id, 'name': 'Цвет', 'value': 'черный'}],
+        }
+
+    @pytest.mark.django_db
+    def test_entry_follows_changes(self, product_info):
+        """Тест обновления строки при изменении товара, категории, магазина и удалении"""
+        product_info.price = 900
+        product_info.save()
+        product_info.product.category.name = 'Телефоны'
+        product_info.product.category.save()
+        product_info.shop.name = 'Евросеть'
+        product_info.shop.save()
+
+        entry = CatalogEntry.objects.get(id=product_info.id)
+        assert (entry.price, entry.category_name, entry.shop_name) == (900, 'Телефоны', 'Евросеть')
+
+        product_info.delete()
+        assert not CatalogEntry.objects.exists()
+
+    @pytest.mark.django_db
+    def test_catalog_page_is_single_query(self, product_info, django_assert_num_queries):
+        """Тест что страница каталога - один запрос без JOIN"""
+        with django_assert_num_queries(1) as context:
+            entries = list(catalog_entries({'category_id': product_info.product.category_id})[:20])
+
+        assert [entry.id for entry in entries] == [product_info.id]
+        assert 'JOIN' not in context.captured_queries[0]['sql'].upper()
+
+    @pytest.mark.django_db
+    def test_refresh_shop_catalog_removes_stale_rows(self, product_info):
+        """Тест полной перестройки каталога магазина"""
+        baker.make(CatalogEntry, id=product_info.id + 1000, shop_id=product_info.shop_id)
+        CatalogEntry.objects.filter(id=product_info.id).update(price=1)
+
+        assert refresh_shop_catalog(product_info.shop_id) == 1
+        assert list(CatalogEntry.objects.values_list('id', 'price')) == [(product_info.id, 1000)]
+
+    @pytest.mark.django_db(transaction=True)
+    def test_stock_changed_invalidates_cacheops(self, product_info, cacheops_enabled):
+        """Тест что после изменения остатков UPDATE-ом cacheops не отдает старый остаток"""
+        assert ProductInfo.objects.get(id=product_info.id).quantity == 3
+
+        with transaction.atomic():
+            ProductInfo.objects.filter(id=product_info.id).update(quantity=1)
+            stock_changed([product_info.id])
+
+        assert ProductInfo.objects.get(id=product_info.id).quantity == 1
+        assert CatalogEntry.objects.get(id=product_info.id).quantity == 1
+
+    @pytest.mark.django_db
+    def test_entry_quantity_without_held(self, product_info):
+        """Тест что остаток строки показывается за вычетом резервов корзин"""
+        entry = CatalogEntry.objects.get(id=product_info.id)
+
+        assert entry.as_dict(2)['quantity'] == 1
+        assert entry.as_dict(5)['quantity'] == 0
@@ -1,26 +1,23 @@
 from django.contrib.auth import authenticate
 from django.core.validators import URLValidator
-from django.http import JsonResponse
+from django.http import JsonResponse, HttpResponse
 from django.shortcuts import render
 from django.utils.decorators import method_decorator
 from django.views.decorators.csrf import csrf_exempt
-from rest_framework.exceptions import ValidationError
-from rest_framework.pagination import PageNumberPagination
+from rest_framework.exceptions import ValidationError, NotFound
 from rest_framework.views import APIView
 from rest_framework.response import Response
 from rest_framework import status
-from ujson import loads as load_json
-from yaml import load as load_yaml, Loader
-from requests import get
+from ujson import loads as load_json, dumps as dump_json
 from django.conf import settings
 from rest_framework.authtoken.models import Token
 from backend.models import Shop, Category, ProductInfo, Product, ProductParameter, Parameter, User, new_user_registered, \
-    ConfirmEmailToken, Order, OrderItem, Contact, Address, ProductImage
+    ConfirmEmailToken, Order, OrderItem, Contact, Address, ProductImage, CatalogEntry
 from datetime import timedelta
 from django.utils import timezone
 from rest_framework.authentication import TokenAuthentication
 from rest_framework.permissions import IsAuthenticated
-from .tasks import send_confirmation_email
+from .tasks import send_confirmation_email, import_price_list
 from drf_spectacular.utils import extend_schema, extend_schema_view, OpenApiParameter, OpenApiExample
 from drf_spectacular.types import OpenApiTypes
 from rest_framework.throttling import AnonRateThrottle, UserRateThrottle
@@ -41,12 +38,26 @@ from django.db import DatabaseError
 from rest_framework import status
 from drf_spectacular.utils import extend_schema, OpenApiResponse
 from backend.exceptions import PaymentProcessingException, InventoryException, \
-    ExternalAPIException, DataValidationException
+    ExternalAPIException, DataValidationException, OrderStateException
 from rest_framework.views import exception_handler
 from backend.exceptions import BaseAPIException
-from django.views.decorators.cache import cache_page
-from django.utils.decorators import method_decorator
-from backend.cache_utils import cached_view, CacheManager, cache_metrics
+from backend.cache_utils import (cached_view, CacheManager, cache_metrics, add_cache_tags, invalidate_tags,
+                                 bump_generation, shop_tag, category_tag, product_tag, product_list_tag,
+                                 shop_namespace, category_namespace, CATEGORY_LIST_TAG, SHOP_LIST_TAG,
+                                 CATALOG_NAMESPACE, NAMESPACE_RE)
+from backend.importer import IMPORT_MODES, IMPORT_MODE_SYNC
+from backend.import_jobs import ImportJob
+from backend.feed_parsers import FEED_FORMATS
+from backend.feed_shards import MAX_SHARDS
+from backend.pagination import ProductPageNumberPagination, ProductCursorPagination
+from backend.search import search_products
+from backend.facets import parse_parameter_filters, filter_by_parameters, get_facets
+from backend.catalog import catalog_entries
+from backend.carts import get_cart, CART_BATCH_MAX_ITEMS
+from backend.stock import (order_lines, unavailable_items, held_by_others, held_quantities, hold_stock,
+                           release_holds)
+from backend.orders import change_state
+from django.urls import reverse
 import time
 
 def status_response(status: bool, message: str = ""):
@@ -67,6 +78,19 @@ def status_response(status: bool, message: str = ""):
 class UpdatePrice(APIView):
     """
     Класс для обновления прайса от поставщика
+
+    Импорт выполняется фоновой задачей Celery, в ответе возвращается id задачи
+    для опроса статуса через ImportStatusView.
+
+    Параметр mode: sync (по умолчанию) - синхронизация с текущим каталогом по external_id,
+    replace - удаление каталога магазина и загрузка заново.
+    Параметр format: yaml, jsonl или csv (по умолчанию определяется по url).
+    Если прайс не изменился (304 или тот же хеш), импорт пропускается;
+    параметр force=true загружает прайс в любом случае.
+    Параметр shards > 1 делит товары прайса на части, которые импортируются
+    параллельно отдельными задачами Celery (только в режиме sync).
+    Параметр dry_run=true только проверяет прайс, отчет об ошибках
+    возвращается в статусе задачи, БД не изменяется
     """
     throttle_classes = [PartnerRateThrottle]
     authentication_classes = [TokenAuthentication]
@@ -80,6 +104,25 @@ class UpdatePrice(APIView):
                                                 'Вход только для магазинов'),status=403)
 
         url = request.data.get('url')
+        mode = request.data.get('mode', IMPORT_MODE_SYNC)
+        if mode not in IMPORT_MODES:
+            return JsonResponse(status_response(False,
+                                                f'Режим импорта должен быть одним из: {", ".join(IMPORT_MODES)}'),
+                                status=400)
+        feed_format = request.data.get('format')
+        if feed_format and feed_format not in FEED_FORMATS:
+            return JsonResponse(status_response(False,
+                                                f'Формат прайса должен быть одним из: {", ".join(FEED_FORMATS)}'),
+                                status=400)
+        try:
+            shards = int(request.data.get('shards', 1))
+        except (TypeError, ValueError):
+            shards = 0
+        if not 1 <= shards <= MAX_SHARDS:
+            return JsonResponse(status_response(False, f'shards должен быть от 1 до {MAX_SHARDS}'), status=400)
+        if shards > 1 and mode != IMPORT_MODE_SYNC:
+            return JsonResponse(status_response(False, 'Параллельный импорт доступен только в режиме sync'),
+                                status=400)
         if url:
             validate_url = URLValidator()
             try:
@@ -87,35 +130,38 @@ class UpdatePrice(APIView):
             except ValidationError as e:
                 return JsonResponse(status_response(False, str(e)))
             else:
-                stream = get(url).content
-                data = load_yaml(stream, Loader=Loader)
-                shop, _ = Shop.objects.get_or_create(name=data['shop'], user_id=request.user.id)
-                for category in data['categories']:
-                    category_object, created = Category.objects.get_or_create(id=category['id'], name=category['name'])
-                    category_object.shops.add(shop.id)
-                    category_object.save()
-                ProductInfo.objects.filter(shop_id=shop.id).delete()
-                for item in data['goods']:
-                    product, _ = Product.objects.get_or_create(name=item['name'], category_id=item['category'])
-                    product_info = ProductInfo.objects.create(product=product,
-                                                              external_id=item['id'],
-                                                              name=item['name'],
-                                                              model=item.get('model', ''),
-                                                              price=item['price'],
-                                                              price_rrc=item.get('price_rrc'),
-                                                              quantity=item['quantity'],
-                                                              shop=shop
-                                                              )
-                    for name, value in item['parameters'].items():
-                        parameter_object, _ = Parameter.objects.get_or_create(name=name,)
-                        ProductParameter.objects.create(product_info=product_info,
-                                                        parameter=parameter_object,
-                                                        value=value)
-
-                return JsonResponse(status_response(True))
+                force = str(request.data.get('force', '')).lower() in ('1', 'true', 'yes')
+                dry_run = str(request.data.get('dry_run', '')).lower() in ('1', 'true', 'yes')
+                job = ImportJob.create(request.user.id, url, feed_format=feed_format, force=force,
+                                       shards=shards, dry_run=dry_run, mode=mode)
+                import_price_list.delay(job.id)
+
+                return JsonResponse({
+                    **status_response(True, 'Проверка прайса поставлена в очередь' if dry_run
+                                      else 'Импорт прайса поставлен в очередь'),
+                    'JobId': job.id,
+                    'StatusUrl': reverse('partner_update_status', kwargs={'job_id': job.id}),
+                }, status=202)
         return JsonResponse(status_response(False,'Не указаны все необходимые аргументы')
                             )
 
+class ImportStatusView(APIView):
+    """
+    Класс для получения статуса фоновой задачи импорта прайса
+    """
+    authentication_classes = [TokenAuthentication]
+    permission_classes = [IsAuthenticated]
+
+    def get(self, request, *args, **kwargs):
+        job = ImportJob.get(kwargs.get('job_id'))
+        if job is None or job.user_id != request.user.id:
+            return JsonResponse(status_response(False, 'Задача импорта не найдена'), status=404)
+
+        return JsonResponse({
+            **status_response(True),
+            'Job': job.to_dict(),
+        })
+
 class UserLogin(APIView):
     """
     Аутентификация пользователя в системе.
@@ -380,6 +426,39 @@ class GettingKeyAgain(APIView):
             )
 
 
+def product_list_namespaces(request):
+    """
+    Пространства имен кеша страницы товаров: весь каталог и магазин и категория из фильтров
+    """
+    namespaces = [CATALOG_NAMESPACE]
+    shop_id = request.GET.get('shop_id', '')
+    if shop_id.isdigit():
+        namespaces.append(shop_namespace(int(shop_id)))
+    category_id = request.GET.get('category_id', '')
+    if category_id.isdigit():
+        namespaces.append(category_namespace(int(category_id)))
+    return namespaces
+
+
+def filter_products(products, query_params):
+    """
+    Фильтрация товаров по магазину и категории и поиск по названию
+    (по названию, модели и названию продукта, сортировка по релевантности)
+    """
+    shop_id = query_params.get('shop_id')
+    if shop_id:
+        products = products.filter(shop_id=shop_id)
+
+    category_id = query_params.get('category_id')
+    if category_id:
+        products = products.filter(product__category_id=category_id)
+
+    product_name = query_params.get('name')
+    if product_name:
+        products = search_products(products, product_name)
+    return products
+
+
 @extend_schema_view(
     get=extend_schema(
         summary="Получить список товаров",
@@ -390,6 +469,7 @@ class GettingKeyAgain(APIView):
         - shop_id: фильтрация по магазину
         - category_id: фильтрация по категории  
         - name: поиск по названию товара
+        - param_<id>: значение параметра (можно несколько раз), param_<id>__gte / __lte: диапазон
         """,
         parameters=[
             OpenApiParameter(
@@ -429,75 +509,53 @@ class ProductListView(APIView):
     """
         Класс для получения списка товаров с пагинацией и кешированием
 
+        Товары читаются из денормализованного каталога CatalogEntry (backend.catalog).
         Предоставляет возможность:
-        - Просмотра списка товаров с пагинацией
-        - Фильтрации по магазину, категории и названию
+        - Просмотра списка товаров с пагинацией по номеру страницы
+          или по курсору (pagination=cursor, без COUNT(*) и OFFSET)
+        - Фильтрации по магазину, категории, параметрам (param_<id>=значение,
+          param_<id>__gte/__lte=число) и поиска по названию (backend.search)
         - Получения детальной информации о каждом товаре
     """
     throttle_classes = [AnonRateThrottle]
 
-    @method_decorator(cache_page(60 * 15))
-    @cached_view(timeout=60 * 15, key_prefix="product_list_view")  # Дополнительное кеширование
+    @cached_view(timeout=60 * 15, key_prefix="product_list_view",
+                 namespaces=product_list_namespaces)
     def get(self, request, *args, **kwargs):
         try:
             start_time = time.time()
 
-            # Базовый queryset с оптимизацией запросов
-            products = ProductInfo.objects.filter(
-                quantity__gt=0
-            ).select_related(
-                'product', 'shop', 'product__category'
-            ).prefetch_related(
-                'product_parameters__parameter'
-            ).order_by('id')
+            filters = parse_parameter_filters(request.query_params)
+            product_name = request.query_params.get('name')
 
-            # Фильтрация
-            shop_id = request.query_params.get('shop_id')
-            if shop_id:
-                products = products.filter(shop_id=shop_id)
+            if product_name:
+                # Поиск ранжирует ProductInfo; для страницы подставляются готовые строки каталога
+                products = filter_by_parameters(ProductInfo.objects.filter(quantity__gt=0), filters)
+                products = filter_products(products, request.query_params).values_list('id', flat=True)
+                # Результаты поиска упорядочены по релевантности, а не по id, поэтому только по страницам
+                paginator = ProductPageNumberPagination()
+                page_ids = paginator.paginate_queryset(products, request, view=self)
+                entries = CatalogEntry.objects.in_bulk(page_ids)
+                paginated_products = [entries[product_info_id] for product_info_id in page_ids
+                                      if product_info_id in entries]
+            else:
+                # Денормализованный каталог: страница читается одним запросом без JOIN и prefetch
+                products = filter_by_parameters(catalog_entries(request.query_params), filters)
+                if ProductCursorPagination.is_requested(request):
+                    paginator = ProductCursorPagination()
+                else:
+                    paginator = ProductPageNumberPagination()
+                paginated_products = paginator.paginate_queryset(products, request, view=self)
 
-            category_id = request.query_params.get('category_id')
-            if category_id:
-                products = products.filter(product__category_id=category_id)
+            # Зависимости закешированной страницы: состав списка и показанные товары, магазины, категории
+            add_cache_tags(product_list_tag(request.query_params.get('shop_id'),
+                                            request.query_params.get('category_id')))
+            for entry in paginated_products:
+                add_cache_tags(product_tag(entry.id), shop_tag(entry.shop_id), category_tag(entry.category_id))
 
-            product_name = request.query_params.get('name')
-            if product_name:
-                products = products.filter(name__icontains=product_name)
-
-            # Пагинация
-            paginator = PageNumberPagination()
-            paginator.page_size = request.query_params.get('page_size', 20)
-            paginated_products = paginator.paginate_queryset(products, request)
-
-            # Подготовка данных
-            product_list = []
-            for product_info in paginated_products:
-                product_data = {
-                    'id': product_info.id,
-                    'external_id': product_info.external_id,
-                    'product_id': product_info.product.id if product_info.product else None,
-                    'name': product_info.name,
-                    'model': product_info.model,
-                    'price': product_info.price,
-                    'price_rrc': product_info.price_rrc,
-                    'quantity': product_info.quantity,
-                    'shop': {
-                        'id': product_info.shop.id,
-                        'name': product_info.shop.name
-                    },
-                    'category': {
-                        'id': product_info.product.category.id if product_info.product and product_info.product.category else None,
-                        'name': product_info.product.category.name if product_info.product and product_info.product.category else None
-                    },
-                    'parameters': [
-                        {
-                            'id': param.parameter.id,
-                            'name': param.parameter.name,
-                            'value': param.value
-                        } for param in product_info.product_parameters.all()
-                    ]
-                }
-                product_list.append(product_data)
+            # Остаток показывается за вычетом резервов корзин
+            held = held_quantities(entry.id for entry in paginated_products)
+            product_list = [entry.as_dict(held.get(entry.id, 0)) for entry in paginated_products]
 
             response_data = {
                 'Status': True,
@@ -505,10 +563,55 @@ class ProductListView(APIView):
                 'ExecutionTimeMs': round((time.time() - start_time) * 1000, 2)
             }
 
-            # Добавляем пагинацию к ответу
+            # Добавляем пагинацию к ответу; ujson сериализует страницу в разы быстрее JSONRenderer
             response = paginator.get_paginated_response(response_data)
-            return response
+            return HttpResponse(dump_json(response.data, ensure_ascii=False, escape_forward_slashes=False),
+                                content_type='application/json')
+
+        except NotFound as e:
+            return Response({
+                'Status': False,
+                'Error': str(e.detail)
+            }, status=404)
+        except DataValidationException as e:
+            return Response({
+                'Status': False,
+                'Error': str(e.detail)
+            }, status=400)
+        except Exception as e:
+            return Response({
+                'Status': False,
+                'Error': str(e)
+            }, status=500)
+
+
+class ProductFacetsView(APIView):
+    """
+        Класс для получения фасетов: значений параметров с числом товаров
+
+        Принимает те же фильтры, что и список товаров (shop_id, category_id,
+        name, param_<id>, param_<id>__gte, param_<id>__lte). Без поиска и
+        фильтров по параметрам счетчики берутся из предрасчитанной таблицы FacetCount.
+    """
+    throttle_classes = [AnonRateThrottle]
 
+    def get(self, request, *args, **kwargs):
+        try:
+            filters = parse_parameter_filters(request.query_params)
+            products = filter_products(ProductInfo.objects.filter(quantity__gt=0), request.query_params)
+            facets = get_facets(
+                products, filters,
+                shop_id=request.query_params.get('shop_id'),
+                category_id=request.query_params.get('category_id'),
+                searched=bool(request.query_params.get('name')),
+            )
+            return Response({'Status': True, 'Facets': facets})
+
+        except DataValidationException as e:
+            return Response({
+                'Status': False,
+                'Error': str(e.detail)
+            }, status=400)
         except Exception as e:
             return Response({
                 'Status': False,
@@ -521,8 +624,7 @@ class CategoryListView(APIView):
     Класс для получения списка категорий
     """
 
-    @method_decorator(cache_page(60 * 60))  # Кеширование на 1 час
-    @cached_view(timeout=60 * 60, key_prefix="category_list_view")
+    @cached_view(timeout=60 * 60, key_prefix="category_list_view", namespaces=[CATALOG_NAMESPACE])  # 1 час
     def get(self, request, *args, **kwargs):
         start_time = time.time()
 
@@ -536,6 +638,8 @@ class CategoryListView(APIView):
                 'shops': [shop.name for shop in category.shops.all()]
             }
             category_list.append(category_data)
+            add_cache_tags(category_tag(category.id), *[shop_tag(shop.id) for shop in category.shops.all()])
+        add_cache_tags(CATEGORY_LIST_TAG)
 
         return Response({
             'Status': True,
@@ -549,8 +653,7 @@ class ShopListView(APIView):
     Класс для получения списка магазинов
     """
 
-    @method_decorator(cache_page(60 * 30))  # Кеширование на 30 минут
-    @cached_view(timeout=60 * 30, key_prefix="shop_list_view")
+    @cached_view(timeout=60 * 30, key_prefix="shop_list_view", namespaces=[CATALOG_NAMESPACE])  # 30 минут
     def get(self, request, *args, **kwargs):
         start_time = time.time()
 
@@ -565,6 +668,8 @@ class ShopListView(APIView):
                 'user_email': shop.user.email if shop.user else None
             }
             shop_list.append(shop_data)
+            add_cache_tags(shop_tag(shop.id))
+        add_cache_tags(SHOP_LIST_TAG)
 
         return Response({
             'Status': True,
@@ -625,43 +730,38 @@ class CartView(APIView):
 
     def get(self, request, *args, **kwargs):
         try:
-            # Находим корзину пользователя (статус 'basket')
-            cart = Order.objects.filter(
-                user=request.user,
-                state='basket'
-            ).prefetch_related(
-                'ordered_items__product_info__shop',
-                'ordered_items__product_info__product__category'
-            ).first()
+            # Корзина пользователя из хранилища CART_BACKEND (БД или Redis)
+            contents = get_cart(request.user.id).contents()
 
-            if not cart:
+            if not contents:
                 return JsonResponse({
                     'Status': True,
                     'Message': 'Корзина пуста',
                     'Cart': {}
                 })
 
+            order_id, lines = contents
             # Собираем данные корзины
             cart_data = {
-                'order_id': cart.id,
-                'total_items': cart.ordered_items.count(),
+                'order_id': order_id,
+                'total_items': len(lines),
                 'total_amount': 0,
                 'items': []
             }
 
             total_amount = 0
-            for item in cart.ordered_items.all():
-                item_amount = item.product_info.price * item.quantity
+            for line in lines:
+                item_amount = line['price'] * line['quantity']
                 total_amount += item_amount
 
                 item_data = {
-                    'id': item.id,
-                    'product_name': item.product_info.name,
-                    'shop': item.product_info.shop.name,
-                    'quantity': item.quantity,
-                    'price': item.product_info.price,
+                    'id': line['id'],
+                    'product_name': line['product_name'],
+                    'shop': line['shop'],
+                    'quantity': line['quantity'],
+                    'price': line['price'],
                     'amount': item_amount,
-                    'product_info_id': item.product_info.id
+                    'product_info_id': line['product_info_id']
                 }
                 cart_data['items'].append(item_data)
 
@@ -718,34 +818,31 @@ class AddToCartView(APIView):
 
             # Проверяем существование товара
             try:
-                product_info = ProductInfo.objects.get(id=product_info_id, quantity__gte=quantity)
+                product_info = ProductInfo.objects.select_related('shop').get(id=product_info_id, quantity__gte=quantity)
             except ProductInfo.DoesNotExist:
                 return JsonResponse({
                     'Status': False,
                     'Error': 'Товар не найден или недостаточно на складе'
                 }, status=404)
 
-            # Находим или создаем корзину пользователя
-            cart, created = Order.objects.get_or_create(
-                user=request.user,
-                state='basket',
-                defaults={'contact': None}
-            )
+            cart = get_cart(request.user.id)
 
-            # Добавляем товар в корзину
-            order_item, created = OrderItem.objects.get_or_create(
-                order=cart,
-                product_info=product_info,
-                defaults={'quantity': quantity}
-            )
+            # Резервируем все количество товара в корзине на STOCK_HOLD_TIMEOUT (если резервы включены)
+            in_cart = cart.quantity(product_info.id)
+            try:
+                hold_stock(product_info.id, request.user.id, in_cart + quantity, product_info.quantity)
+            except InventoryException as e:
+                return JsonResponse({
+                    'Status': False,
+                    'Error': f"{e.detail}. Доступно: {max(e.extra_context['available'] - in_cart, 0)}"
+                }, status=400)
 
-            if not created:
-                order_item.quantity += quantity
-                order_item.save()
+            # Добавляем товар в корзину (если уже есть - увеличиваем количество)
+            total = cart.add(product_info, quantity)
 
             return JsonResponse({
                 'Status': True,
-                'Message': f'Товар добавлен в корзину. Всего: {order_item.quantity} шт.'
+                'Message': f'Товар добавлен в корзину. Всего: {total} шт.'
             })
 
         except ValueError:
@@ -760,6 +857,120 @@ class AddToCartView(APIView):
             }, status=500)
 
 
+
+@extend_schema_view(
+    post=extend_schema(
+        summary="Добавить несколько товаров в корзину",
+        description="Пакетное добавление товаров одним запросом вместо cart/add/ на каждый товар. "
+                    "Строки с ошибками пропускаются, результат возвращается по каждой строке",
+        request={
+            'application/json': {
+                'type': 'object',
+                'required': ['items'],
+                'properties': {
+                    'items': {
+                        'type': 'array',
+                        'items': {
+                            'type': 'object',
+                            'required': ['product_info_id', 'quantity'],
+                            'properties': {
+                                'product_info_id': {'type': 'integer', 'example': 1},
+                                'quantity': {'type': 'integer', 'example': 2}
+                            }
+                        }
+                    }
+                }
+            }
+        },
+        auth=['TokenAuth']
+    )
+)
+class BatchAddToCartView(APIView):
+    """
+    Пакетное добавление товаров в корзину.
+
+    Все товары проверяются одним запросом к ProductInfo и добавляются
+    в корзину одной операцией (upsert в OrderItem или один HSET в Redis).
+    """
+    authentication_classes = [TokenAuthentication]
+    permission_classes = [IsAuthenticated]
+
+    def post(self, request, *args, **kwargs):
+        try:
+            items = request.data.get('items')
+            if not isinstance(items, list) or not items:
+                return JsonResponse({
+                    'Status': False,
+                    'Error': 'Не указан список items'
+                }, status=400)
+
+            if len(items) > CART_BATCH_MAX_ITEMS:
+                return JsonResponse({
+                    'Status': False,
+                    'Error': f'Не более {CART_BATCH_MAX_ITEMS} товаров за запрос'
+                }, status=400)
+
+            # Разбираем строки, результат по каждой строке в порядке запроса
+            results = []
+            requested = []
+            seen = set()
+            for item in items:
+                result = {'product_info_id': item.get('product_info_id') if isinstance(item, dict) else None}
+                results.append(result)
+                try:
+                    product_info_id = int(item['product_info_id'])
+                    quantity = int(item['quantity'])
+                except (TypeError, KeyError, ValueError):
+                    result.update(Status=False, Error='Неверный формат product_info_id или quantity')
+                    continue
+                result['quantity'] = quantity
+                if quantity <= 0:
+                    result.update(Status=False, Error='Количество должно быть больше 0')
+                elif product_info_id in seen:
+                    result.update(Status=False, Error='Товар указан несколько раз')
+                else:
+                    seen.add(product_info_id)
+                    requested.append((result, product_info_id, quantity))
+
+            # Проверяем все товары одним запросом
+            product_infos = ProductInfo.objects.select_related('shop').in_bulk(
+                [product_info_id for _, product_info_id, _ in requested])
+            cart = get_cart(request.user.id)
+            in_cart = cart.quantities(product_infos)
+
+            accepted = []
+            for result, product_info_id, quantity in requested:
+                product_info = product_infos.get(product_info_id)
+                if product_info is None or product_info.quantity < quantity:
+                    result.update(Status=False, Error='Товар не найден или недостаточно на складе')
+                    continue
+                try:
+                    hold_stock(product_info_id, request.user.id, in_cart.get(product_info_id, 0) + quantity,
+                               product_info.quantity)
+                except InventoryException as e:
+                    available = max(e.extra_context.get('available', 0) - in_cart.get(product_info_id, 0), 0)
+                    result.update(Status=False, Error=f"{e.detail}. Доступно: {available}")
+                    continue
+                accepted.append((result, product_info, quantity))
+
+            # Добавляем все проверенные товары одной операцией
+            if accepted:
+                totals = cart.add_many([(product_info, quantity) for _, product_info, quantity in accepted])
+                for result, product_info, _ in accepted:
+                    result.update(Status=True, in_cart=totals[product_info.id])
+
+            return JsonResponse({
+                'Status': True,
+                'Message': f'Добавлено товаров: {len(accepted)} из {len(items)}',
+                'Results': results
+            })
+
+        except Exception as e:
+            return JsonResponse({
+                'Status': False,
+                'Error': str(e)
+            }, status=500)
+
 class RemoveFromCartView(APIView):
     """
     Класс для удаления товара из корзины
@@ -778,29 +989,29 @@ class RemoveFromCartView(APIView):
                 }, status=400)
 
             # Находим корзину пользователя
-            cart = Order.objects.filter(user=request.user, state='basket').first()
-            if not cart:
+            cart = get_cart(request.user.id)
+            if not cart.exists():
                 return JsonResponse({
                     'Status': False,
                     'Error': 'Корзина не найдена'
                 }, status=404)
 
             # Удаляем товар из корзины
-            try:
-                order_item = OrderItem.objects.get(id=item_id, order=cart)
-                order_item.delete()
-
-                return JsonResponse({
-                    'Status': True,
-                    'Message': 'Товар удален из корзины'
-                })
-
-            except OrderItem.DoesNotExist:
+            line = cart.find(item_id)
+            if line is None:
                 return JsonResponse({
                     'Status': False,
                     'Error': 'Товар не найден в корзине'
                 }, status=404)
 
+            cart.remove(item_id)
+            release_holds(request.user.id, [line['product_info_id']])
+
+            return JsonResponse({
+                'Status': True,
+                'Message': 'Товар удален из корзины'
+            })
+
         except Exception as e:
             return JsonResponse({
                 'Status': False,
@@ -833,37 +1044,43 @@ class UpdateCartItemView(APIView):
                 }, status=400)
 
             # Находим корзину пользователя
-            cart = Order.objects.filter(user=request.user, state='basket').first()
-            if not cart:
+            cart = get_cart(request.user.id)
+            if not cart.exists():
                 return JsonResponse({
                     'Status': False,
                     'Error': 'Корзина не найдена'
                 }, status=404)
 
             # Обновляем количество товара
-            try:
-                order_item = OrderItem.objects.get(id=item_id, order=cart)
-
-                # Проверяем доступное количество на складе
-                if order_item.product_info.quantity < quantity:
-                    return JsonResponse({
-                        'Status': False,
-                        'Error': f'Недостаточно товара на складе. Доступно: {order_item.product_info.quantity}'
-                    }, status=400)
-
-                order_item.quantity = quantity
-                order_item.save()
+            line = cart.find(item_id)
+            if line is None:
+                return JsonResponse({
+                    'Status': False,
+                    'Error': 'Товар не найден в корзине'
+                }, status=404)
 
+            # Проверяем доступное количество на складе
+            stock = ProductInfo.objects.filter(id=line['product_info_id']).values_list('quantity', flat=True).first() or 0
+            if stock < quantity:
                 return JsonResponse({
-                    'Status': True,
-                    'Message': f'Количество обновлено: {quantity} шт.'
-                })
+                    'Status': False,
+                    'Error': f'Недостаточно товара на складе. Доступно: {stock}'
+                }, status=400)
 
-            except OrderItem.DoesNotExist:
+            try:
+                hold_stock(line['product_info_id'], request.user.id, quantity, stock)
+            except InventoryException as e:
                 return JsonResponse({
                     'Status': False,
-                    'Error': 'Товар не найден в корзине'
-                }, status=404)
+                    'Error': f"{e.detail}. Доступно: {e.extra_context['available']}"
+                }, status=400)
+
+            cart.update(item_id, quantity)
+
+            return JsonResponse({
+                'Status': True,
+                'Message': f'Количество обновлено: {quantity} шт.'
+            })
 
         except ValueError:
             return JsonResponse({
@@ -887,15 +1104,15 @@ class ClearCartView(APIView):
     def delete(self, request, *args, **kwargs):
         try:
             # Находим корзину пользователя
-            cart = Order.objects.filter(user=request.user, state='basket').first()
-            if not cart:
+            cart = get_cart(request.user.id)
+            if not cart.exists():
                 return JsonResponse({
                     'Status': False,
                     'Error': 'Корзина не найдена'
                 }, status=404)
 
-            # Удаляем все товары из корзины
-            cart.ordered_items.all().delete()
+            # Удаляем все товары из корзины и снимаем их резервы
+            release_holds(request.user.id, cart.clear())
 
             return JsonResponse({
                 'Status': True,
@@ -1164,11 +1381,9 @@ class ConfirmOrderView(APIView):
 
             contact_id = request.data['contact_id']
 
-            # Находим корзину пользователя
-            cart = Order.objects.filter(
-                user=request.user,
-                state='basket'
-            ).prefetch_related('ordered_items').first()
+            # Находим корзину пользователя (корзина из Redis сначала сохраняется в БД)
+            store = get_cart(request.user.id)
+            cart = store.persist()
 
             if not cart:
                 return JsonResponse({
@@ -1192,39 +1407,29 @@ class ConfirmOrderView(APIView):
                     'Error': 'Корзина пуста'
                 }, status=400)
 
-            # Проверяем доступность товаров
-            unavailable_items = []
-            for item in cart.ordered_items.all():
-                if item.product_info.quantity < item.quantity:
-                    unavailable_items.append({
-                        'product': item.product_info.name,
-                        'available': item.product_info.quantity,
-                        'requested': item.quantity
-                    })
-
-            if unavailable_items:
+            # Статус и остатки меняются одной транзакцией, нехватка откатывает весь заказ
+            try:
+                change_state(cart, 'new', contact=contact)
+            except OrderStateException as e:
                 return JsonResponse({
                     'Status': False,
-                    'Error': 'Недостаточно товаров на складе',
-                    'UnavailableItems': unavailable_items
+                    'Error': e.detail
+                }, status=400)
+            except InventoryException as e:
+                lines = order_lines(cart.id)
+                return JsonResponse({
+                    'Status': False,
+                    'Error': e.detail,
+                    'UnavailableItems': unavailable_items(lines, held_by_others(request.user.id, lines))
                 }, status=400)
 
-            # Обновляем заказ
-            cart.contact = contact
-            cart.state = 'new'  # меняем статус на "новый"
-            cart.save()
-
-            # Резервируем товары (уменьшаем количество на складе)
-            for item in cart.ordered_items.all():
-                product_info = item.product_info
-                product_info.quantity -= item.quantity
-                product_info.save()
+            store.discard()
 
             return JsonResponse({
                 'Status': True,
                 'Message': 'Заказ успешно подтвержден',
                 'OrderId': cart.id,
-                'OrderState': cart.state
+                'OrderState': 'new'
             })
 
         except Exception as e:
@@ -1412,23 +1617,19 @@ class CancelOrderView(APIView):
                     'Error': 'Заказ не найден'
                 }, status=404)
 
-            # Проверяем что заказ можно отменить
-            if order.state in ['delivered', 'canceled']:
+            # Статус меняется по условию, остатки возвращаются одним запросом
+            was_basket = order.state == 'basket'
+            try:
+                change_state(order, 'canceled')
+            except OrderStateException as e:
                 return JsonResponse({
                     'Status': False,
-                    'Error': f'Невозможно отменить заказ в статусе "{order.get_state_display()}"'
+                    'Error': e.detail
                 }, status=400)
 
-            # Возвращаем товары на склад
-            if order.state != 'basket':
-                for item in order.ordered_items.all():
-                    product_info = item.product_info
-                    product_info.quantity += item.quantity
-                    product_info.save()
-
-            # Меняем статус заказа
-            order.state = 'canceled'
-            order.save()
+            if was_basket:
+                # Отмененная корзина не должна вернуться из Redis при следующем сохранении
+                get_cart(request.user.id).discard()
 
             return JsonResponse({
                 'Status': True,
@@ -2151,9 +2352,17 @@ class CacheStatsView(APIView):
                                 'hits': {'type': 'integer', 'example': 75},
                                 'misses': {'type': 'integer', 'example': 25},
                                 'hit_rate_percent': {'type': 'number', 'example': 75.0},
+                                'l1_hits': {'type': 'integer', 'example': 60},
+                                'l2_hits': {'type': 'integer', 'example': 15},
+                                'l1_hit_rate_percent': {'type': 'number', 'example': 60.0},
+                                'l2_hit_rate_percent': {'type': 'number', 'example': 37.5},
                                 'avg_time_with_cache_ms': {'type': 'number', 'example': 5.2},
                                 'avg_time_without_cache_ms': {'type': 'number', 'example': 150.8},
-                                'total_time_saved_seconds': {'type': 'number', 'example': 12.5}
+                                'total_time_saved_seconds': {'type': 'number', 'example': 12.5},
+                                'coalesced': {'type': 'integer', 'example': 12},
+                                'stale_served': {'type': 'integer', 'example': 3},
+                                'recomputed': {'type': 'integer', 'example': 25},
+                                'early_refreshes': {'type': 'integer', 'example': 4}
                             }
                         },
                         'redis_info': {
@@ -2217,22 +2426,34 @@ class CacheStatsView(APIView):
 
 class CacheManagementView(APIView):
     """
-    API для управления кешем (очистка, инвалидация)
+    API для управления кешем (инвалидация)
+
+    Записи сбрасываются сменой поколения пространства имен (catalog, shop:<id>,
+    category:<id>) или по тегам зависимостей. cache.clear() не используется:
+    в том же кеше хранятся сессии и счетчики троттлинга.
     """
     authentication_classes = [TokenAuthentication]
     permission_classes = [IsAuthenticated]
 
     @extend_schema(
-        summary="Очистка кеша",
-        description="Очистка всего кеша или определенных паттернов",
+        summary="Инвалидация кеша",
+        description="Смена поколения пространств имен кеша или инвалидация по тегам; "
+                    "без параметров сбрасывается пространство catalog",
         request={
             'application/json': {
                 'type': 'object',
                 'properties': {
-                    'pattern': {
-                        'type': 'string',
-                        'example': '*product*',
-                        'description': 'Паттерн для очистки (оставьте пустым для очистки всего кеша)'
+                    'namespaces': {
+                        'type': 'array',
+                        'items': {'type': 'string'},
+                        'example': ['catalog', 'shop:1', 'category:224'],
+                        'description': 'Пространства имен для смены поколения'
+                    },
+                    'tags': {
+                        'type': 'array',
+                        'items': {'type': 'string'},
+                        'example': ['shop:1', 'category:224', 'products:all:all'],
+                        'description': 'Теги для инвалидации'
                     }
                 }
             }
@@ -2240,19 +2461,32 @@ class CacheManagementView(APIView):
     )
     def post(self, request, *args, **kwargs):
         try:
-            from django.core.cache import cache
-            from backend.cache_utils import invalidate_cache_pattern
-
-            pattern = request.data.get('pattern')
+            namespaces = request.data.get('namespaces') or []
+            tags = request.data.get('tags') or []
+            if isinstance(namespaces, str):
+                namespaces = [namespaces]
+            if isinstance(tags, str):
+                tags = [tags]
+            if not namespaces and not tags:
+                namespaces = [CATALOG_NAMESPACE]
+
+            invalid = [namespace for namespace in namespaces if not NAMESPACE_RE.match(str(namespace))]
+            if invalid:
+                return Response({
+                    'Status': False,
+                    'Error': f'Неизвестные пространства имен: {", ".join(map(str, invalid))}'
+                }, status=400)
 
-            if pattern:
-                # Очистка по паттерну
-                cleared_count = invalidate_cache_pattern(pattern)
-                message = f'Очищено {cleared_count} ключей по паттерну: {pattern}'
-            else:
-                # Очистка всего кеша
-                cache.clear()
-                message = 'Весь кеш очищен'
+            messages = []
+            if namespaces:
+                generations = bump_generation(*namespaces)
+                messages.append('Новые поколения: ' + ', '.join(
+                    f'{namespace}={generation}' for namespace, generation in sorted(generations.items())))
+            if tags:
+                # Удаляются только записи, зарегистрированные под тегами
+                cleared_count = invalidate_tags(*tags)
+                messages.append(f'Очищено {cleared_count} ключей по тегам: {", ".join(tags)}')
+            message = '; '.join(messages)
 
             return Response({
                 'Status': True,
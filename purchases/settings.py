@@ -69,6 +69,7 @@ INSTALLED_APPS = [
     'django.contrib.sessions',
     'django.contrib.messages',
     'django.contrib.staticfiles',
+    'django.contrib.postgres',
     'backend',
     'rest_framework.authtoken',
     'django_rest_passwordreset',
@@ -217,6 +218,25 @@ CELERY_TASK_SERIALIZER = 'json'
 CELERY_RESULT_SERIALIZER = 'json'
 CELERY_TIMEZONE = TIME_ZONE
 
+# Поиск товаров: auto - Postgres (полнотекстовый + триграммы), иначе индекс в памяти;
+# postgres или inverted - принудительно
+PRODUCT_SEARCH_BACKEND = os.getenv('PRODUCT_SEARCH_BACKEND', 'auto')
+
+# Плановое обновление прайсов магазинов (backend.tasks.refresh_shop_catalogs)
+# Сколько импортов может идти одновременно по всем магазинам
+CATALOG_IMPORT_MAX_CONCURRENT = int(os.getenv('CATALOG_IMPORT_MAX_CONCURRENT', 5))
+# Окно в секундах, по которому случайно разносится запуск плановых импортов
+CATALOG_REFRESH_JITTER = int(os.getenv('CATALOG_REFRESH_JITTER', 15 * 60))
+
+# Резерв товара за корзиной при добавлении (backend.stock), секунд; 0 - резервы отключены.
+# Истекшие резервы снимает задача release_expired_stock_holds
+STOCK_HOLD_TIMEOUT = int(os.getenv('STOCK_HOLD_TIMEOUT', 0))
+
+# Хранилище корзин (backend.carts): db - Order/OrderItem, redis - hash в Redis с сохранением
+# в БД при оформлении заказа и задачей flush_carts
+CART_BACKEND = os.getenv('CART_BACKEND', 'db')
+CART_REDIS_TIMEOUT = int(os.getenv('CART_REDIS_TIMEOUT', 60 * 60 * 24 * 30))  # секунд
+
 EMAIL_BACKEND = 'django.core.mail.backends.smtp.EmailBackend'
 EMAIL_USE_TLS = False
 EMAIL_HOST = 'smtp.mail.ru'
@@ -398,20 +418,23 @@ CACHEOPS = {
         'ops': 'get',
         'timeout': 60 * 15,  # 15 минут
     },
+    # Read model каталога обновляется bulk-операциями, которые cacheops не отслеживает
+    'backend.catalogentry': None,
+    'backend.facetcount': None,
 }
 
 # Session cache (опционально)
 SESSION_ENGINE = 'django.contrib.sessions.backends.cache'
 SESSION_CACHE_ALIAS = 'default'
 
-# Cache middleware
-CACHE_MIDDLEWARE_SECONDS = 60 * 15  # 15 минут
-CACHE_MIDDLEWARE_KEY_PREFIX = 'purchases'
-
 # Cache timeout settings
 CACHE_TTL = {
     'SHORT': 60 * 5,      # 5 минут
     'MEDIUM': 60 * 30,    # 30 минут
     'LONG': 60 * 60,      # 1 час
     'VERY_LONG': 60 * 60 * 24,  # 1 день
-}
\ No newline at end of file
+}
+
+# L1-кеш в памяти процесса перед Redis (backend.local_cache)
+CACHE_L1_MAX_ENTRIES = int(os.getenv('CACHE_L1_MAX_ENTRIES', 1000))
+CACHE_L1_TIMEOUT = int(os.getenv('CACHE_L1_TIMEOUT', 5))  # секунд
@@ -3,8 +3,8 @@ from django.contrib import admin
 from django.urls import path, include
 from drf_spectacular.views import SpectacularAPIView, SpectacularSwaggerView, SpectacularRedocView
 
-from backend.views import UpdatePrice, UserLogin, UserRegister, UserActivation, ProductListView, CategoryListView, \
-    ShopListView, CartView, AddToCartView, RemoveFromCartView, UpdateCartItemView, ClearCartView, ContactListView, \
+from backend.views import UpdatePrice, ImportStatusView, UserLogin, UserRegister, UserActivation, ProductListView, CategoryListView, \
+    ProductFacetsView, ShopListView, CartView, AddToCartView, BatchAddToCartView, RemoveFromCartView, UpdateCartItemView, ClearCartView, ContactListView, \
     AddContactView, UpdateContactView, DeleteContactView, SetDefaultContactView, ConfirmOrderView, OrderListView, \
     OrderDetailView, CancelOrderView, GoogleAuthSuccessView, GoogleAuthErrorView, GoogleAuthInitView, \
     UserAvatarUploadView, DeleteUserAvatarView, ProductImageUploadView, SentryTestView, SentryPerformanceTestView, \
@@ -17,14 +17,17 @@ urlpatterns = [
     path('api/docs/', SpectacularSwaggerView.as_view(url_name='schema'), name='swagger-ui'),
     path('api/redoc/', SpectacularRedocView.as_view(url_name='schema'), name='redoc'),
     path('partner/update/', UpdatePrice.as_view(), name='partner_update'),
+    path('partner/update/status/<str:job_id>/', ImportStatusView.as_view(), name='partner_update_status'),
     path('login/', UserLogin.as_view(), name='user_login'),
     path('register/', UserRegister.as_view(), name='user_register'),
     path('useractivation/', UserActivation.as_view(), name='user_activation'),
     path('products/', ProductListView.as_view(), name='products'),
+    path('products/facets/', ProductFacetsView.as_view(), name='product_facets'),
     path('categories/', CategoryListView.as_view(), name='categories'),
     path('shops/', ShopListView.as_view(), name='shops'),
     path('cart/', CartView.as_view(), name='cart'),
     path('cart/add/', AddToCartView.as_view(), name='add-to-cart'),
+    path('cart/add/batch/', BatchAddToCartView.as_view(), name='batch-add-to-cart'),
     path('cart/remove/', RemoveFromCartView.as_view(), name='remove-from-cart'),
     path('cart/update/', UpdateCartItemView.as_view(), name='update-cart-item'),
     path('cart/clear/', ClearCartView.as_view(), name='clear-cart'),